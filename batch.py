@@ -0,0 +1,404 @@
+"""
+JSONL batch mode for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: asyncio, json, os, time, ledger, router
+Licence: Please cite if used.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+from ledger import BudgetExceeded
+from router import AUTO
+
+DEFAULT_BATCH_CONCURRENCY = 16
+PROGRESS_INTERVAL = 2.0
+SYNC_EVERY = 100
+
+
+def read_queries(path):
+    """
+    Read queries from a JSONL file, one {"query": ...} object per line.
+
+    Lines without an "id" are numbered by their line in the file. Each query
+    comes with the key it is checkpointed under, which keeps explicit IDs
+    apart from line numbers, so {"id": 3} never stands in for line 3.
+
+    Args:
+        path (str): The path to the JSONL file.
+
+    Yields:
+        tuple: The checkpoint key and the query record.
+    """
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "id" in record:
+                key = json.dumps(["id", record["id"]])
+            else:
+                record["id"] = line_number
+                key = json.dumps(["line", line_number])
+            yield key, record
+
+
+def count_queries(path):
+    """
+    Count the non-empty lines in a JSONL file.
+
+    Args:
+        path (str): The path to the JSONL file.
+
+    Returns:
+        int: The number of queries.
+    """
+    with open(path, 'r') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def checkpoint_path(output_path):
+    """
+    Return the checkpoint journal path for a results file.
+
+    Args:
+        output_path (str): The results file.
+
+    Returns:
+        str: The journal path.
+    """
+    return output_path + ".ckpt"
+
+
+class Checkpoint:
+    """
+    Journal of finished queries for resuming a batch.
+
+    Each line records a query's key, whether it failed, and the length of
+    the results file after its result was written. On resume the results
+    file is cut back to the last recorded length, so a result written just
+    before a crash but never checkpointed is dropped and run again rather
+    than duplicated. Failed queries are dropped from both files and run
+    again too.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize the checkpoint.
+
+        Args:
+            path (str): The path to the journal file.
+        """
+        self.path = path
+        self.file = None
+        self.pending = 0
+
+    def exists(self):
+        """
+        Check whether a journal from an earlier run exists.
+
+        Returns:
+            bool: True if the journal file exists.
+        """
+        return os.path.exists(self.path)
+
+    def load(self, output_path):
+        """
+        Read the finished queries and cut the results file back to match.
+
+        Args:
+            output_path (str): The results file written alongside the journal.
+
+        Returns:
+            set: The keys of queries that succeeded.
+        """
+        finished = []
+        size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash mid-write
+                    break
+                # Results past the end of the file were lost before they reached disk
+                if entry["offset"] > size:
+                    break
+                finished.append(entry)
+        offset = finished[-1]["offset"] if finished else 0
+        with open(output_path, 'a') as output:
+            output.truncate(offset)
+        if any(entry.get("failed") for entry in finished):
+            finished = self.drop_failed(output_path, finished)
+        self.rewrite(finished)
+        return {entry["key"] for entry in finished}
+
+    def drop_failed(self, output_path, entries):
+        """
+        Remove the results of failed queries so they are written once, when retried.
+
+        Args:
+            output_path (str): The results file, already cut back to the last entry.
+            entries (list): The journal entries, one per result line, in order.
+
+        Returns:
+            list: The entries that succeeded, with their offsets in the rewritten file.
+        """
+        with open(output_path, 'rb') as f:
+            data = f.read()
+        kept = []
+        lines = []
+        start = size = 0
+        for entry in entries:
+            line = data[start:entry["offset"]]
+            start = entry["offset"]
+            if entry.get("failed"):
+                continue
+            lines.append(line)
+            size += len(line)
+            kept.append(dict(entry, offset=size))
+        temp = output_path + ".tmp"
+        with open(temp, 'wb') as f:
+            f.write(b"".join(lines))
+        os.replace(temp, output_path)
+        return kept
+
+    def rewrite(self, entries):
+        """
+        Replace the journal with the given entries.
+
+        Args:
+            entries (list): The journal entries to keep.
+        """
+        with open(self.path, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+
+    def open(self):
+        """
+        Open the journal for appending.
+        """
+        self.file = open(self.path, 'a')
+
+    def record(self, key, offset, output, failed=False):
+        """
+        Record a finished query once its result is in the results file.
+
+        Args:
+            key (str): The query's checkpoint key.
+            offset (int): The length of the results file after the result.
+            output (file): The open results file.
+            failed (bool): Whether the query failed and should run again on resume.
+        """
+        output.flush()
+        entry = {"key": key, "offset": offset}
+        if failed:
+            entry["failed"] = True
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        self.pending += 1
+        if self.pending >= SYNC_EVERY:
+            self.sync(output)
+
+    def sync(self, output):
+        """
+        Flush the results file and then the journal to disk.
+
+        Args:
+            output (file): The open results file.
+        """
+        os.fsync(output.fileno())
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self, output):
+        """
+        Sync and close the journal.
+
+        Args:
+            output (file): The open results file.
+        """
+        if self.file is not None:
+            output.flush()
+            self.sync(output)
+            self.file.close()
+            self.file = None
+
+
+class BatchRunner:
+    """
+    Run a JSONL file of queries through the client with bounded parallelism.
+
+    Each query may override "model", "max_tokens", "temperature" and "role".
+    Results are written as JSONL in completion order while the batch runs,
+    and a checkpoint journal next to the results lets an interrupted batch
+    pick up where it stopped.
+    """
+
+    def __init__(self, client, defaults, models=None, concurrency=DEFAULT_BATCH_CONCURRENCY,
+                 progress_interval=PROGRESS_INTERVAL, router=None):
+        """
+        Initialize the batch runner.
+
+        Args:
+            client (AsyncClient): The client used to send requests.
+            defaults (dict): Default "model", "max_tokens", "temperature" and "role".
+            models (dict): Model names mapped to engines.
+            concurrency (int): The number of queries in flight at once.
+            progress_interval (float): Seconds between progress reports.
+            router (ModelRouter): Picks the engine for queries whose model is "Auto".
+        """
+        self.client = client
+        self.router = router
+        self.defaults = defaults
+        self.models = models or {}
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.start = None
+        self.stopped = None
+
+    def build_request(self, record):
+        """
+        Build the engine, prompt and settings for a query.
+
+        Args:
+            record (dict): The query record.
+
+        Returns:
+            tuple: Engine, prompt, max tokens and temperature.
+        """
+        settings = dict(self.defaults, **record)
+        engine = self.models.get(settings["model"], settings["model"])
+        role = settings.get("role")
+        prompt = f"{role}: {record['query']}" if role else record["query"]
+        return engine, prompt, settings["max_tokens"], settings["temperature"]
+
+    async def run_query(self, record):
+        """
+        Run one query and build its output record.
+
+        Args:
+            record (dict): The query record.
+
+        Returns:
+            dict: The result record with the response or the error.
+        """
+        result = {"id": record["id"], "query": record.get("query")}
+        try:
+            engine, prompt, max_tokens, temperature = self.build_request(record)
+            if engine == AUTO and self.router is not None:
+                response = await self.router.complete(prompt, max_tokens, temperature)
+                engine = response["model"]
+            else:
+                response = await self.client.complete(engine, prompt, max_tokens, temperature)
+            result["model"] = engine
+            result.update(response=response["text"], usage=response["usage"],
+                          latency=response["latency"], cached=response.get("cached", False))
+        except (asyncio.CancelledError, BudgetExceeded):
+            raise
+        except Exception as e:
+            self.failed += 1
+            result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    async def worker(self, queue, output, checkpoint):
+        """
+        Take queries off the queue until it is closed with None.
+
+        Args:
+            queue (asyncio.Queue): The pending queries.
+            output (file): The open results file.
+            checkpoint (Checkpoint): The journal of finished queries.
+        """
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if self.stopped is not None:
+                continue
+            key, record = item
+            try:
+                result = await self.run_query(record)
+            except BudgetExceeded as e:
+                # Leave the query unfinished so a resumed run picks it up
+                self.stopped = str(e)
+                continue
+            output.write(json.dumps(result) + "\n")
+            checkpoint.record(key, output.tell(), output, failed="error" in result)
+            self.done += 1
+
+    async def report_progress(self):
+        """
+        Print progress and throughput until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self.print_progress()
+
+    def print_progress(self):
+        """
+        Print one progress line.
+        """
+        elapsed = time.monotonic() - self.start
+        rate = (self.done - self.skipped) / elapsed if elapsed else 0.0
+        print(f"Batch: {self.done}/{self.total} done, {self.failed} failed, "
+              f"{rate:.1f} queries/s", flush=True)
+
+    async def run(self, input_path, output_path, resume=True):
+        """
+        Run every query in the input file and write the results.
+
+        Args:
+            input_path (str): The JSONL file of queries.
+            output_path (str): The JSONL file for results.
+            resume (bool): Skip queries finished by an earlier run of this batch.
+
+        Returns:
+            dict: The number of queries done, skipped and failed, the elapsed time, and
+                the reason the run stopped early, if a budget cap stopped it.
+        """
+        self.total = count_queries(input_path)
+        checkpoint = Checkpoint(checkpoint_path(output_path))
+        finished = set()
+        if resume and checkpoint.exists():
+            finished = checkpoint.load(output_path)
+        elif os.path.exists(output_path) or checkpoint.exists():
+            open(output_path, 'w').close()
+            checkpoint.rewrite([])
+        self.done = self.skipped = len(finished)
+        self.start = time.monotonic()
+        # A bounded queue keeps memory flat however large the input file is
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        with open(output_path, 'a') as output:
+            checkpoint.open()
+            workers = [asyncio.create_task(self.worker(queue, output, checkpoint))
+                       for _ in range(self.concurrency)]
+            progress = asyncio.create_task(self.report_progress())
+            try:
+                for key, record in read_queries(input_path):
+                    if self.stopped is not None:
+                        break
+                    if key not in finished:
+                        await queue.put((key, record))
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                progress.cancel()
+                for task in workers:
+                    task.cancel()
+                checkpoint.close(output)
+        self.print_progress()
+        if self.stopped is not None:
+            print(f"Batch stopped: {self.stopped}")
+        return {"done": self.done, "skipped": self.skipped, "failed": self.failed,
+                "elapsed": time.monotonic() - self.start, "stopped": self.stopped}
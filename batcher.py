@@ -0,0 +1,162 @@
+"""
+Prompt micro-batching for browseGPT
+
+The Completions endpoint takes a list of prompts in one call. MicroBatcher
+sits in front of a backend and folds completion requests that share an
+engine and settings into one such call.
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: asyncio, json, tokenizer
+Licence: Please cite if used.
+"""
+
+import asyncio
+import json
+
+from tokenizer import count_tokens
+
+DEFAULT_WINDOW = 0.02
+DEFAULT_MAX_BATCH = 20
+
+
+def split_usage(usage, prompts, texts):
+    """
+    Split a batch's usage across its prompts in proportion to local counts.
+
+    Args:
+        usage (dict): The usage block of the batched response.
+        prompts (list): The prompts in the batch.
+        texts (list): The completion text for each prompt.
+
+    Returns:
+        list: One usage dict per prompt.
+    """
+    prompt_counts = [count_tokens(prompt) for prompt in prompts]
+    completion_counts = [count_tokens(text) for text in texts]
+    prompt_total = usage.get("prompt_tokens", sum(prompt_counts))
+    completion_total = usage.get("completion_tokens", sum(completion_counts))
+    split = []
+    for prompt_count, completion_count in zip(prompt_counts, completion_counts):
+        prompt_tokens = round(prompt_total * prompt_count / (sum(prompt_counts) or 1))
+        completion_tokens = round(completion_total * completion_count / (sum(completion_counts) or 1))
+        split.append({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens})
+    return split
+
+
+class MicroBatcher:
+    """
+    Backend wrapper that batches completion prompts into one request.
+
+    Non-streaming completion requests are queued by their settings (engine,
+    max_tokens, temperature and credentials). A queue is sent as one request
+    when it reaches max_batch prompts or window seconds after its first
+    prompt, and the choices are handed back by index. Chat and streaming
+    requests pass straight through.
+    """
+
+    def __init__(self, backend, window=DEFAULT_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        """
+        Initialize the batcher.
+
+        Args:
+            backend (object): Backend with send() and send_batch() methods.
+            window (float): Seconds to wait for more prompts after the first.
+            max_batch (int): The most prompts per request.
+        """
+        self.backend = backend
+        self.window = window
+        self.max_batch = max_batch
+        self.groups = {}
+        self.timers = {}
+        self.counters = {"prompts": 0, "batches": 0}
+
+    async def send(self, endpoint, params, on_token=None):
+        """
+        Queue a completion for batching, or pass other requests through.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            on_token (callable): Called with each token when streaming.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        if endpoint != "completion" or on_token is not None or not isinstance(params["prompt"], str):
+            return await self.backend.send(endpoint, params, on_token)
+
+        key = json.dumps({k: v for k, v in params.items() if k != "prompt"}, sort_keys=True)
+        future = asyncio.get_running_loop().create_future()
+        group = self.groups.setdefault(key, [])
+        group.append((params["prompt"], future))
+        self.counters["prompts"] += 1
+        if len(group) >= self.max_batch:
+            self.flush(key, params)
+        elif len(group) == 1:
+            self.timers[key] = asyncio.get_running_loop().call_later(self.window, self.flush, key, params)
+        return await future
+
+    def flush(self, key, params):
+        """
+        Send a queue of prompts now.
+
+        Args:
+            key (str): The queue's settings key.
+            params (dict): Parameters of any request in the queue.
+        """
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        group = self.groups.pop(key, None)
+        if group:
+            asyncio.ensure_future(self.send_group(params, group))
+
+    async def send_group(self, params, group):
+        """
+        Send a queue of prompts as one request and resolve each caller.
+
+        Args:
+            params (dict): Parameters shared by the queue.
+            group (list): (prompt, future) pairs.
+        """
+        # Callers that timed out while queued no longer need an answer
+        live = [(prompt, future) for prompt, future in group if not future.done()]
+        if not live:
+            return
+        prompts = [prompt for prompt, _ in live]
+        self.counters["batches"] += 1
+        try:
+            if len(live) == 1:
+                results = [await self.backend.send("completion", dict(params, prompt=prompts[0]))]
+            else:
+                results, usage = await self.backend.send_batch(dict(params, prompt=prompts))
+                for result, split in zip(results, split_usage(usage, prompts, [r["text"] for r in results])):
+                    result["usage"] = split
+        except Exception as e:
+            for _, future in live:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(live, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        """
+        Return the batching counters.
+
+        Returns:
+            dict: Prompts, batches and the mean batch size.
+        """
+        stats = dict(self.counters)
+        stats["mean_batch"] = stats["prompts"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    async def close(self):
+        """
+        Close the wrapped backend.
+        """
+        if hasattr(self.backend, "close"):
+            await self.backend.close()
@@ -0,0 +1,11 @@
+"""
+Benchmark suite for browseGPT
+
+Run with: python -m bench [--output results.json]
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Licence: Please cite if used.
+"""
+
+from bench.suite import bench_export, bench_history, bench_pipeline, bench_tokenizer, percentiles
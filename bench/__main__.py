@@ -0,0 +1,90 @@
+"""
+Command line entry point for the browseGPT benchmarks
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: argparse, json, platform, sys, datetime.datetime, bench
+Licence: Please cite if used.
+"""
+
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime
+
+from bench.suite import bench_export, bench_history, bench_pipeline, bench_tokenizer
+
+BENCHMARKS = ("pipeline", "streaming", "history", "export", "tokenizer")
+
+
+def parse_args(argv=None):
+    """
+    Parse the benchmark options.
+
+    Args:
+        argv (list): The arguments, defaulting to sys.argv.
+
+    Returns:
+        argparse.Namespace: The options.
+    """
+    parser = argparse.ArgumentParser(prog="python -m bench",
+                                     description="Benchmark the browseGPT pipeline against a mock backend.")
+    parser.add_argument("--only", default=",".join(BENCHMARKS),
+                        help=f"comma-separated benchmarks to run, from {', '.join(BENCHMARKS)}")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--seed", type=int, default=1)
+    pipeline = parser.add_argument_group("pipeline")
+    pipeline.add_argument("--requests", type=int, default=500)
+    pipeline.add_argument("--concurrency", type=int, default=32)
+    pipeline.add_argument("--max-tokens", type=int, default=60)
+    pipeline.add_argument("--latency", type=float, default=0.05, help="median seconds to first token")
+    pipeline.add_argument("--jitter", type=float, default=0.5, help="log-normal sigma of the latency")
+    pipeline.add_argument("--tokens-per-second", type=float, default=500.0)
+    pipeline.add_argument("--error-rate", type=float, default=0.0)
+    pipeline.add_argument("--rate-limit-rate", type=float, default=0.0)
+    pipeline.add_argument("--repeat", type=float, default=0.0, help="share of prompts that repeat earlier ones")
+    pipeline.add_argument("--cache", action="store_true", help="put the response cache in front")
+    pipeline.add_argument("--batch", action="store_true", help="micro-batch completion prompts")
+    pipeline.add_argument("--server", action="store_true", help="go through the mock HTTP server")
+    storage = parser.add_argument_group("history and tokenizer")
+    storage.add_argument("--history-records", type=int, default=5000)
+    storage.add_argument("--export-sizes", default="100,1000,10000")
+    storage.add_argument("--tokenizer-words", type=int, default=100000)
+    options = parser.parse_args(argv)
+    options.only = [name.strip() for name in options.only.split(",") if name.strip()]
+    options.export_sizes = [int(size) for size in options.export_sizes.split(",")]
+    unknown = set(options.only) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    return options
+
+
+def main(argv=None):
+    """
+    Run the selected benchmarks and write the results as JSON.
+
+    Args:
+        argv (list): The arguments, defaulting to sys.argv.
+    """
+    options = parse_args(argv)
+    results = {"timestamp": datetime.now().isoformat(), "python": platform.python_version(),
+               "platform": platform.platform(), "options": vars(options)}
+    runners = {"pipeline": lambda: bench_pipeline(options),
+               "streaming": lambda: bench_pipeline(options, stream=True),
+               "history": lambda: bench_history(options),
+               "export": lambda: bench_export(options),
+               "tokenizer": lambda: bench_tokenizer(options)}
+    for name in options.only:
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = runners[name]()
+    text = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Benchmarks for the browseGPT chat pipeline
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, asyncio, json, os, random, shutil, tempfile, time, tracemalloc, client, batcher, cache, history, mock_server, ratelimit, retry, tokenizer
+Licence: Please cite if used.
+"""
+
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import openai
+
+from batcher import MicroBatcher
+from cache import ResponseCache
+from client import AsyncClient, OpenAIBackend
+from history import open_history
+from mock_server import WORDS, MockBackend, Simulator, start_server
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+from tokenizer import MappedEncoder, compile_tables, load_encoder
+
+ENGINE = "text-davinci-002"
+HISTORY_BACKENDS = ("memory", "journal", "sqlite")
+# Far above any real limit, so the limiter is timed without ever making callers wait
+BENCH_LIMITS = (10 ** 9, 10 ** 12)
+
+
+def percentiles(samples):
+    """
+    Summarize samples by their mean and tail percentiles.
+
+    Args:
+        samples (list): The samples, in seconds.
+
+    Returns:
+        dict: Count, mean, p50, p95, p99 and max.
+    """
+    ordered = sorted(s for s in samples if s is not None)
+    if not ordered:
+        return {"count": 0}
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {"count": len(ordered), "mean": sum(ordered) / len(ordered), "p50": at(0.5),
+            "p95": at(0.95), "p99": at(0.99), "max": ordered[-1]}
+
+
+def make_prompt(rng, words=20):
+    """
+    Make a random prompt.
+
+    Args:
+        rng (random.Random): The random source.
+        words (int): The number of words.
+
+    Returns:
+        str: The prompt.
+    """
+    return "user: " + " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_record(rng, index):
+    """
+    Make a history record shaped like the ones the chat loop saves.
+
+    Args:
+        rng (random.Random): The random source.
+        index (int): The record number.
+
+    Returns:
+        dict: The record.
+    """
+    query = make_prompt(rng)[len("user: "):]
+    response = " ".join(rng.choice(WORDS) for _ in range(60))
+    return {"timestamp": datetime.now().isoformat(), "model": ENGINE, "copilot": index % 5 == 0,
+            "query": query, "response": response, "prompt_tokens": 22,
+            "copilot_response": response if index % 5 == 0 else "", "ttft": rng.random()}
+
+
+def make_client(options, directory):
+    """
+    Build the client the chat loop uses, over a mock backend.
+
+    Args:
+        options (argparse.Namespace): The benchmark options.
+        directory (str): A scratch directory for the cache.
+
+    Returns:
+        tuple: The client and the mock server (None when run in process).
+    """
+    simulator = Simulator(latency=options.latency, jitter=options.jitter,
+                          tokens_per_second=options.tokens_per_second, error_rate=options.error_rate,
+                          rate_limit_rate=options.rate_limit_rate, retry_after=0.01, seed=options.seed)
+    server = None
+    if options.server:
+        server, api_base = start_server(simulator, port=0)
+        # The mock server ignores the key, but openai refuses to send without one
+        openai.api_key = openai.api_key or "mock"
+        backend = OpenAIBackend(api_base=api_base)
+    else:
+        backend = MockBackend(simulator)
+    if options.batch:
+        backend = MicroBatcher(backend)
+    cache = ResponseCache(os.path.join(directory, "cache.sqlite3")) if options.cache else None
+    client = AsyncClient(backend=backend, max_concurrency=options.concurrency, cache=cache,
+                         retry=RetryPolicy(base_delay=0.01), limiter=RateLimiter({}, BENCH_LIMITS))
+    return client, server
+
+
+def bench_pipeline(options, stream=False):
+    """
+    Drive many requests through the client at once.
+
+    Args:
+        options (argparse.Namespace): The benchmark options.
+        stream (bool): Whether to stream the responses.
+
+    Returns:
+        dict: Throughput and latency and time-to-first-token percentiles.
+    """
+    rng = random.Random(options.seed)
+    prompts = [make_prompt(rng) for _ in range(options.requests)]
+    if options.repeat:
+        # Repeat part of the workload so caching and coalescing have work to do
+        prompts = [rng.choice(prompts) if rng.random() < options.repeat else p for p in prompts]
+    directory = tempfile.mkdtemp(prefix="browsegpt-bench-")
+    client, server = make_client(options, directory)
+    latencies = []
+    ttfts = []
+    failures = []
+
+    async def one(prompt):
+        start = time.monotonic()
+        try:
+            result = await client.complete(ENGINE, prompt, options.max_tokens, 0,
+                                           on_token=(lambda token: None) if stream else None)
+        except Exception as e:
+            failures.append(type(e).__name__)
+            return
+        latencies.append(time.monotonic() - start)
+        ttfts.append(result["ttft"])
+
+    async def run_all():
+        await asyncio.gather(*[one(prompt) for prompt in prompts])
+
+    try:
+        start = time.monotonic()
+        client.run(run_all())
+        elapsed = time.monotonic() - start
+    finally:
+        client.close()
+        if client.cache is not None:
+            client.cache.close()
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+    return {"requests": len(prompts), "failed": len(failures),
+            "errors": {name: failures.count(name) for name in set(failures)}, "elapsed": elapsed,
+            "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+            "latency": percentiles(latencies), "ttft": percentiles(ttfts),
+            "retries": client.retry.counters, "coalesced": client.coalesced,
+            "cache": client.cache.stats() if client.cache is not None else None,
+            "batching": client.backend.stats() if options.batch else None}
+
+
+def bench_history(options):
+    """
+    Measure the memory each history backend holds as records are added.
+
+    Args:
+        options (argparse.Namespace): The benchmark options.
+
+    Returns:
+        dict: Backends mapped to memory growth and append rate.
+    """
+    rng = random.Random(options.seed)
+    # Records are parsed inside the measured loop so each one is a fresh object
+    lines = [json.dumps(make_record(rng, i)) for i in range(options.history_records)]
+    results = {}
+    for backend in HISTORY_BACKENDS:
+        directory = tempfile.mkdtemp(prefix="browsegpt-bench-")
+        tracemalloc.start()
+        try:
+            history = open_history(backend, os.path.join(directory, f"history.{backend}"))
+            base, _ = tracemalloc.get_traced_memory()
+            start = time.monotonic()
+            for line in lines:
+                history.append(json.loads(line))
+            elapsed = time.monotonic() - start
+            current, peak = tracemalloc.get_traced_memory()
+            history.close()
+        finally:
+            tracemalloc.stop()
+            shutil.rmtree(directory, ignore_errors=True)
+        results[backend] = {"records": len(lines), "memory_growth_bytes": current - base,
+                            "bytes_per_record": (current - base) / len(lines),
+                            "peak_bytes": peak - base,
+                            "appends_per_second": len(lines) / elapsed if elapsed else 0.0}
+    return results
+
+
+def bench_export(options):
+    """
+    Time exporting each history backend at several sizes.
+
+    Args:
+        options (argparse.Namespace): The benchmark options.
+
+    Returns:
+        dict: Backends mapped to one timing per size.
+    """
+    rng = random.Random(options.seed)
+    results = {}
+    for backend in HISTORY_BACKENDS:
+        results[backend] = []
+        for size in options.export_sizes:
+            directory = tempfile.mkdtemp(prefix="browsegpt-bench-")
+            try:
+                history = open_history(backend, os.path.join(directory, f"history.{backend}"))
+                for i in range(size):
+                    history.append(make_record(rng, i))
+                target = os.path.join(directory, f"export{history.extension}")
+                start = time.monotonic()
+                history.export(target)
+                elapsed = time.monotonic() - start
+                results[backend].append({"records": size, "seconds": elapsed,
+                                         "bytes": os.path.getsize(target),
+                                         "records_per_second": size / elapsed if elapsed else 0.0})
+                history.close()
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def bench_tokenizer(options):
+    """
+    Measure cold-start load time and encoding throughput of the JSON and the
+    memory-mapped tables, with a cold and a warm merge cache.
+
+    Fresh encoders are built rather than the shared one, which earlier
+    benchmarks will already have loaded.
+
+    Args:
+        options (argparse.Namespace): The benchmark options.
+
+    Returns:
+        dict: Per encoder, load time, then tokens and bytes per second for each pass.
+    """
+    rng = random.Random(options.seed)
+    # Mix common words with random strings so the cold pass has real merging to do
+    words = list(WORDS) + ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 12)))
+                           for _ in range(2000)]
+    text = " ".join(rng.choice(words) for _ in range(options.tokenizer_words))
+    size = len(text.encode("utf-8"))
+    results = {"bytes": size}
+    directory = tempfile.mkdtemp(prefix="browsegpt-bench-")
+    try:
+        # Compile a private copy so the mapped load is timed whether or not gpt_encoder.bin exists
+        compiled = os.path.join(directory, "encoder.bin")
+        compile_tables(output=compiled)
+        for name, load in (("json", load_encoder), ("mapped", lambda: MappedEncoder(compiled))):
+            start = time.monotonic()
+            encoder = load()
+            results[name] = {"load_seconds": time.monotonic() - start}
+            for cache in ("cold", "warm"):
+                start = time.monotonic()
+                tokens = encoder.encode(text)
+                elapsed = time.monotonic() - start
+                results[name][cache] = {"tokens": len(tokens), "seconds": elapsed,
+                                        "tokens_per_second": len(tokens) / elapsed if elapsed else 0.0,
+                                        "bytes_per_second": size / elapsed if elapsed else 0.0}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
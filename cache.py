@@ -0,0 +1,192 @@
+"""
+Response cache for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: sqlite3, json, hashlib, threading, time, collections.OrderedDict
+Licence: Please cite if used.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_PATH = "gpt_cache.sqlite3"
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MEMORY_ITEMS = 1024
+DEFAULT_DISK_ITEMS = 100000
+
+# Disk eviction scans the table, so only run it every so many writes
+EVICT_EVERY = 100
+
+
+class ResponseCache:
+    """
+    Two-tier response cache: an in-memory LRU in front of a SQLite store.
+
+    Responses are keyed on the endpoint and the request parameters (model,
+    prompt, max_tokens, temperature). Sampled requests (temperature > 0) are
+    not cached unless cache_sampled is set.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, max_memory_items=DEFAULT_MEMORY_ITEMS,
+                 max_disk_items=DEFAULT_DISK_ITEMS, cache_sampled=False):
+        """
+        Initialize the cache and create the SQLite table if needed.
+
+        Args:
+            path (str): The SQLite file, or None to keep only the memory tier.
+            ttl (float): Seconds before an entry expires.
+            max_memory_items (int): The size of the in-memory LRU.
+            max_disk_items (int): The maximum number of rows kept on disk.
+            cache_sampled (bool): Cache requests with temperature > 0 too.
+        """
+        self.ttl = ttl
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.cache_sampled = cache_sampled
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "skipped": 0}
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                            "created REAL NOT NULL, accessed REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.db.commit()
+
+    def make_key(self, endpoint, params):
+        """
+        Build the cache key for a request.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): The request parameters.
+
+        Returns:
+            str: The key, or None if the request should not be cached.
+        """
+        if params.get("temperature", 1) > 0 and not self.cache_sampled:
+            self.counters["skipped"] += 1
+            return None
+        blob = json.dumps([endpoint, params], sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a response, checking memory before disk.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            dict: The cached response, or None on a miss.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created < self.ttl:
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return value
+                del self.memory[key]
+
+            if self.db is not None:
+                row = self.db.execute("SELECT value, created FROM responses WHERE key = ?",
+                                      (key,)).fetchone()
+                if row is not None and now - row[1] < self.ttl:
+                    self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    self.db.commit()
+                    value = json.loads(row[0])
+                    self.remember(key, row[1], value)
+                    self.counters["disk_hits"] += 1
+                    return value
+
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Store a response in both tiers.
+
+        Args:
+            key (str): The cache key.
+            value (dict): The response to cache.
+        """
+        now = time.time()
+        with self.lock:
+            self.remember(key, now, value)
+            if self.db is None:
+                return
+            self.db.execute("INSERT OR REPLACE INTO responses (key, value, created, accessed) "
+                            "VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            self.writes += 1
+            if self.writes % EVICT_EVERY == 0:
+                self.evict(now)
+            self.db.commit()
+
+    def remember(self, key, created, value):
+        """
+        Put an entry in the memory tier, dropping the least recently used.
+
+        Args:
+            key (str): The cache key.
+            created (float): When the entry was first stored.
+            value (dict): The cached response.
+        """
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def evict(self, now):
+        """
+        Drop expired rows and trim the disk tier to its size limit.
+
+        Args:
+            now (float): The current time.
+        """
+        self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        self.db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                        "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_disk_items,))
+
+    def stats(self):
+        """
+        Return the hit and miss counters.
+
+        Returns:
+            dict: Counters plus the overall hit rate.
+        """
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        lookups = hits + self.counters["misses"]
+        stats = dict(self.counters)
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """
+        Remove every entry from both tiers.
+        """
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM responses")
+                self.db.commit()
+
+    def close(self):
+        """
+        Close the SQLite connection.
+        """
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,382 @@
+"""
+Command line interface for browseGPT
+
+Non-interactive entry point for scripts, pipelines and cron jobs. Input is
+read from arguments, files or stdin and results go to stdout; progress and
+errors go to stderr.
+
+Usage:
+    python cli.py ask "What is browseGPT?"
+    echo "What is browseGPT?" | python cli.py ask --model GPT-3.5 --json
+    python cli.py batch queries.jsonl [--output results.jsonl | --output -]
+    python cli.py export [--output history.jsonl]
+    python cli.py search "caching" --limit 5
+    python cli.py bench --only pipeline --requests 200
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, argparse, asyncio, contextlib, json, os, shutil, sys, tempfile, datetime.datetime, batch, batcher, cache, client, history, keypool, ledger, ratelimit, retry, router, tokenizer, vcr, test
+Licence: Please cite if used.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+import openai
+
+from batch import BatchRunner
+from batcher import MicroBatcher
+from cache import ResponseCache
+from client import AsyncClient, OpenAIBackend
+from history import open_history, print_results
+from keypool import KeyPool
+from ledger import BudgetExceeded, Ledger
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+from router import AUTO, POLICIES, ModelRouter
+from test import DEFAULT_SETTINGS, MODELS
+from tokenizer import count_tokens
+from vcr import CassetteMiss
+
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+def fail(message, code=EXIT_FAILED):
+    """
+    Print an error to stderr and exit.
+
+    Args:
+        message (str): The error message.
+        code (int): The exit status.
+    """
+    print(f"error: {message}", file=sys.stderr)
+    sys.exit(code)
+
+
+def open_history_from(args):
+    """
+    Open the history backend chosen on the command line.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+
+    Returns:
+        object: The history.
+    """
+    settings = DEFAULT_SETTINGS["History Settings"]
+    path = args.history_path or (settings["SQLite Path"] if args.history == "sqlite" else settings["Journal Path"])
+    return open_history(args.history, path)
+
+
+def make_client(args, batching=False):
+    """
+    Build a client from the default settings and the command line.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+        batching (bool): Whether to micro-batch completion prompts.
+
+    Returns:
+        AsyncClient: The client.
+    """
+    keys = KeyPool.from_env()
+    if not keys.available():
+        fail("no API key: set OPENAI_API_KEY or OPENAI_API_KEYS", EXIT_USAGE)
+    openai.api_key = keys.available()[0].key
+    client_settings = DEFAULT_SETTINGS["Client Settings"]
+    backend = OpenAIBackend(api_base=args.api_base or client_settings["API Base"])
+    if batching and client_settings["Micro Batching"]:
+        backend = MicroBatcher(backend, window=client_settings["Batch Window"],
+                               max_batch=client_settings["Max Batch"])
+    cache_settings = DEFAULT_SETTINGS["Cache Settings"]
+    cache = None
+    if cache_settings["Enabled"] and not args.no_cache:
+        cache = ResponseCache(cache_settings["Path"], ttl=cache_settings["TTL"],
+                              cache_sampled=cache_settings["Cache Sampled"])
+    ledger_settings = DEFAULT_SETTINGS["Ledger Settings"]
+    ledger = None
+    if ledger_settings["Enabled"]:
+        ledger = Ledger(ledger_settings["Path"],
+                        session_budget=args.budget if args.budget is not None
+                        else ledger_settings["Session Budget"],
+                        daily_budget=ledger_settings["Daily Budget"])
+    retry_settings = DEFAULT_SETTINGS["Retry Settings"]
+    return AsyncClient(backend=backend, max_concurrency=client_settings["Max Concurrency"],
+                       timeout=args.timeout or client_settings["Timeout"], cache=cache,
+                       retry=RetryPolicy(max_attempts=retry_settings["Max Attempts"],
+                                         max_elapsed=retry_settings["Max Elapsed"]),
+                       limiter=RateLimiter(), keys=keys, ledger=ledger)
+
+
+def close_client(client):
+    """
+    Close the client and the stores it writes to.
+
+    Args:
+        client (AsyncClient): The client.
+    """
+    client.close()
+    if client.cache is not None:
+        client.cache.close()
+    if client.ledger is not None:
+        client.ledger.close()
+
+
+def ask(args):
+    """
+    Answer one query from the arguments or stdin.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+    """
+    query = " ".join(args.query) if args.query else sys.stdin.read()
+    query = query.strip()
+    if not query:
+        fail("no query given on the command line or stdin", EXIT_USAGE)
+    if args.model != AUTO and args.model not in MODELS and args.model not in MODELS.values():
+        fail(f"unknown model {args.model}; choose from {', '.join(MODELS)} or {AUTO}", EXIT_USAGE)
+    engine = MODELS.get(args.model, args.model)
+    prompt = f"{args.role}: {query}" if args.role else query
+    stream = args.stream and not args.json
+
+    def print_token(token):
+        sys.stdout.write(token)
+        sys.stdout.flush()
+
+    client = make_client(args)
+    router = None
+    try:
+        if engine == AUTO:
+            router_settings = DEFAULT_SETTINGS["Router Settings"]
+            router = ModelRouter(client, MODELS, policy=args.policy or router_settings["Policy"],
+                                 min_quality=router_settings["Min Quality"],
+                                 log_path=router_settings["Log Path"])
+            request = router.complete(prompt, args.max_tokens, args.temperature,
+                                      on_token=print_token if stream else None)
+        else:
+            request = client.complete(engine, prompt, args.max_tokens, args.temperature,
+                                      on_token=print_token if stream else None)
+        result = client.run(request)
+    except asyncio.TimeoutError:
+        fail("request timed out")
+    except (openai.error.OpenAIError, BudgetExceeded, CassetteMiss) as e:
+        fail(str(e))
+    finally:
+        if router is not None:
+            router.close()
+        close_client(client)
+
+    record = {"timestamp": datetime.now().isoformat(), "model": result.get("model", engine), "copilot": False,
+              "query": query, "response": result["text"], "prompt_tokens": count_tokens(prompt),
+              "completion_tokens": result["usage"].get("completion_tokens") or count_tokens(result["text"]),
+              "copilot_response": "", "ttft": result["ttft"]}
+    if not args.no_history:
+        history = open_history_from(args)
+        history.append(record)
+        history.close()
+    if args.json:
+        print(json.dumps(dict(record, latency=result["latency"], cached=result.get("cached", False))))
+    elif stream:
+        print()
+    else:
+        print(result["text"])
+
+
+def batch(args):
+    """
+    Run a JSONL file of queries, or JSONL on stdin.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+    """
+    scratch = None
+    input_path = args.input
+    if input_path == "-":
+        scratch = tempfile.mkdtemp(prefix="browsegpt-")
+        input_path = os.path.join(scratch, "stdin.jsonl")
+        with open(input_path, 'w') as f:
+            shutil.copyfileobj(sys.stdin, f)
+    to_stdout = args.output == "-" or (args.output is None and args.input == "-")
+    if to_stdout:
+        scratch = scratch or tempfile.mkdtemp(prefix="browsegpt-")
+        output_path = os.path.join(scratch, "results.jsonl")
+    elif args.output is None:
+        stem = input_path[:-len(".jsonl")] if input_path.endswith(".jsonl") else input_path
+        output_path = stem + "_results.jsonl"
+    else:
+        output_path = args.output
+
+    query_settings = DEFAULT_SETTINGS["Query Settings"]
+    defaults = {"model": args.model or DEFAULT_SETTINGS["Model"],
+                "max_tokens": args.max_tokens or query_settings["Max Tokens"],
+                "temperature": query_settings["Temperature"] if args.temperature is None else args.temperature,
+                "role": query_settings["Role"]}
+    client = make_client(args, batching=True)
+    router = ModelRouter(client, MODELS, policy=args.policy or DEFAULT_SETTINGS["Router Settings"]["Policy"])
+    runner = BatchRunner(client, defaults, MODELS, concurrency=args.concurrency or
+                         DEFAULT_SETTINGS["Client Settings"]["Max Concurrency"], router=router)
+    try:
+        # Progress goes to stderr so stdout carries only results
+        with contextlib.redirect_stdout(sys.stderr):
+            summary = client.run(runner.run(input_path, output_path, resume=not args.no_resume))
+        if to_stdout:
+            with open(output_path, 'r') as f:
+                shutil.copyfileobj(f, sys.stdout)
+        else:
+            print(f"Results written to {output_path}", file=sys.stderr)
+    except (json.JSONDecodeError, FileNotFoundError) as e:
+        fail(f"invalid batch input: {e}", EXIT_USAGE)
+    finally:
+        close_client(client)
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+    if summary["failed"] or summary["stopped"]:
+        sys.exit(EXIT_FAILED)
+
+
+def export(args):
+    """
+    Write the chat history as JSONL to a file or stdout.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+    """
+    history = open_history_from(args)
+    try:
+        if args.output and args.output != "-":
+            history.export(args.output)
+            print(f"History exported to {args.output}", file=sys.stderr)
+            return
+        for record in history:
+            sys.stdout.write(json.dumps(record) + "\n")
+    finally:
+        history.close()
+
+
+def search(args):
+    """
+    Search the chat history and print the matches.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+    """
+    history = open_history_from(args)
+    try:
+        if args.history == "sqlite":
+            results = history.search(" ".join(args.text), limit=args.limit, model=args.model)
+        else:
+            results = [r for r in history.search(" ".join(args.text), limit=args.limit)
+                       if args.model is None or r.get("model") == args.model]
+    finally:
+        history.close()
+    if args.json:
+        for record in results:
+            print(json.dumps(record))
+    else:
+        print_results(results)
+    if not results:
+        sys.exit(EXIT_FAILED)
+
+
+def bench(args):
+    """
+    Run the benchmark suite, passing the remaining arguments through.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+    """
+    from bench.__main__ import main
+    main(args.extra)
+
+
+def build_parser():
+    """
+    Build the argument parser.
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(prog="python cli.py", description="browseGPT without the menus.")
+    parser.add_argument("--history", choices=("memory", "journal", "sqlite"),
+                        default=DEFAULT_SETTINGS["History Settings"]["Backend"], help="history backend")
+    parser.add_argument("--history-path", help="history file, defaulting to the backend's usual one")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def client_options(command):
+        command.add_argument("--policy", choices=POLICIES, help="routing policy for --model Auto")
+        command.add_argument("--api-base", help="API base URL, e.g. a local mock server")
+        command.add_argument("--timeout", type=float, help="per-request timeout in seconds")
+        command.add_argument("--budget", type=float, help="spending cap in dollars for this run")
+        command.add_argument("--no-cache", action="store_true", help="skip the response cache")
+
+    query_settings = DEFAULT_SETTINGS["Query Settings"]
+    ask_parser = commands.add_parser("ask", help="answer one query from the arguments or stdin")
+    ask_parser.add_argument("query", nargs="*", help="the query; read from stdin if omitted")
+    ask_parser.add_argument("--model", default=DEFAULT_SETTINGS["Model"], help=f"a MODELS name, engine or {AUTO}")
+    ask_parser.add_argument("--max-tokens", type=int, default=query_settings["Max Tokens"])
+    ask_parser.add_argument("--temperature", type=float, default=query_settings["Temperature"])
+    ask_parser.add_argument("--role", default=query_settings["Role"], help="role prefixed to the query")
+    ask_parser.add_argument("--no-stream", dest="stream", action="store_false", help="print the answer at the end")
+    ask_parser.add_argument("--json", action="store_true", help="print the answer as a JSON record")
+    ask_parser.add_argument("--no-history", action="store_true", help="do not save the turn to history")
+    client_options(ask_parser)
+    ask_parser.set_defaults(handler=ask)
+
+    batch_parser = commands.add_parser("batch", help="run a JSONL file of queries")
+    batch_parser.add_argument("input", help="the JSONL file, or - for stdin")
+    batch_parser.add_argument("--output", help="results file, or - for stdout")
+    batch_parser.add_argument("--model", help=f"default MODELS name, engine or {AUTO}")
+    batch_parser.add_argument("--max-tokens", type=int)
+    batch_parser.add_argument("--temperature", type=float)
+    batch_parser.add_argument("--concurrency", type=int, help="queries in flight at once")
+    batch_parser.add_argument("--no-resume", action="store_true", help="start over instead of resuming")
+    client_options(batch_parser)
+    batch_parser.set_defaults(handler=batch)
+
+    export_parser = commands.add_parser("export", help="write the chat history as JSONL")
+    export_parser.add_argument("--output", help="the export file, or - for stdout (the default)")
+    export_parser.set_defaults(handler=export)
+
+    search_parser = commands.add_parser("search", help="search the chat history")
+    search_parser.add_argument("text", nargs="+", help="words to search for")
+    search_parser.add_argument("--limit", type=int, default=20)
+    search_parser.add_argument("--model", help="only turns with this engine")
+    search_parser.add_argument("--json", action="store_true", help="print matches as JSONL")
+    search_parser.set_defaults(handler=search)
+
+    bench_parser = commands.add_parser("bench", help="run the benchmark suite (see python -m bench -h)")
+    bench_parser.set_defaults(handler=bench)
+    return parser
+
+
+def main(argv=None):
+    """
+    Run one subcommand.
+
+    Args:
+        argv (list): The arguments, defaulting to sys.argv.
+    """
+    parser = build_parser()
+    # The benchmark options belong to the bench package, so pass them through unparsed
+    args, extra = parser.parse_known_args(argv)
+    args.extra = extra
+    if extra and args.handler is not bench:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    try:
+        args.handler(args)
+    except BrokenPipeError:
+        # Output piped into head or similar; stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(EXIT_FAILED)
+
+
+if __name__ == "__main__":
+    main()
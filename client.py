@@ -0,0 +1,699 @@
+"""
+Async client layer for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, aiohttp, asyncio, contextlib, json, threading, time, ratelimit, retry, tokenizer
+Licence: Please cite if used.
+"""
+
+import asyncio
+import contextlib
+import json
+import threading
+import time
+
+import aiohttp
+import openai
+
+from ratelimit import estimate_tokens
+from retry import AUTH, classify
+from tokenizer import count_tokens
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = 60
+
+
+class OpenAIBackend:
+    """
+    Backend that sends requests to the OpenAI API.
+    """
+
+    def __init__(self, api_base=None):
+        """
+        Initialize the backend with no HTTP session.
+
+        Args:
+            api_base (str): The API base URL, such as a local mock server's;
+                None uses openai.api_base.
+        """
+        self.api_base = api_base
+        self.session = None
+        self.session_loop = None
+
+    def get_session(self):
+        """
+        Return an aiohttp session bound to the running event loop.
+
+        Returns:
+            aiohttp.ClientSession: The shared session for this loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session_loop is not loop:
+            self.session = aiohttp.ClientSession()
+            self.session_loop = loop
+        return self.session
+
+    async def send(self, endpoint, params, on_token=None):
+        """
+        Send one request to the OpenAI API.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            on_token (callable): Called with each token when streaming.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        # Reuse one connection pool instead of opening a session per request
+        openai.aiosession.set(self.get_session())
+        if self.api_base:
+            params = dict(params, api_base=self.api_base)
+        resource = openai.ChatCompletion if endpoint == "chat" else openai.Completion
+        start = time.monotonic()
+        if on_token is None:
+            response = await resource.acreate(**params)
+            choice = response.choices[0]
+            text = choice.message.content if endpoint == "chat" else choice.text
+            latency = time.monotonic() - start
+            return {"text": text.strip(), "usage": dict(response.get("usage") or {}),
+                    "ttft": latency, "latency": latency}
+
+        ttft = None
+        chunks = []
+        async for chunk in await resource.acreate(stream=True, **params):
+            choice = chunk.choices[0]
+            token = choice.delta.get("content", "") if endpoint == "chat" else choice.text
+            if not chunks:
+                # Match the non-streaming output, which strips leading whitespace
+                token = token.lstrip()
+                if not token:
+                    continue
+                ttft = time.monotonic() - start
+            chunks.append(token)
+            on_token(token)
+        return {"text": "".join(chunks).strip(), "usage": {},
+                "ttft": ttft, "latency": time.monotonic() - start}
+
+    async def send_batch(self, params):
+        """
+        Send a list of prompts as one completion request.
+
+        Args:
+            params (dict): Keyword arguments for the openai call, with a list prompt.
+
+        Returns:
+            tuple: One result per prompt, in order, and the usage of the whole batch.
+        """
+        openai.aiosession.set(self.get_session())
+        if self.api_base:
+            params = dict(params, api_base=self.api_base)
+        start = time.monotonic()
+        response = await openai.Completion.acreate(**params)
+        latency = time.monotonic() - start
+        texts = [""] * len(params["prompt"])
+        for choice in response.choices:
+            texts[choice.index] = choice.text.strip()
+        results = [{"text": text, "usage": {}, "ttft": latency, "latency": latency} for text in texts]
+        return results, dict(response.get("usage") or {})
+
+    async def close(self):
+        """
+        Close the HTTP session.
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class Flight:
+    """
+    A request in flight that identical requests can attach to.
+
+    The request runs in its own task, so a caller that is cancelled only
+    stops waiting; the request is cancelled once no caller is left. Tokens
+    already streamed are replayed to late joiners, and every caller gets
+    the same result or error.
+    """
+
+    def __init__(self, streamed=False):
+        """
+        Initialize the flight.
+
+        Args:
+            streamed (bool): Whether the request streams its tokens.
+        """
+        self.streamed = streamed
+        self.tokens = []
+        self.listeners = []
+        self.task = None
+        self.waiters = 0
+
+    def start(self, coro):
+        """
+        Start the request.
+
+        Args:
+            coro (coroutine): The coroutine that sends the request.
+        """
+        self.task = asyncio.ensure_future(coro)
+
+    def emit(self, token):
+        """
+        Pass a streamed token to every caller.
+
+        Args:
+            token (str): The token text.
+        """
+        self.tokens.append(token)
+        for listener in self.listeners:
+            listener(token)
+
+    async def join(self, on_token=None, leader=False):
+        """
+        Wait for the flight's result.
+
+        Args:
+            on_token (callable): Called with each token when streaming.
+            leader (bool): Whether this caller started the flight.
+
+        Returns:
+            dict: The shared response, marked as coalesced for followers.
+        """
+        self.waiters += 1
+        if on_token is not None:
+            for token in self.tokens:
+                on_token(token)
+            self.listeners.append(on_token)
+        try:
+            result = await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if not self.task.done():
+                self.leave(on_token)
+            raise
+        if on_token is not None and not self.streamed:
+            # The request was not streamed, so hand over the text in one piece
+            on_token(result["text"])
+        return result if leader else dict(result, coalesced=True)
+
+    def leave(self, on_token=None):
+        """
+        Stop waiting for the flight, cancelling it if nobody else waits.
+
+        Args:
+            on_token (callable): The leaving caller's token callback.
+        """
+        self.waiters -= 1
+        if on_token is not None:
+            self.listeners.remove(on_token)
+        if not self.waiters:
+            self.task.cancel()
+
+
+class AsyncClient:
+    """
+    Asyncio client that keeps many requests in flight at once.
+
+    Requests are capped by a semaphore and each one gets its own timeout. The
+    client owns an event loop on a background thread, so blocking code such as
+    the interactive menus can call run() while batch jobs submit many
+    coroutines at once.
+    """
+
+    def __init__(self, backend=None, max_concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT,
+                 cache=None, retry=None, limiter=None, keys=None, hedge=None, metrics=None, ledger=None):
+        """
+        Initialize the client.
+
+        Args:
+            backend (object): Object with an async send(endpoint, params, on_token) method.
+            max_concurrency (int): The maximum number of requests in flight.
+            timeout (float): The default per-request timeout in seconds.
+            cache (ResponseCache): Optional cache checked before each request.
+            retry (RetryPolicy): Optional policy for retrying failed requests.
+            limiter (RateLimiter): Optional limiter every attempt waits on.
+            keys (KeyPool): Optional pool of API keys to spread requests over.
+            hedge (HedgePolicy): Optional policy for duplicating slow requests.
+            metrics (Metrics): Optional registry every request is recorded in.
+            ledger (Ledger): Optional ledger every API call is charged to.
+        """
+        self.backend = backend or OpenAIBackend()
+        self.cache = cache
+        self.retry = retry
+        self.limiter = limiter
+        self.keys = keys
+        self.hedge = hedge
+        self.metrics = metrics
+        self.ledger = ledger
+        if keys is not None and ledger is not None:
+            keys.load_usage(ledger)
+        if metrics is not None:
+            metrics.attach(self)
+        self.inflight = {}
+        self.coalesced = 0
+        self.queued = 0
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.loop = None
+        self.semaphore = None
+        self.semaphore_loop = None
+
+    def get_semaphore(self):
+        """
+        Return the concurrency semaphore for the running event loop.
+
+        Returns:
+            asyncio.Semaphore: The semaphore capping requests in flight.
+        """
+        loop = asyncio.get_running_loop()
+        if self.semaphore is None or self.semaphore_loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.semaphore_loop = loop
+        return self.semaphore
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        Hold a concurrency slot, counting the wait as queued.
+        """
+        semaphore = self.get_semaphore()
+        self.queued += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.queued -= 1
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def set_concurrency(self, max_concurrency):
+        """
+        Change the concurrency cap for requests made from now on.
+
+        Args:
+            max_concurrency (int): The maximum number of requests in flight.
+        """
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+
+    async def request(self, endpoint, params, on_token=None, timeout=None):
+        """
+        Send a request once a concurrency slot is free, unless it is cached.
+
+        Identical requests made while one is already in flight attach to it
+        instead of being sent again. The outcome is recorded in the metrics
+        registry, if there is one.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+
+        Raises:
+            asyncio.TimeoutError: If the request takes longer than the timeout.
+            openai.error.OpenAIError: If the request fails and is not retried.
+        """
+        if self.metrics is None:
+            return await self.lookup(endpoint, params, on_token, timeout)
+        start = time.monotonic()
+        try:
+            result = await self.lookup(endpoint, params, on_token, timeout)
+        except Exception as e:
+            self.metrics.observe(endpoint, params, time.monotonic() - start, error=e)
+            raise
+        self.metrics.observe(endpoint, params, time.monotonic() - start, result)
+        return result
+
+    async def lookup(self, endpoint, params, on_token=None, timeout=None):
+        """
+        Serve a request from the cache or an identical one in flight, or send it.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        key = self.cache.make_key(endpoint, params) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                if on_token is not None:
+                    on_token(cached["text"])
+                return dict(cached, cached=True, ttft=0.0, latency=0.0)
+
+        flight_key = json.dumps([endpoint, params], sort_keys=True)
+        flight = self.inflight.get(flight_key)
+        if flight is not None:
+            self.coalesced += 1
+            return await flight.join(on_token)
+
+        flight = self.inflight[flight_key] = Flight(streamed=on_token is not None)
+        flight.start(self.fly(flight_key, flight, key, endpoint, params, timeout))
+        return await flight.join(on_token, leader=True)
+
+    async def fly(self, flight_key, flight, key, endpoint, params, timeout=None):
+        """
+        Send a coalesced request and cache its response.
+
+        Args:
+            flight_key (str): The request's key among requests in flight.
+            flight (Flight): The flight the request belongs to.
+            key (str): The cache key, or None if the response is not cached.
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        try:
+            result = await self.fetch(endpoint, params, flight.emit if flight.streamed else None, timeout)
+        finally:
+            del self.inflight[flight_key]
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    async def fetch(self, endpoint, params, on_token=None, timeout=None):
+        """
+        Send a request, retrying it if a retry policy is set.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        if self.retry is None:
+            return await self.hedged_send(endpoint, params, on_token, timeout)
+
+        # A stream that has started printing cannot be retried without repeating itself
+        streamed = []
+
+        def forward(token):
+            streamed.append(True)
+            on_token(token)
+
+        return await self.retry.call(
+            lambda: self.hedged_send(endpoint, params, forward if on_token else None, timeout),
+            can_retry=lambda: not streamed)
+
+    async def hedged_send(self, endpoint, params, on_token=None, timeout=None):
+        """
+        Make one attempt at a request, hedged if a hedge policy is set.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        if self.hedge is None:
+            return await self.send(endpoint, params, on_token, timeout)
+        model = params.get("engine") or params.get("model")
+        return await self.hedge.run(model, lambda forward: self.send(endpoint, params, forward, timeout),
+                                    on_token)
+
+    async def send(self, endpoint, params, on_token=None, timeout=None):
+        """
+        Make one attempt at a request once the rate limiter and a concurrency
+        slot allow it.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        engine = params.get("engine") or params.get("model")
+        prompt_tokens, charged = estimate_tokens(endpoint, params)
+        if self.limiter is None:
+            async with self.slot():
+                return await self.send_charged(endpoint, params, prompt_tokens, on_token, timeout)
+
+        await self.limiter.acquire(engine, charged)
+        try:
+            async with self.slot():
+                result = await self.send_charged(endpoint, params, prompt_tokens, on_token, timeout)
+        except BaseException:
+            self.limiter.reconcile(engine, charged, 0)
+            raise
+        usage = result["usage"]
+        used = usage.get("total_tokens") or usage.get("prompt_tokens", prompt_tokens) + usage["completion_tokens"]
+        self.limiter.reconcile(engine, charged, used)
+        return result
+
+    async def send_charged(self, endpoint, params, prompt_tokens, on_token=None, timeout=None):
+        """
+        Send a request and charge it to the ledger, if there is one.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            prompt_tokens (int): The local count of the prompt's tokens.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+
+        A call cancelled after it was sent, such as the losing copy of a
+        hedged request, is still billed, so it is recorded at its prompt
+        tokens plus the completion tokens streamed before it was cancelled.
+
+        Raises:
+            BudgetExceeded: If the call could take spending over a budget cap.
+        """
+        engine = params.get("engine") or params.get("model")
+        reserved = 0.0
+        if self.ledger is not None:
+            reserved = self.ledger.reserve(engine, prompt_tokens, params.get("max_tokens", 16))
+        attempt = {"sent": False, "key": None, "tokens": []}
+
+        def tap(token):
+            attempt["tokens"].append(token)
+            on_token(token)
+
+        try:
+            result = await self.send_with_key(endpoint, params, prompt_tokens, on_token and tap, timeout,
+                                              attempt)
+        except asyncio.CancelledError:
+            if self.ledger is not None:
+                if attempt["sent"]:
+                    self.ledger.record(engine, partial_usage(prompt_tokens, attempt["tokens"]),
+                                       key=attempt["key"], reserved=reserved)
+                else:
+                    self.ledger.release(reserved)
+            raise
+        except BaseException:
+            if self.ledger is not None:
+                self.ledger.release(reserved)
+            raise
+        if self.ledger is not None:
+            self.ledger.record(engine, result["usage"], key=result.get("key"), reserved=reserved)
+        return result
+
+    async def send_with_key(self, endpoint, params, prompt_tokens, on_token=None, timeout=None, attempt=None):
+        """
+        Send through the backend with a key from the pool, if there is one.
+
+        Responses without token counts get them here, so the key pool,
+        limiter, ledger and metrics all read the same counts from the result's
+        usage. A key that fails auth is quarantined by the pool and the request moves
+        on to the next key.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): Keyword arguments for the openai call.
+            prompt_tokens (int): The local count of the prompt's tokens.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+            attempt (dict): Optional record of whether the call was sent, the
+                key it used and the tokens streamed, for billing it if cancelled.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        attempt = {"sent": False, "key": None, "tokens": []} if attempt is None else attempt
+        if self.keys is None:
+            attempt["sent"] = True
+            result = await asyncio.wait_for(self.backend.send(endpoint, params, on_token),
+                                            timeout or self.timeout)
+            return fill_usage(result, prompt_tokens)
+        while True:
+            key = await self.keys.acquire()
+            keyed = dict(params, api_key=key.key)
+            if key.organization:
+                keyed["organization"] = key.organization
+            attempt["sent"] = True
+            attempt["key"] = key.name
+            try:
+                result = await asyncio.wait_for(self.backend.send(endpoint, keyed, on_token),
+                                                timeout or self.timeout)
+            except Exception as e:
+                self.keys.release(key, error=e)
+                if classify(e) == AUTH:
+                    continue
+                raise
+            except BaseException:
+                self.keys.release(key, usage=partial_usage(prompt_tokens, attempt["tokens"]))
+                raise
+            fill_usage(result, prompt_tokens)
+            self.keys.release(key, usage=result["usage"])
+            result["key"] = key.name
+            return result
+
+    async def complete(self, engine, prompt, max_tokens, temperature, on_token=None, timeout=None):
+        """
+        Request a text completion.
+
+        Args:
+            engine (str): The engine to query.
+            prompt (str): The prompt text.
+            max_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        params = {"engine": engine, "prompt": prompt,
+                  "max_tokens": max_tokens, "temperature": temperature}
+        return await self.request("completion", params, on_token, timeout)
+
+    async def chat_complete(self, model, messages, max_tokens, temperature, on_token=None, timeout=None):
+        """
+        Request a chat completion.
+
+        Args:
+            model (str): The model to query.
+            messages (list): The conversation messages.
+            max_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        params = {"model": model, "messages": messages,
+                  "max_tokens": max_tokens, "temperature": temperature}
+        return await self.request("chat", params, on_token, timeout)
+
+    async def gather(self, coros):
+        """
+        Run many requests concurrently.
+
+        Args:
+            coros (iterable): Request coroutines.
+
+        Returns:
+            list: Results in order, with exceptions in place of failed requests.
+        """
+        return await asyncio.gather(*coros, return_exceptions=True)
+
+    def get_loop(self):
+        """
+        Return the background event loop, starting it on first use.
+
+        Returns:
+            asyncio.AbstractEventLoop: The client's event loop.
+        """
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return self.loop
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the background loop without waiting for it.
+
+        Args:
+            coro (coroutine): The coroutine to run.
+
+        Returns:
+            concurrent.futures.Future: The future for the result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+
+    def run(self, coro):
+        """
+        Run a coroutine on the background loop and wait for its result.
+
+        Args:
+            coro (coroutine): The coroutine to run.
+
+        Returns:
+            object: The coroutine's result.
+        """
+        future = self.submit(coro)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+    def close(self):
+        """
+        Close the backend and stop the background loop.
+        """
+        if self.loop is not None:
+            if hasattr(self.backend, "close"):
+                self.run(self.backend.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+
+def fill_usage(result, prompt_tokens):
+    """
+    Count a response's tokens locally if it came without a usage block.
+
+    Args:
+        result (dict): The response, updated in place.
+        prompt_tokens (int): The local count of the prompt's tokens.
+
+    Returns:
+        dict: The response.
+    """
+    if not result["usage"].get("completion_tokens"):
+        # Streamed responses carry no usage block, so count locally
+        completion_tokens = count_tokens(result["text"])
+        result["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                           "total_tokens": prompt_tokens + completion_tokens}
+    return result
+
+
+def partial_usage(prompt_tokens, tokens):
+    """
+    Count the tokens of a call that was cancelled part way through.
+
+    Args:
+        prompt_tokens (int): The local count of the prompt's tokens.
+        tokens (list): The tokens streamed before it was cancelled.
+
+    Returns:
+        dict: The usage block.
+    """
+    completion_tokens = count_tokens("".join(tokens)) if tokens else 0
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
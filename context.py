@@ -0,0 +1,247 @@
+"""
+Token-budgeted context window for browseGPT chat
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: tokenizer
+Licence: Please cite if used.
+"""
+
+from tokenizer import count_tokens
+
+DEFAULT_BUDGET = 3000
+DEFAULT_COMPACT_EVERY = 6
+
+SUMMARY_PROMPT = ("Summarize the conversation below in a few sentences. Keep names, facts, "
+                  "decisions and open questions. If a summary so far is given, fold the new "
+                  "turns into it.")
+
+# Tokens the chat format adds around each message for the role and separators
+MESSAGE_OVERHEAD = 4
+
+
+def count_message(message):
+    """
+    Count the prompt tokens a chat message costs.
+
+    Args:
+        message (dict): The message, with "role" and "content".
+
+    Returns:
+        int: The number of tokens.
+    """
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+class ContextWindow:
+    """
+    Chat messages with cached token counts, windowed to fit a token budget.
+
+    The full conversation is kept, but window() returns only what fits: every
+    system message plus the most recent other turns. The newest message is
+    always included, even if it alone is over budget.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, messages=None):
+        """
+        Initialize the context window.
+
+        Args:
+            budget (int): The maximum number of prompt tokens to send.
+            messages (list): Messages to start with.
+        """
+        self.budget = budget
+        self.messages = []
+        self.counts = []
+        self.system_indices = []
+        self.system_tokens = 0
+        for message in messages or []:
+            self.append(message)
+
+    def append(self, message):
+        """
+        Add a message and cache its token count.
+
+        Args:
+            message (dict): The message, with "role" and "content".
+        """
+        count = count_message(message)
+        if message["role"] == "system":
+            self.system_indices.append(len(self.messages))
+            self.system_tokens += count
+        self.messages.append(message)
+        self.counts.append(count)
+
+    def add(self, role, content):
+        """
+        Add a message from its role and content.
+
+        Args:
+            role (str): "system", "user" or "assistant".
+            content (str): The message text.
+        """
+        self.append({"role": role, "content": content})
+
+    def total_tokens(self):
+        """
+        Return the token count of the whole conversation.
+
+        Returns:
+            int: The number of tokens.
+        """
+        return sum(self.counts)
+
+    def window(self, budget=None):
+        """
+        Return the messages to send for the next request.
+
+        Args:
+            budget (int): The token budget, defaults to the window's budget.
+
+        Returns:
+            list: System messages and the newest turns that fit, in order.
+        """
+        budget = self.budget if budget is None else budget
+        first = self.window_start(budget, self.system_tokens)
+        earlier = [self.messages[i] for i in self.system_indices if i < first]
+        return earlier + self.messages[first:]
+
+    def window_start(self, budget, used, lower=0):
+        """
+        Find where the window of recent turns starts.
+
+        Args:
+            budget (int): The token budget.
+            used (int): Tokens already taken by messages that are always sent.
+            lower (int): The earliest index the window may start at.
+
+        Returns:
+            int: The index of the oldest message in the window.
+        """
+        first = len(self.messages)
+        for i in range(len(self.messages) - 1, lower - 1, -1):
+            if self.messages[i]["role"] == "system":
+                continue
+            if used + self.counts[i] > budget and first < len(self.messages):
+                break
+            used += self.counts[i]
+            first = i
+        return first
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+
+def summary_messages(summary, messages):
+    """
+    Build the request that folds turns into a rolling summary.
+
+    Args:
+        summary (str): The summary so far, or None.
+        messages (list): The turns to fold in.
+
+    Returns:
+        list: Messages for a chat completion request.
+    """
+    turns = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    if summary:
+        turns = f"Summary so far: {summary}\n\n{turns}"
+    return [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": turns}]
+
+
+class SummarizingContext(ContextWindow):
+    """
+    Context window that folds turns falling out of the window into a summary.
+
+    Once compact_every turns have dropped out of the window, they are sent
+    to summarize() together with the summary so far. That call runs in the
+    background; its result is picked up on a later append or window() without
+    waiting, and the summary is sent as a system message ahead of the
+    remaining turns.
+    """
+
+    def __init__(self, summarize, budget=DEFAULT_BUDGET, compact_every=DEFAULT_COMPACT_EVERY, messages=None):
+        """
+        Initialize the summarizing context.
+
+        Args:
+            summarize (callable): Takes the summary so far and a list of turns and
+                returns a concurrent.futures.Future for the new summary text.
+            budget (int): The maximum number of prompt tokens to send.
+            compact_every (int): The number of turns folded in per summary call.
+            messages (list): Messages to start with.
+        """
+        self.summarize = summarize
+        self.compact_every = compact_every
+        self.summary = None
+        self.summary_tokens = 0
+        self.summarized = 0
+        self.pending = None
+        self.pending_end = 0
+        super().__init__(budget, messages)
+
+    def append(self, message):
+        """
+        Add a message and start a summary if enough turns have dropped out.
+
+        Args:
+            message (dict): The message, with "role" and "content".
+        """
+        super().append(message)
+        self.compact()
+
+    def summary_message(self):
+        """
+        Return the summary as a system message.
+
+        Returns:
+            dict: The summary message.
+        """
+        return {"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"}
+
+    def compact(self):
+        """
+        Collect a finished summary and start the next one if it is due.
+        """
+        if self.pending is not None:
+            if not self.pending.done():
+                return
+            try:
+                self.summary = self.pending.result()
+                self.summary_tokens = count_message(self.summary_message())
+                self.summarized = self.pending_end
+            except Exception:
+                # Keep the old summary; the same turns are retried next time
+                pass
+            self.pending = None
+
+        first = self.window_start(self.budget, self.system_tokens + self.summary_tokens, self.summarized)
+        dropped = [i for i in range(self.summarized, first) if self.messages[i]["role"] != "system"]
+        if len(dropped) >= self.compact_every:
+            batch = dropped[:self.compact_every]
+            self.pending_end = batch[-1] + 1
+            self.pending = self.summarize(self.summary, [self.messages[i] for i in batch])
+
+    def window(self, budget=None):
+        """
+        Return the summary and the newest turns that fit the budget.
+
+        Args:
+            budget (int): The token budget, defaults to the window's budget.
+
+        Returns:
+            list: System messages, the summary and the newest turns, in order.
+        """
+        self.compact()
+        budget = self.budget if budget is None else budget
+        if self.summary is None:
+            return super().window(budget)
+        first = self.window_start(budget, self.system_tokens + self.summary_tokens, self.summarized)
+        earlier = [self.messages[i] for i in self.system_indices if i < first]
+        return earlier + [self.summary_message()] + self.messages[first:]
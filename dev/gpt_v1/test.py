@@ -1,8 +1,18 @@
 import openai
 import os
+import sys
 import json
 from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from batch import BatchRunner
+from batcher import MicroBatcher
+from cache import ResponseCache
+from client import AsyncClient, OpenAIBackend
+from history import JournalHistory
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+
 # Obtain API key from environment variables
 API_KEY = os.getenv("OPENAI_API_KEY")
 
@@ -33,7 +43,7 @@ class ChatGPT:
 
     def __init__(self):
         """
-        Initializes the GPT-3 chat with API key, default settings, and an empty history.
+        Initializes the GPT-3 chat with API key, default settings, and a history journal.
         """
         openai.api_key = API_KEY
         self.settings = {
@@ -41,7 +51,10 @@ class ChatGPT:
             "max_tokens": DEFAULT_MAX_TOKENS,
             "temperature": DEFAULT_TEMPERATURE
         }
-        self.history = []
+        self.history = JournalHistory("history_journal.jsonl")
+        self.cache = ResponseCache()
+        self.client = AsyncClient(backend=MicroBatcher(OpenAIBackend()), max_concurrency=16, cache=self.cache,
+                                  retry=RetryPolicy(), limiter=RateLimiter())
 
     def prompt_user(self, message):
         """
@@ -65,26 +78,27 @@ class ChatGPT:
         Returns:
             str: The model's response.
         """
-        response = openai.Completion.create(
-            engine=self.settings["model"],
-            prompt=query,
-            max_tokens=self.settings["max_tokens"],
-            temperature=self.settings["temperature"]
-        )
-        print(response.choices[0].text.strip())
-        self.history.append({"query": query, "response": response.choices[0].text.strip()})
-        return response.choices[0].text.strip()
+        result = self.client.run(self.client.complete(self.settings["model"], query,
+                                                      self.settings["max_tokens"],
+                                                      self.settings["temperature"]))
+        print(result["text"])
+        self.history.append({"query": query, "response": result["text"]})
+        return result["text"]
 
     def query_from_file(self, filename):
         """
         Makes a query to the GPT-3 model from a JSON file and prints the model's response.
 
+        A .jsonl file is run as a batch, one query per line.
+
         Args:
             filename (str): The path to the JSON file.
 
         Returns:
             str: The model's response.
         """
+        if filename.endswith(".jsonl"):
+            return self.batch_from_file(filename)
         try:
             with open(filename, 'r') as f:
                 data = json.load(f)
@@ -93,6 +107,27 @@ class ChatGPT:
         except FileNotFoundError:
             print("File not found. Please try again.")
 
+    def batch_from_file(self, filename):
+        """
+        Runs every query in a JSONL file and writes the responses to a results file.
+
+        Args:
+            filename (str): The path to the JSONL file.
+
+        Returns:
+            str: The path to the results file.
+        """
+        output = filename[:-len(".jsonl")] + "_results.jsonl"
+        defaults = {"model": self.settings["model"], "max_tokens": self.settings["max_tokens"],
+                    "temperature": self.settings["temperature"]}
+        try:
+            self.client.run(BatchRunner(self.client, defaults, MODELS).run(filename, output))
+        except FileNotFoundError:
+            print("File not found. Please try again.")
+            return None
+        print(f"Results saved to {output}")
+        return output
+
     def update_settings(self):
         """
         Allows the user to update the model settings.
@@ -102,6 +137,9 @@ class ChatGPT:
         print("Current settings:")
         for key, value in self.settings.items():
             print(f"{key}: {value}")
+        stats = self.cache.stats()
+        print(f"cache: {stats['memory_hits'] + stats['disk_hits']} hits, {stats['misses']} misses, "
+              f"{stats['skipped']} skipped")
 
         model_choice = self.prompt_user(f"Select the model (Current options are {', '.join(MODELS.keys())}): ")
         if model_choice in MODELS.keys():
@@ -125,12 +163,12 @@ class ChatGPT:
 
     def save_history(self):
         """
-        Saves the history of queries and responses to a JSON file.
+        Saves the history of queries and responses to a JSONL file.
 
-        The file is saved as history.json in the current directory.
+        Every query is already journaled as it is made, so this copies the
+        journal to history.jsonl in the current directory.
         """
-        with open("history.json", 'w') as f:
-            json.dump(self.history, f)
+        self.history.export("history.jsonl")
         print("History saved.")
 
     def process_user_response(self, response):
@@ -1,8 +1,15 @@
 import openai
 import os
+import sys
 import json
 from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from client import AsyncClient
+from context import ContextWindow
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+
 API_KEY = os.getenv("OPENAI_API_KEY")
 
 MODELS = {
@@ -21,8 +28,9 @@ class ChatGPT:
         self.api_key = API_KEY
         openai.api_key = self.api_key
         self.model = MODELS["GPT-3"]
-        self.messages = [{"role": "system", "content": "You are talking to GPT-3"}]
+        self.messages = ContextWindow(messages=[{"role": "system", "content": "You are talking to GPT-3"}])
         self.history = []
+        self.client = AsyncClient(retry=RetryPolicy(), limiter=RateLimiter())
 
     def get_user_input(self, prompt):
         user_input = input(prompt).strip()
@@ -59,12 +67,9 @@ class ChatGPT:
 
     def chat(self, query):
         self.messages.append({"role": "user", "content": query})
-        response = openai.ChatCompletion.create(
-            model=self.model,
-            messages=self.messages,
-            max_tokens=100
-        )
-        return response['choices'][0]['message']['content']
+        result = self.client.run(self.client.chat_complete(self.model, self.messages.window(),
+                                                           max_tokens=100, temperature=1))
+        return result["text"]
 
 if __name__ == "__main__":
     print("Test GPT interface")
@@ -1,6 +1,12 @@
 import openai
 import json
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from client import AsyncClient
+from context import ContextWindow, SummarizingContext, summary_messages
+from ratelimit import RateLimiter
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -19,34 +25,51 @@ DEFAULT_SETTINGS = {
     "Model": "gpt-3.0-turbo",
     "Max tokens": 150,
     "Temperature": 0.5,
+    "Context budget": 3000,
+    "Summarize": True,
+    "Summarize every": 6,
 }
 
 class OpenAIGPTChat:
     def __init__(self):
-        self.messages = []
         self.settings = DEFAULT_SETTINGS.copy()
+        self.client = AsyncClient(limiter=RateLimiter())
+        if self.settings["Summarize"]:
+            self.messages = SummarizingContext(self.summarize, self.settings["Context budget"],
+                                               self.settings["Summarize every"])
+        else:
+            self.messages = ContextWindow(self.settings["Context budget"])
 
     def add_user_message(self, content):
-        self.messages.append({"role": "user", "content": content})
+        self.messages.add("user", content)
 
     def add_system_message(self, content):
-        self.messages.append({"role": "system", "content": content})
+        self.messages.add("system", content)
+
+    def add_assistant_message(self, content):
+        self.messages.add("assistant", content)
 
     def generate_response(self):
         model_name = self.settings['Model']
         model_value = MODELS[model_name]
-        response = openai.ChatCompletion.create(
-            model=model_value,
-            messages=self.messages,
-            max_tokens=self.settings["Max tokens"],
-            temperature=self.settings["Temperature"]
-        )
-        response_message = response['choices'][0]['message']['content']
-        self.add_system_message(response_message)
+        result = self.client.run(self.client.chat_complete(model_value, self.messages.window(),
+                                                           self.settings["Max tokens"],
+                                                           self.settings["Temperature"]))
+        response_message = result["text"]
+        self.add_assistant_message(response_message)
         return response_message
 
+    def summarize(self, summary, messages):
+        return self.client.submit(self.request_summary(summary, messages))
+
+    async def request_summary(self, summary, messages):
+        model_value = MODELS[self.settings['Model']]
+        result = await self.client.chat_complete(model_value, summary_messages(summary, messages),
+                                                 self.settings["Max tokens"], 0)
+        return result["text"]
+
     def get_conversation(self):
-        return self.messages
+        return self.messages.messages
 
 #Example usage
 if __name__ == "__main__":
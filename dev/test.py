@@ -1,10 +1,17 @@
 import openai
 import os
+import sys
 import json
+import asyncio
 from datetime import datetime
 from prompt_toolkit import PromptSession
 from prompt_toolkit.completion import WordCompleter
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from client import AsyncClient
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODELS = {
     "GPT-1": "text-gpt-1-en-12b",
@@ -47,6 +54,7 @@ class ChatGPT:
         self.settings = DEFAULT_SETTINGS.copy()
         self.history = []
         self.session = PromptSession()
+        self.client = AsyncClient(retry=RetryPolicy(), limiter=RateLimiter())
 
     def prompt_user(self, message):
         """
@@ -97,15 +105,14 @@ class ChatGPT:
             prompt = f"{role}: {query}"
             query_settings = self.settings["Query Settings"]
             try:
-                response = openai.Completion.create(
-                    engine=model_value,
-                    prompt=prompt,
-                    max_tokens=query_settings["Max Tokens"],
-                    temperature=query_settings["Temperature"]
-                )
-                response_text = response.choices[0].text.strip()
+                result = self.client.run(self.client.complete(model_value, prompt,
+                                                              query_settings["Max Tokens"],
+                                                              query_settings["Temperature"]))
+                response_text = result["text"]
                 self.history.append({"query": query, "response": response_text, "copilot_response": response_text if copilot else ""})
                 print(f"\n{response_text}")
+            except asyncio.TimeoutError:
+                print("\nRequest timed out. Please try again.")
             except openai.error.APIError as e:
                 print(f"\nOpenAI API Error: {e}")
                 self.api_key = ""
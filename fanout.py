@@ -0,0 +1,148 @@
+"""
+Multi-model fan-out for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: asyncio, time
+Licence: Please cite if used.
+"""
+
+import asyncio
+import time
+
+RACE = "race"
+COMPARE = "compare"
+
+
+def acceptable(result):
+    """
+    Default test for a race winner: any non-empty answer.
+
+    Args:
+        result (dict): A response.
+
+    Returns:
+        bool: True if the answer has text.
+    """
+    return bool(result["text"].strip())
+
+
+class FanOut:
+    """
+    Send one prompt to several engines at once.
+
+    In race mode the first acceptable answer wins and the other requests are
+    cancelled. In compare mode every answer is collected. Either way the
+    latency of each engine is reported so it can be kept in the history.
+    """
+
+    def __init__(self, client, accept=acceptable):
+        """
+        Initialize the fan-out.
+
+        Args:
+            client (AsyncClient): The client that sends the requests.
+            accept (callable): Takes a response and returns True if it can win a race.
+        """
+        self.client = client
+        self.accept = accept
+
+    async def timed(self, engine, prompt, max_tokens, temperature, timeout=None):
+        """
+        Request a completion from one engine and time it.
+
+        Args:
+            engine (str): The engine to query.
+            prompt (str): The prompt text.
+            max_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The engine, its response or error, and the seconds it took.
+        """
+        start = time.monotonic()
+        try:
+            result = await self.client.complete(engine, prompt, max_tokens, temperature, timeout=timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return {"model": engine, "text": None, "error": f"{type(e).__name__}: {e}",
+                    "latency": time.monotonic() - start}
+        return {"model": engine, "text": result["text"], "error": None, "usage": result["usage"],
+                "ttft": result["ttft"], "latency": time.monotonic() - start}
+
+    async def compare(self, engines, prompt, max_tokens, temperature, timeout=None):
+        """
+        Collect every engine's answer side by side.
+
+        Args:
+            engines (list): The engines to query.
+            prompt (str): The prompt text.
+            max_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            list: One answer per engine, in the order given.
+        """
+        return await asyncio.gather(*[self.timed(engine, prompt, max_tokens, temperature, timeout)
+                                      for engine in engines])
+
+    async def race(self, engines, prompt, max_tokens, temperature, timeout=None):
+        """
+        Return the first acceptable answer and cancel the rest.
+
+        Args:
+            engines (list): The engines to query.
+            prompt (str): The prompt text.
+            max_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            dict: The first acceptable answer or, if none was, the last one without
+                an error (or the last error), with every engine's latency under "latencies" (None if cancelled).
+        """
+        tasks = {asyncio.ensure_future(self.timed(engine, prompt, max_tokens, temperature, timeout)): engine
+                 for engine in engines}
+        latencies = dict.fromkeys(engines)
+        pending = set(tasks)
+        winner = None
+        fallback = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Several engines can finish in the same round; any acceptable one beats the rest
+                for task in done:
+                    result = task.result()
+                    latencies[result["model"]] = result["latency"]
+                    if winner is None and result["error"] is None and self.accept(result):
+                        winner = result
+                    elif fallback is None or (fallback["error"] is None) <= (result["error"] is None):
+                        fallback = result
+        finally:
+            for task in pending:
+                task.cancel()
+        return dict(winner or fallback, latencies=latencies)
+
+    async def run(self, mode, engines, prompt, max_tokens, temperature, timeout=None):
+        """
+        Fan a prompt out in race or compare mode.
+
+        Args:
+            mode (str): "race" or "compare".
+            engines (list): The engines to query.
+            prompt (str): The prompt text.
+            max_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+
+        Returns:
+            list: The answers; a race returns only the winner.
+        """
+        if mode == RACE:
+            return [await self.race(engines, prompt, max_tokens, temperature, timeout)]
+        if mode == COMPARE:
+            return await self.compare(engines, prompt, max_tokens, temperature, timeout)
+        raise ValueError(f"Unknown fan-out mode: {mode}")
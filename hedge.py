@@ -0,0 +1,258 @@
+"""
+Hedged requests for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: asyncio, time, collections.deque, ledger, tokenizer
+Licence: Please cite if used.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+from ledger import price
+from tokenizer import count_tokens
+
+DEFAULT_PERCENTILE = 0.95
+DEFAULT_MAX_HEDGE_RATIO = 0.1
+DEFAULT_WINDOW = 500
+MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """
+    Recent time-to-first-token samples per model.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        """
+        Initialize the tracker.
+
+        Args:
+            window (int): The number of recent samples kept per model.
+        """
+        self.window = window
+        self.samples = {}
+
+    def record(self, model, seconds):
+        """
+        Add a sample.
+
+        Args:
+            model (str): The model name.
+            seconds (float): The time to first token.
+        """
+        if seconds is not None:
+            self.samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model, q):
+        """
+        Return a percentile of the recent samples.
+
+        Args:
+            model (str): The model name.
+            q (float): The percentile, between 0 and 1.
+
+        Returns:
+            float: The value, or None until there are enough samples.
+        """
+        samples = self.samples.get(model)
+        if not samples or len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def tail_mean(self, model, above):
+        """
+        Return the mean of the samples slower than a threshold.
+
+        Args:
+            model (str): The model name.
+            above (float): The threshold in seconds.
+
+        Returns:
+            float: The mean, or None if no sample is that slow.
+        """
+        slow = [s for s in self.samples.get(model, ()) if s > above]
+        return sum(slow) / len(slow) if slow else None
+
+
+class HedgePolicy:
+    """
+    Send a duplicate request when the first one is slow to respond.
+
+    If a request has no first token by the model's observed p95, a second copy
+    is sent; whichever produces a first token (or, without streaming, a
+    response) first is kept and the other is cancelled. Hedges per model are
+    capped at max_hedge_ratio of its requests, and all hedging stops once the
+    cancelled copies have cost max_hedge_cost dollars.
+
+    A cancelled copy is still billed for its prompt and whatever it streamed
+    before it was cancelled; those tokens and their cost are counted per model.
+    """
+
+    def __init__(self, percentile=DEFAULT_PERCENTILE, max_hedge_ratio=DEFAULT_MAX_HEDGE_RATIO,
+                 window=DEFAULT_WINDOW, max_hedge_cost=None, prices=None):
+        """
+        Initialize the hedge policy.
+
+        Args:
+            percentile (float): The latency percentile that triggers a hedge.
+            max_hedge_ratio (float): The most hedges per request, per model.
+            window (int): The number of recent samples kept per model.
+            max_hedge_cost (float): The most dollars cancelled copies may cost, or None for no cap.
+            prices (dict): Engines mapped to (prompt, completion) dollars per 1,000 tokens.
+        """
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.max_hedge_cost = max_hedge_cost
+        self.prices = prices
+        self.tracker = LatencyTracker(window)
+        self.counters = {}
+        self.wasted_cost = 0.0
+
+    def get_counters(self, model):
+        """
+        Return the counters for a model.
+
+        Args:
+            model (str): The model name.
+
+        Returns:
+            dict: Requests, hedges, hedge wins, estimated seconds saved, and the
+                tokens and dollars spent on cancelled copies.
+        """
+        return self.counters.setdefault(model, {"requests": 0, "hedges": 0, "wins": 0, "saved": 0.0,
+                                                "wasted_tokens": 0, "wasted_cost": 0.0})
+
+    def over_budget(self):
+        """
+        Check whether cancelled copies have used up the hedge spend cap.
+
+        Returns:
+            bool: True if there is a cap and it has been reached.
+        """
+        return self.max_hedge_cost is not None and self.wasted_cost >= self.max_hedge_cost
+
+    def charge(self, model, prompt_tokens, tokens):
+        """
+        Count what a cancelled copy of a request cost.
+
+        Args:
+            model (str): The model name.
+            prompt_tokens (int): The request's prompt tokens.
+            tokens (list): The tokens the copy streamed before it was cancelled.
+        """
+        completion_tokens = count_tokens("".join(tokens)) if tokens else 0
+        cost = price(model, prompt_tokens, completion_tokens, self.prices)
+        cost = 0.0 if cost == float("inf") else cost
+        counters = self.get_counters(model)
+        counters["wasted_tokens"] += prompt_tokens + completion_tokens
+        counters["wasted_cost"] += cost
+        self.wasted_cost += cost
+
+    def stats(self):
+        """
+        Return the hedge rate, latency saved and hedge spend per model.
+
+        Returns:
+            dict: Models mapped to their counters and hedge rate.
+        """
+        stats = {}
+        for model, counters in self.counters.items():
+            stats[model] = dict(counters, hedge_rate=counters["hedges"] / counters["requests"]
+                                if counters["requests"] else 0.0)
+        return stats
+
+    async def run(self, model, attempt, on_token=None):
+        """
+        Run a request, hedging it if it is slow.
+
+        Args:
+            model (str): The model name.
+            attempt (callable): Takes an on_token callback (or None) and returns
+                a new request coroutine.
+            on_token (callable): Called with each token of the winning stream.
+
+        Returns:
+            dict: The winning response.
+        """
+        counters = self.get_counters(model)
+        counters["requests"] += 1
+        delay = self.tracker.percentile(model, self.percentile)
+        if delay is None or counters["hedges"] >= self.max_hedge_ratio * counters["requests"] \
+                or self.over_budget():
+            result = await attempt(on_token)
+            self.tracker.record(model, result["ttft"])
+            return result
+
+        start = time.monotonic()
+        winner = []
+        streamed = ([], [])
+        first_token = asyncio.Event()
+
+        def forwarder(index):
+            if on_token is None:
+                return None
+
+            def forward(token):
+                streamed[index].append(token)
+                if not winner:
+                    winner.append(index)
+                    first_token.set()
+                if winner[0] == index:
+                    on_token(token)
+            return forward
+
+        tasks = [asyncio.ensure_future(attempt(forwarder(0)))]
+        signal = asyncio.ensure_future(first_token.wait())
+        try:
+            done, _ = await asyncio.wait([tasks[0], signal], timeout=delay,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                counters["hedges"] += 1
+                tasks.append(asyncio.ensure_future(attempt(forwarder(1))))
+            result, index = await self.first_result(tasks, signal, winner)
+        finally:
+            signal.cancel()
+            cancelled = [i for i, task in enumerate(tasks) if task.cancel()]
+
+        if len(tasks) > 1 and 1 - index in cancelled:
+            self.charge(model, result["usage"].get("prompt_tokens", 0), streamed[1 - index])
+
+        if index == 1:
+            counters["wins"] += 1
+            # Estimate what the primary would have taken from the slow tail it was in
+            elapsed = time.monotonic() - start
+            expected = self.tracker.tail_mean(model, elapsed)
+            if expected is not None:
+                counters["saved"] += expected - elapsed
+        self.tracker.record(model, result["ttft"] if index == 0 else time.monotonic() - start)
+        return result
+
+    async def first_result(self, tasks, signal, winner):
+        """
+        Wait for the first attempt to stream a token or return successfully.
+
+        Args:
+            tasks (list): The running attempts.
+            signal (asyncio.Future): Completes when a stream picks a winner.
+            winner (list): Holds the index of the winning stream once chosen.
+
+        Returns:
+            tuple: The winning result and the index of its attempt.
+        """
+        pending = set(tasks)
+        error = None
+        while pending:
+            waiters = pending | ({signal} if not signal.done() else set())
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            if winner:
+                return await tasks[winner[0]], winner[0]
+            for task in done & pending:
+                pending.discard(task)
+                if task.exception() is None:
+                    return task.result(), tasks.index(task)
+                error = task.exception()
+        raise error
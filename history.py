@@ -0,0 +1,387 @@
+"""
+Chat history backends for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: argparse, json, os, shutil, sqlite3, time
+Licence: Please cite if used.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+DEFAULT_JOURNAL_PATH = "gpt_chat_history.jsonl"
+DEFAULT_SQLITE_PATH = "gpt_chat_history.sqlite3"
+SYNC_EVERY = 32
+SYNC_INTERVAL = 1.0
+SEARCH_LIMIT = 20
+
+
+def matches(record, text):
+    """
+    Check whether every word of the search text appears in a record.
+
+    Args:
+        record (dict): The query and response record.
+        text (str): The search text.
+
+    Returns:
+        bool: True if the query or response contains every word.
+    """
+    haystack = f"{record.get('query', '')} {record.get('response', '')}".lower()
+    return all(word in haystack for word in text.lower().split())
+
+
+def scan_search(records, text, limit=SEARCH_LIMIT):
+    """
+    Search records one by one, newest first.
+
+    Args:
+        records (iterable): The history records in the order they were made.
+        text (str): The search text.
+        limit (int): The maximum number of results.
+
+    Returns:
+        list: The matching records.
+    """
+    found = [record for record in records if matches(record, text)]
+    return found[::-1][:limit]
+
+
+class MemoryHistory(list):
+    """
+    Chat history kept as a list in memory and written out on export.
+    """
+
+    extension = ".json"
+
+    def export(self, filename):
+        """
+        Write the whole history to a JSON file.
+
+        Args:
+            filename (str): The export file.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self, f)
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        """
+        Search past queries and responses.
+
+        Args:
+            text (str): The search text.
+            limit (int): The maximum number of results.
+
+        Returns:
+            list: The matching records, newest first.
+        """
+        return scan_search(self, text, limit)
+
+    def close(self):
+        """
+        Nothing to release for an in-memory history.
+        """
+
+
+class JournalHistory:
+    """
+    Chat history appended to a JSONL journal as each record is produced.
+
+    Records are flushed on every append and fsynced in batches, so memory
+    stays constant however long the session runs and export is a file copy.
+    """
+
+    extension = ".jsonl"
+
+    def __init__(self, path=DEFAULT_JOURNAL_PATH, sync_every=SYNC_EVERY, sync_interval=SYNC_INTERVAL):
+        """
+        Open the journal, creating it if needed.
+
+        Args:
+            path (str): The journal file.
+            sync_every (int): Records between fsyncs.
+            sync_interval (float): Seconds between fsyncs.
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        # Counted on the first len(), so opening the journal does not read it
+        self.count = None
+        self.file = open(path, 'a')
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def append(self, record):
+        """
+        Append one record to the journal.
+
+        Args:
+            record (dict): The query and response record.
+        """
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if self.count is not None:
+            self.count += 1
+        self.pending += 1
+        if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush the journal to disk.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def __len__(self):
+        if self.count is None:
+            self.file.flush()
+            with open(self.path, 'r') as f:
+                self.count = sum(1 for line in f if line.strip())
+        return self.count
+
+    def __iter__(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def export(self, filename):
+        """
+        Copy the journal to an export file.
+
+        Args:
+            filename (str): The export file.
+        """
+        self.sync()
+        shutil.copyfile(self.path, filename)
+
+    def rotate(self, filename):
+        """
+        Move the journal to an export file and start a new one.
+
+        Args:
+            filename (str): The export file.
+        """
+        self.sync()
+        self.file.close()
+        os.replace(self.path, filename)
+        self.file = open(self.path, 'a')
+        self.count = 0
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        """
+        Search past queries and responses by scanning the journal.
+
+        Args:
+            text (str): The search text.
+            limit (int): The maximum number of results.
+
+        Returns:
+            list: The matching records, newest first.
+        """
+        self.file.flush()
+        return scan_search(self, text, limit)
+
+    def close(self):
+        """
+        Sync and close the journal.
+        """
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+class SQLiteHistory:
+    """
+    Chat history stored in SQLite with a full-text index.
+
+    Turns are indexed on timestamp, model and the copilot flag, and an FTS5
+    table over the query and response text makes search fast on very large
+    histories. Commits are batched like the journal's fsyncs.
+    """
+
+    extension = ".jsonl"
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH, sync_every=SYNC_EVERY, sync_interval=SYNC_INTERVAL):
+        """
+        Open the database, creating the tables if needed.
+
+        Args:
+            path (str): The SQLite file.
+            sync_every (int): Records between commits.
+            sync_interval (float): Seconds between commits.
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY,
+                timestamp TEXT,
+                model TEXT,
+                copilot INTEGER NOT NULL DEFAULT 0,
+                query TEXT,
+                response TEXT,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_timestamp ON turns (timestamp);
+            CREATE INDEX IF NOT EXISTS turns_model ON turns (model);
+            CREATE INDEX IF NOT EXISTS turns_copilot ON turns (copilot);
+            CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(
+                query, response, content='turns', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS turns_fts_insert AFTER INSERT ON turns BEGIN
+                INSERT INTO turns_fts (rowid, query, response)
+                VALUES (new.id, new.query, new.response);
+            END;
+            CREATE TRIGGER IF NOT EXISTS turns_fts_delete AFTER DELETE ON turns BEGIN
+                INSERT INTO turns_fts (turns_fts, rowid, query, response)
+                VALUES ('delete', old.id, old.query, old.response);
+            END;
+        """)
+        self.db.commit()
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def append(self, record):
+        """
+        Insert one record.
+
+        Args:
+            record (dict): The query and response record.
+        """
+        copilot = bool(record.get("copilot", record.get("copilot_response")))
+        self.db.execute("INSERT INTO turns (timestamp, model, copilot, query, response, record) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (record.get("timestamp"), record.get("model"), int(copilot),
+                         record.get("query"), record.get("response"), json.dumps(record)))
+        self.pending += 1
+        if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """
+        Commit pending records.
+        """
+        self.db.commit()
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM turns").fetchone()[0]
+
+    def __iter__(self):
+        for (record,) in self.db.execute("SELECT record FROM turns ORDER BY id"):
+            yield json.loads(record)
+
+    def search(self, text, limit=SEARCH_LIMIT, model=None, copilot=None):
+        """
+        Full-text search over past queries and responses.
+
+        Each word is matched as a literal term, so punctuation in the search
+        text is not read as FTS5 query syntax.
+
+        Args:
+            text (str): The search text.
+            limit (int): The maximum number of results.
+            model (str): Only return turns with this model.
+            copilot (bool): Only return copilot (True) or chat (False) turns.
+
+        Returns:
+            list: The matching records, best match first.
+        """
+        self.sync()
+        terms = " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+        if not terms:
+            return []
+        sql = ("SELECT turns.record FROM turns_fts JOIN turns ON turns.id = turns_fts.rowid "
+               "WHERE turns_fts MATCH ?")
+        args = [terms]
+        if model is not None:
+            sql += " AND turns.model = ?"
+            args.append(model)
+        if copilot is not None:
+            sql += " AND turns.copilot = ?"
+            args.append(int(copilot))
+        sql += " ORDER BY bm25(turns_fts) LIMIT ?"
+        args.append(limit)
+        return [json.loads(record) for (record,) in self.db.execute(sql, args)]
+
+    def export(self, filename):
+        """
+        Write every record to a JSONL file.
+
+        Args:
+            filename (str): The export file.
+        """
+        with open(filename, 'w') as f:
+            for record in self:
+                f.write(json.dumps(record) + "\n")
+
+    def close(self):
+        """
+        Commit and close the database.
+        """
+        if self.db is not None:
+            self.sync()
+            self.db.close()
+            self.db = None
+
+
+def open_history(backend, path=None):
+    """
+    Open a chat history backend.
+
+    Args:
+        backend (str): "memory", "journal" or "sqlite".
+        path (str): The file used by backends that store to disk.
+
+    Returns:
+        object: The history, which supports append(), len(), iteration and export().
+    """
+    if backend == "memory":
+        return MemoryHistory()
+    if backend == "journal":
+        return JournalHistory(path or DEFAULT_JOURNAL_PATH)
+    if backend == "sqlite":
+        return SQLiteHistory(path or DEFAULT_SQLITE_PATH)
+    raise ValueError(f"Unknown history backend: {backend}")
+
+
+def print_results(results):
+    """
+    Print search results, one turn per block.
+
+    Args:
+        results (list): The matching records.
+    """
+    if not results:
+        print("No matching conversations.")
+    for record in results:
+        print(f"\n[{record.get('timestamp', '')}] {record.get('model', '')}")
+        print(f"Q: {record.get('query', '')}")
+        print(f"A: {record.get('response', '')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search browseGPT chat history.")
+    parser.add_argument("text", help="words to search for")
+    parser.add_argument("--db", default=DEFAULT_SQLITE_PATH, help="SQLite history file")
+    parser.add_argument("--limit", type=int, default=SEARCH_LIMIT, help="maximum number of results")
+    parser.add_argument("--model", help="only search turns with this model")
+    args = parser.parse_args()
+
+    history = SQLiteHistory(args.db)
+    print_results(history.search(args.text, limit=args.limit, model=args.model))
+    history.close()
@@ -0,0 +1,259 @@
+"""
+API key pool for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, asyncio, os, time, datetime.date, retry
+Licence: Please cite if used.
+"""
+
+import asyncio
+import os
+import time
+from datetime import date
+
+import openai
+
+from retry import AUTH, RATE_LIMITED, classify, retry_after
+
+QUARANTINE_SECONDS = 30
+AUTH_QUARANTINE_SECONDS = 600
+ERROR_RATE_THRESHOLD = 0.5
+ERROR_RATE_WEIGHT = 0.1
+MIN_REQUESTS = 10
+
+
+class NoKeyAvailable(openai.error.AuthenticationError):
+    """
+    Raised when every key in the pool has failed auth or is over quota.
+    """
+
+
+class APIKey:
+    """
+    One API key with its organization, load and health.
+    """
+
+    def __init__(self, key, organization=None, quota=None):
+        """
+        Initialize the key.
+
+        Args:
+            key (str): The API key.
+            organization (str): The organization ID, if any.
+            quota (int): The most tokens this key may use per day, or None for no cap.
+        """
+        self.key = key
+        self.organization = organization
+        self.quota = quota
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.tokens = 0
+        self.day = date.today().isoformat()
+        self.error_rate = 0.0
+        self.quarantined_until = 0.0
+        self.auth_failed = False
+
+    @property
+    def name(self):
+        """
+        Return a masked name that is safe to print or log.
+
+        Returns:
+            str: The last four characters of the key.
+        """
+        return f"...{self.key[-4:]}"
+
+    def roll_over(self):
+        """
+        Start a new quota period if the day has changed.
+        """
+        today = date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.tokens = 0
+
+    def under_quota(self):
+        """
+        Check whether the key has tokens left in today's quota.
+
+        Returns:
+            bool: True if the key has no quota or is under it.
+        """
+        self.roll_over()
+        return self.quota is None or self.tokens < self.quota
+
+    def usable(self, now):
+        """
+        Check whether the key can take a request.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            bool: True if the key is not quarantined or over quota.
+        """
+        return now >= self.quarantined_until and self.under_quota()
+
+
+class KeyPool:
+    """
+    Pool of API keys that spreads requests by least outstanding requests.
+
+    Each key's error rate and token use are tracked. A key that fails auth,
+    is rate limited, or whose error rate climbs too high is quarantined for a
+    while and the others carry on.
+    """
+
+    def __init__(self, keys=None):
+        """
+        Initialize the pool.
+
+        Args:
+            keys (list): APIKey objects.
+        """
+        self.keys = list(keys or [])
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a pool from the environment.
+
+        OPENAI_API_KEYS holds comma-separated "key", "key:organization" or
+        "key:organization:quota" entries, where quota is the most tokens the
+        key may use per day and the organization may be left empty
+        ("key::50000"). OPENAI_API_KEY is used when it is not set.
+
+        Quotas reset at local midnight. Usage is counted in memory, so call
+        load_usage() with the ledger to carry it over from earlier runs.
+
+        Returns:
+            KeyPool: The pool.
+
+        Raises:
+            ValueError: If a quota is not a whole number of tokens.
+        """
+        pool = cls()
+        entries = os.getenv("OPENAI_API_KEYS") or os.getenv("OPENAI_API_KEY") or ""
+        for entry in entries.split(","):
+            key, _, rest = entry.strip().partition(":")
+            organization, _, quota = rest.partition(":")
+            if not key:
+                continue
+            if quota and not quota.strip().isdigit():
+                raise ValueError(f"Quota for key ...{key[-4:]} must be a number of tokens, not {quota!r}")
+            pool.add(key, organization or None, int(quota) if quota else None)
+        return pool
+
+    def add(self, key, organization=None, quota=None):
+        """
+        Add a key to the pool.
+
+        Args:
+            key (str): The API key.
+            organization (str): The organization ID, if any.
+            quota (int): The most tokens this key may use per day, or None for no cap.
+        """
+        self.keys.append(APIKey(key, organization, quota))
+
+    def load_usage(self, ledger):
+        """
+        Count the tokens each key has already used today, from the ledger.
+
+        Keys are matched by their masked name, as the ledger records them.
+
+        Args:
+            ledger (Ledger): The ledger calls are charged to.
+        """
+        today = date.today().isoformat()
+        for key in self.keys:
+            key.day = today
+            key.tokens = ledger.tokens("key_day", f"{today} {key.name}")
+
+    def usable(self):
+        """
+        Return the keys that can take a request now.
+
+        Returns:
+            list: The usable keys.
+        """
+        now = time.monotonic()
+        return [key for key in self.keys if key.usable(now)]
+
+    def available(self):
+        """
+        Return the keys that have not failed auth and are under quota.
+
+        Returns:
+            list: Keys that can serve requests now or after a quarantine.
+        """
+        return [key for key in self.keys if not key.auth_failed and key.under_quota()]
+
+    async def acquire(self):
+        """
+        Pick the usable key with the fewest requests in flight.
+
+        If every key is quarantined for errors or rate limits, wait for the
+        first one to come back.
+
+        Returns:
+            APIKey: The key, already counted as outstanding.
+
+        Raises:
+            NoKeyAvailable: If every key has failed auth or is over quota.
+        """
+        while True:
+            usable = self.usable()
+            if usable:
+                key = min(usable, key=lambda k: (k.outstanding, k.requests))
+                key.outstanding += 1
+                key.requests += 1
+                return key
+            waits = [key.quarantined_until for key in self.available()]
+            if not waits:
+                raise NoKeyAvailable("No usable API key: every key failed auth or is over quota.")
+            await asyncio.sleep(max(0.0, min(waits) - time.monotonic()))
+
+    def release(self, key, usage=None, error=None):
+        """
+        Record the outcome of a request made with a key.
+
+        Args:
+            key (APIKey): The key returned by acquire().
+            usage (dict): The usage block of a successful response.
+            error (Exception): The error of a failed request.
+        """
+        key.outstanding -= 1
+        key.error_rate += ERROR_RATE_WEIGHT * ((error is not None) - key.error_rate)
+        if usage:
+            key.roll_over()
+            key.tokens += usage.get("total_tokens", 0)
+        if error is None:
+            key.auth_failed = False
+            return
+
+        key.errors += 1
+        kind = classify(error)
+        now = time.monotonic()
+        if kind == AUTH:
+            key.auth_failed = True
+            key.quarantined_until = now + AUTH_QUARANTINE_SECONDS
+        elif kind == RATE_LIMITED:
+            key.quarantined_until = now + (retry_after(error) or QUARANTINE_SECONDS)
+        elif key.requests >= MIN_REQUESTS and key.error_rate > ERROR_RATE_THRESHOLD:
+            key.quarantined_until = now + QUARANTINE_SECONDS
+            key.error_rate = 0.0
+
+    def stats(self):
+        """
+        Return per-key load and health.
+
+        Returns:
+            list: One dict per key, with the key masked.
+        """
+        now = time.monotonic()
+        return [{"key": key.name, "organization": key.organization, "outstanding": key.outstanding,
+                 "requests": key.requests, "errors": key.errors, "error_rate": key.error_rate,
+                 "tokens": key.tokens, "quota": key.quota,
+                 "quarantined": max(0.0, key.quarantined_until - now)} for key in self.keys]
@@ -0,0 +1,360 @@
+"""
+Token and cost ledger for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: json, os, sqlite3, threading, datetime.datetime
+Licence: Please cite if used.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+DEFAULT_LEDGER_PATH = "gpt_ledger.jsonl"
+DIMENSIONS = ("session", "model", "key", "day", "key_day")
+ROLLUPS_VERSION = 1
+REPLAY_CHUNK = 10000
+
+# US dollars per 1,000 prompt tokens and per 1,000 completion tokens for each engine in MODELS
+PRICES = {
+    "text-gpt-1-en-12b": (0.0004, 0.0004),
+    "text-gpt-2-en-117b": (0.0005, 0.0005),
+    "text-davinci-002": (0.02, 0.02),
+    "text-davinci-003": (0.02, 0.02),
+    "text-davinci-004": (0.03, 0.06),
+    "text-jurassic-1-jumbo-en-175b": (0.015, 0.015),
+    "text-megatron-turing-nlg-345m-355b": (0.03, 0.03),
+    "text-wudao-2-0-en-1.76T": (0.03, 0.03)
+}
+
+
+def price(engine, prompt_tokens, completion_tokens, prices=None):
+    """
+    Price a request.
+
+    Args:
+        engine (str): The engine name.
+        prompt_tokens (int): The prompt tokens.
+        completion_tokens (int): The completion tokens.
+        prices (dict): Engines mapped to (prompt, completion) dollars per 1,000 tokens.
+
+    Returns:
+        float: The cost in dollars, or infinity for an engine with no price.
+    """
+    rates = (PRICES if prices is None else prices).get(engine)
+    if rates is None:
+        return float("inf")
+    return (prompt_tokens * rates[0] + completion_tokens * rates[1]) / 1000
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a request would take spending over a budget cap.
+    """
+
+
+class Ledger:
+    """
+    Running record of the tokens and cost of every API call.
+
+    Each call is appended to a JSONL file and added to rollups per session,
+    model, key, day and key per day. The rollups are kept in a SQLite file next to the
+    ledger, along with how much of the ledger they cover, so opening the
+    ledger replays only entries written since. Several processes may share
+    one ledger: each write and the replay of entries other processes added
+    happen in one SQLite write transaction, so no entry is counted twice or
+    skipped. Budget caps per session and
+    per day are checked before each call, counting the worst case of calls
+    still in flight.
+    """
+
+    def __init__(self, path=DEFAULT_LEDGER_PATH, prices=None, session_budget=None, daily_budget=None,
+                 session=None):
+        """
+        Open the ledger, replaying entries the rollups do not cover yet.
+
+        Args:
+            path (str): The JSONL file, or None to keep the ledger in memory only.
+            prices (dict): Engines mapped to (prompt, completion) dollars per 1,000 tokens.
+            session_budget (float): The most this session may spend, or None for no cap.
+            daily_budget (float): The most that may be spent per day, or None for no cap.
+            session (str): The session name; defaults to the start time.
+        """
+        self.path = path
+        self.prices = PRICES if prices is None else prices
+        self.session_budget = session_budget
+        self.daily_budget = daily_budget
+        self.session = session or datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.reserved = 0.0
+        self.lock = threading.Lock()
+        self.file = None
+        self.db = sqlite3.connect(":memory:" if path is None else rollup_path(path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS rollups (
+                dimension TEXT NOT NULL,
+                value TEXT NOT NULL,
+                requests INTEGER NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                cost REAL NOT NULL,
+                PRIMARY KEY (dimension, value)
+            );
+            CREATE TABLE IF NOT EXISTS covered (id INTEGER PRIMARY KEY CHECK (id = 0), offset INTEGER NOT NULL);
+        """)
+        self.db.commit()
+        self.db.execute("BEGIN IMMEDIATE")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != ROLLUPS_VERSION:
+            # Rollups from an older set of dimensions; rebuild them from the ledger
+            self.db.execute("DELETE FROM rollups")
+            self.db.execute("DELETE FROM covered")
+            self.db.execute(f"PRAGMA user_version = {ROLLUPS_VERSION}")
+        self.db.commit()
+        if path is None:
+            return
+        self.file = open(path, 'a')
+        self.catch_up()
+
+    def catch_up(self):
+        """
+        Add ledger entries written since the rollups were last updated.
+
+        A ledger that is shorter than the rollups say, because it was rotated
+        or truncated, is replayed from the start.
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.replay()
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+
+    def replay(self):
+        """
+        Add entries past the covered offset to the rollups, without committing.
+
+        The caller holds the write transaction, so no other process can move
+        the covered offset or add to the rollups meanwhile.
+        """
+        row = self.db.execute("SELECT offset FROM covered WHERE id = 0").fetchone()
+        offset = row[0] if row else 0
+        size = os.path.getsize(self.path)
+        if size == offset:
+            return
+        if size < offset:
+            self.db.execute("DELETE FROM rollups")
+            self.db.execute("DELETE FROM covered")
+            offset = 0
+        entries = []
+        with open(self.path, 'r') as f:
+            f.seek(offset)
+            for line in iter(f.readline, ""):
+                if not line.endswith("\n"):
+                    # A line cut off mid-write; leave it for the next start
+                    break
+                if line.strip():
+                    entries.append(json.loads(line))
+                    if len(entries) >= REPLAY_CHUNK:
+                        self.add(entries)
+                        entries = []
+                offset = f.tell()
+        self.add(entries)
+        self.cover(offset)
+
+    def add(self, entries):
+        """
+        Add entries to the rollups, without committing.
+
+        Args:
+            entries (list): The ledger entries.
+        """
+        totals = {}
+        for entry in entries:
+            for dimension in DIMENSIONS:
+                if dimension == "day":
+                    value = entry["timestamp"][:10]
+                elif dimension == "key_day":
+                    value = f"{entry['timestamp'][:10]} {entry.get('key')}"
+                else:
+                    value = entry.get(dimension)
+                row = totals.setdefault((dimension, value), [0, 0, 0, 0.0])
+                row[0] += 1
+                row[1] += entry["prompt_tokens"]
+                row[2] += entry["completion_tokens"]
+                row[3] += entry["cost"]
+        self.db.executemany("INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT (dimension, value) DO UPDATE SET "
+                            "requests = requests + excluded.requests, "
+                            "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                            "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                            "cost = cost + excluded.cost",
+                            [key + tuple(row) for key, row in totals.items()])
+
+    def cover(self, offset):
+        """
+        Record how much of the ledger the rollups cover, without committing.
+
+        The offset only moves forward, so a stale offset cannot make entries
+        be replayed twice.
+
+        Args:
+            offset (int): The ledger size in bytes.
+        """
+        self.db.execute("INSERT INTO covered VALUES (0, ?) "
+                        "ON CONFLICT (id) DO UPDATE SET offset = MAX(offset, excluded.offset)", (offset,))
+
+    def spent(self, dimension, value):
+        """
+        Return the spending so far under one rollup.
+
+        Args:
+            dimension (str): "session", "model", "key" or "day".
+            value (str): The session, model, key or day.
+
+        Returns:
+            float: The cost in dollars.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT cost FROM rollups WHERE dimension = ? AND value = ?",
+                                  (dimension, value)).fetchone()
+        return row[0] if row else 0.0
+
+    def tokens(self, dimension, value):
+        """
+        Return the tokens used so far under one rollup.
+
+        Args:
+            dimension (str): "session", "model", "key", "day" or "key_day".
+            value (str): The session, model, key, day or "day key".
+
+        Returns:
+            int: The prompt and completion tokens.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT prompt_tokens + completion_tokens FROM rollups "
+                                  "WHERE dimension = ? AND value = ?", (dimension, value)).fetchone()
+        return row[0] if row else 0
+
+    def reserve(self, engine, prompt_tokens, max_tokens):
+        """
+        Set aside the most a call can cost, if the budgets allow it.
+
+        Args:
+            engine (str): The engine name.
+            prompt_tokens (int): The prompt tokens.
+            max_tokens (int): The most tokens the call can generate.
+
+        Returns:
+            float: The amount reserved, to pass to record() or release().
+
+        Raises:
+            BudgetExceeded: If the call could take spending over a cap.
+        """
+        estimate = price(engine, prompt_tokens, max_tokens, self.prices)
+        if estimate == float("inf"):
+            # Engines with no price cannot be budgeted; record them at zero cost
+            estimate = 0.0
+        committed = self.reserved + estimate
+        if self.session_budget is not None and \
+                self.spent("session", self.session) + committed > self.session_budget:
+            raise BudgetExceeded(f"Session budget of ${self.session_budget:.2f} reached "
+                                 f"(${self.spent('session', self.session):.4f} spent)")
+        today = datetime.now().isoformat()[:10]
+        if self.daily_budget is not None and self.spent("day", today) + committed > self.daily_budget:
+            raise BudgetExceeded(f"Daily budget of ${self.daily_budget:.2f} reached "
+                                 f"(${self.spent('day', today):.4f} spent today)")
+        self.reserved = committed
+        return estimate
+
+    def release(self, reserved):
+        """
+        Give back a reservation for a call that failed.
+
+        Args:
+            reserved (float): The amount returned by reserve().
+        """
+        self.reserved = max(0.0, self.reserved - reserved)
+
+    def record(self, engine, usage, key=None, reserved=0.0):
+        """
+        Record a finished call.
+
+        Args:
+            engine (str): The engine name.
+            usage (dict): The call's prompt and completion tokens.
+            key (str): The masked API key the call used.
+            reserved (float): The amount returned by reserve().
+
+        Returns:
+            dict: The ledger entry.
+        """
+        self.release(reserved)
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        cost = price(engine, prompt_tokens, completion_tokens, self.prices)
+        entry = {"timestamp": datetime.now().isoformat(), "session": self.session, "model": engine,
+                 "key": key or "default", "prompt_tokens": prompt_tokens,
+                 "completion_tokens": completion_tokens, "cost": 0.0 if cost == float("inf") else cost}
+        with self.lock:
+            if self.file is None:
+                self.add([entry])
+                self.db.commit()
+                return entry
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.file.write(json.dumps(entry) + "\n")
+                self.file.flush()
+                # Picks up this entry along with any other process has written since
+                self.replay()
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+        return entry
+
+    def rollup(self, dimension):
+        """
+        Return the totals under one dimension.
+
+        Args:
+            dimension (str): "session", "model", "key" or "day".
+
+        Returns:
+            dict: Each session, model, key or day mapped to its requests, tokens and cost.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT value, requests, prompt_tokens, completion_tokens, cost "
+                                   "FROM rollups WHERE dimension = ?", (dimension,)).fetchall()
+        return {value: {"requests": requests, "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens, "cost": cost}
+                for value, requests, prompt_tokens, completion_tokens, cost in rows}
+
+    def close(self):
+        """
+        Close the ledger file and the rollups.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def rollup_path(path):
+    """
+    Return where the rollups of a ledger are kept.
+
+    Args:
+        path (str): The ledger's JSONL file.
+
+    Returns:
+        str: The SQLite file next to it.
+    """
+    return os.path.splitext(path)[0] + ".sqlite3"
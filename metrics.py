@@ -0,0 +1,340 @@
+"""
+Request metrics for browseGPT
+
+Per-model latency and time-to-first-token histograms, token counts and
+outcomes, plus cache, retry and queue gauges read from the client when the
+metrics are rendered. The output is the Prometheus text format, served on
+/metrics or written to a file.
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: os, threading, http.server
+Licence: Please cite if used.
+"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+DEFAULT_DUMP_PATH = "gpt_metrics.prom"
+
+
+class Histogram:
+    """
+    Log-linear histogram of durations, in the style of HdrHistogram.
+
+    Values are kept in microseconds. Each power of two is split into 16
+    linear buckets, so a percentile is within about 3% of the true value
+    whatever the range, and recording a value is a few integer operations.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty histogram.
+        """
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def bucket(micros):
+        """
+        Return the bucket a value falls in.
+
+        Args:
+            micros (int): The value in microseconds.
+
+        Returns:
+            int: The bucket index.
+        """
+        if micros < 2 * SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+        return shift * SUB_BUCKETS + (micros >> shift)
+
+    @staticmethod
+    def bucket_value(index):
+        """
+        Return the middle of a bucket.
+
+        Args:
+            index (int): The bucket index.
+
+        Returns:
+            float: The value in seconds.
+        """
+        if index < 2 * SUB_BUCKETS:
+            return index / 1e6
+        shift = index // SUB_BUCKETS - 1
+        low = (index - shift * SUB_BUCKETS) << shift
+        return (low + (1 << shift) / 2) / 1e6
+
+    def record(self, seconds):
+        """
+        Add a value.
+
+        Args:
+            seconds (float): The value in seconds.
+        """
+        if seconds is None:
+            return
+        index = self.bucket(max(0, int(seconds * 1e6)))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """
+        Return a percentile.
+
+        Args:
+            q (float): The percentile, between 0 and 1.
+
+        Returns:
+            float: The value in seconds, or None if the histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Registry of request metrics, labelled by model.
+
+    The client calls observe() once per request. Gauges such as cache hit
+    rate and queue depth are read from the client only when the metrics are
+    rendered, so they cost nothing on the request path.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty registry.
+        """
+        self.latency = {}
+        self.ttft = {}
+        self.counters = {}
+        self.client = None
+        self.server = None
+
+    def attach(self, client):
+        """
+        Read cache, retry and queue gauges from a client.
+
+        Args:
+            client (AsyncClient): The client to read.
+        """
+        self.client = client
+
+    def increment(self, name, labels, amount=1):
+        """
+        Add to a counter.
+
+        Args:
+            name (str): The metric name.
+            labels (tuple): (label, value) pairs.
+            amount (float): How much to add.
+        """
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, endpoint, params, seconds, result=None, error=None):
+        """
+        Record one request.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): The request parameters.
+            seconds (float): How long the caller waited.
+            result (dict): The response, on success.
+            error (BaseException): The error, on failure.
+        """
+        model = params.get("engine") or params.get("model")
+        if error is not None:
+            self.increment("browsegpt_requests_total", (("model", model), ("outcome", type(error).__name__)))
+            return
+        outcome = "cached" if result.get("cached") else "coalesced" if result.get("coalesced") else "ok"
+        self.increment("browsegpt_requests_total", (("model", model), ("outcome", outcome)))
+        self.latency.setdefault(model, Histogram()).record(seconds)
+        if outcome != "ok":
+            return
+        if result.get("ttft") is not None:
+            # An empty streamed reply has no first token
+            self.ttft.setdefault(model, Histogram()).record(result["ttft"])
+        # The client fills in counts for streamed replies, so nothing is tokenized here
+        usage = result.get("usage") or {}
+        self.increment("browsegpt_prompt_tokens_total", (("model", model),), usage.get("prompt_tokens", 0))
+        self.increment("browsegpt_completion_tokens_total", (("model", model),), usage.get("completion_tokens", 0))
+
+    def gauges(self):
+        """
+        Read the client's gauges and cumulative counters.
+
+        Returns:
+            list: (name, type, help, labels, value) tuples.
+        """
+        client = self.client
+        if client is None:
+            return []
+        samples = [("browsegpt_queue_depth", "gauge", "Requests waiting for a concurrency slot.", (),
+                    client.queued),
+                   ("browsegpt_inflight_requests", "gauge", "Distinct requests in flight.", (),
+                    len(client.inflight)),
+                   ("browsegpt_coalesced_total", "counter", "Requests served by an identical one in flight.",
+                    (), client.coalesced)]
+        if client.limiter is not None:
+            samples.append(("browsegpt_rate_limit_waiting", "gauge", "Requests waiting on the rate limiter.",
+                            (), client.limiter.waiting))
+        if client.retry is not None:
+            for name, value in client.retry.counters.items():
+                samples.append((f"browsegpt_retry_{name}_total", "counter", f"Retry policy {name} count.",
+                                (), value))
+        if client.cache is not None:
+            stats = client.cache.stats()
+            for name in ("memory_hits", "disk_hits", "misses", "skipped"):
+                samples.append((f"browsegpt_cache_{name}_total", "counter", f"Response cache {name}.",
+                                (), stats[name]))
+            samples.append(("browsegpt_cache_hit_ratio", "gauge", "Response cache hit rate.", (),
+                            stats["hit_rate"]))
+        return samples
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        """
+        lines = []
+        for name, help_text, histograms in (
+                ("browsegpt_request_latency_seconds", "Time callers waited for a response.", self.latency),
+                ("browsegpt_ttft_seconds", "Time to first token of requests sent to the API.", self.ttft)):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} summary"]
+            for model, histogram in sorted(histograms.items()):
+                if not histogram.count:
+                    continue
+                for q in QUANTILES:
+                    value = histogram.percentile(q)
+                    lines.append(f'{name}{{model="{model}",quantile="{q}"}} {value:.6f}')
+                lines.append(f'{name}_sum{{model="{model}"}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{model="{model}"}} {histogram.count}')
+
+        helps = {"browsegpt_requests_total": "Requests by model and outcome.",
+                 "browsegpt_prompt_tokens_total": "Prompt tokens sent.",
+                 "browsegpt_completion_tokens_total": "Completion tokens received."}
+        for metric in sorted(helps):
+            lines += [f"# HELP {metric} {helps[metric]}", f"# TYPE {metric} counter"]
+            for (name, labels), value in sorted(self.counters.items()):
+                if name == metric:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for name, kind, help_text, labels, value in self.gauges():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}",
+                      f"{name}{format_labels(labels)} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Return per-model figures for display.
+
+        Returns:
+            list: One dict per model with request counts, percentiles and tokens.
+        """
+        rows = []
+        for model in sorted(set(self.latency) | {dict(l)["model"] for _, l in self.counters}):
+            latency = self.latency.get(model, Histogram())
+            ttft = self.ttft.get(model, Histogram())
+            requests = sum(v for (n, l), v in self.counters.items()
+                           if n == "browsegpt_requests_total" and dict(l)["model"] == model)
+            errors = sum(v for (n, l), v in self.counters.items() if n == "browsegpt_requests_total"
+                         and dict(l)["model"] == model and dict(l)["outcome"] not in ("ok", "cached", "coalesced"))
+            rows.append({"model": model, "requests": requests, "errors": errors,
+                         "p50": latency.percentile(0.5), "p95": latency.percentile(0.95),
+                         "p99": latency.percentile(0.99), "ttft_p50": ttft.percentile(0.5),
+                         "ttft_p99": ttft.percentile(0.99),
+                         "prompt_tokens": self.counters.get(("browsegpt_prompt_tokens_total",
+                                                             (("model", model),)), 0),
+                         "completion_tokens": self.counters.get(("browsegpt_completion_tokens_total",
+                                                                 (("model", model),)), 0)})
+        return rows
+
+    def dump(self, path=DEFAULT_DUMP_PATH):
+        """
+        Write the metrics to a file, replacing it atomically.
+
+        Args:
+            path (str): The file to write, e.g. for a node exporter textfile collector.
+        """
+        temp = path + ".tmp"
+        with open(temp, 'w') as f:
+            f.write(self.render())
+        os.replace(temp, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the metrics on /metrics from a background thread.
+
+        Args:
+            port (int): The port, or 0 for any free port.
+            host (str): The interface to listen on.
+
+        Returns:
+            int: The port the server listens on.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        """
+        Stop the metrics server, if it is running.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+def format_labels(labels):
+    """
+    Format labels for the Prometheus text format.
+
+    Args:
+        labels (tuple): (label, value) pairs.
+
+    Returns:
+        str: The label block, or an empty string.
+    """
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
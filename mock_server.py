@@ -0,0 +1,430 @@
+"""
+Local OpenAI-compatible mock server for browseGPT
+
+Serves /v1/completions, /v1/engines/<engine>/completions and
+/v1/chat/completions, streamed or not, with configurable latency, token
+rate, errors and rate limiting. MockBackend runs the same simulation in
+process, without HTTP.
+
+Usage: python mock_server.py [--port 8080] [--latency 0.2] [--tokens-per-second 50]
+Then point the client at it with api_base="http://127.0.0.1:8080/v1".
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, argparse, asyncio, json, math, random, re, threading, time, zlib, http.server, context, tokenizer
+Licence: Please cite if used.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+
+from context import count_message
+from tokenizer import count_tokens
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+ROUTE = re.compile(r"^/v1/(?:engines/([^/]+)/)?(completions|chat/completions)$")
+WORDS = ("the", "model", "answer", "query", "token", "stream", "result", "data", "search", "browse",
+         "cache", "request", "response", "copilot", "history", "latency", "batch", "prompt", "text",
+         "is", "a", "of", "to", "and", "in", "that", "for", "with", "on", "as")
+
+
+class Simulator:
+    """
+    Simulated model timing, failures and output.
+
+    The wait for the first token is log-normal around a median latency, and
+    the rest of the answer arrives at a fixed token rate. Each request may
+    fail with a 429 (with Retry-After) or a 503. Answers are made from a
+    seeded word list, so the same prompt always gets the same answer.
+    """
+
+    def __init__(self, latency=0.2, jitter=0.5, tokens_per_second=50.0, error_rate=0.0,
+                 rate_limit_rate=0.0, retry_after=1.0, seed=None):
+        """
+        Initialize the simulator.
+
+        Args:
+            latency (float): The median seconds to the first token.
+            jitter (float): The log-normal sigma around the median; 0 for none.
+            tokens_per_second (float): The rate tokens arrive after the first; 0 for instant.
+            error_rate (float): The share of requests that fail with a 503.
+            rate_limit_rate (float): The share of requests that fail with a 429.
+            retry_after (float): The Retry-After seconds sent with a 429.
+            seed (int): Seed for the latency and failure draws.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.counters = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+    def first_token_delay(self):
+        """
+        Draw the seconds to wait before the first token.
+
+        Returns:
+            float: The delay.
+        """
+        if self.latency <= 0:
+            return 0.0
+        if self.jitter <= 0:
+            return self.latency
+        return self.random.lognormvariate(math.log(self.latency), self.jitter)
+
+    def token_delay(self):
+        """
+        Return the seconds between tokens.
+
+        Returns:
+            float: The delay.
+        """
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def failure(self):
+        """
+        Decide whether a request fails.
+
+        Returns:
+            tuple: The HTTP status, error type and message, or None to succeed.
+        """
+        self.counters["requests"] += 1
+        draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            self.counters["rate_limited"] += 1
+            return 429, "requests", "Rate limit reached for requests (mock)."
+        if draw < self.rate_limit_rate + self.error_rate:
+            self.counters["errors"] += 1
+            return 503, "server_error", "The server is overloaded (mock)."
+        return None
+
+    def generate(self, prompt, max_tokens):
+        """
+        Make the answer tokens for a prompt.
+
+        Args:
+            prompt (str): The prompt text.
+            max_tokens (int): The most tokens to return.
+
+        Returns:
+            list: The tokens, each a word with its leading space.
+        """
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        length = rng.randint(max(1, max_tokens // 2), max(1, max_tokens))
+        return [" " + rng.choice(WORDS) for _ in range(length)]
+
+
+def prompt_of(endpoint, params):
+    """
+    Return the prompt text and prompt tokens of a request.
+
+    Args:
+        endpoint (str): "completion" or "chat".
+        params (dict): The request parameters.
+
+    Returns:
+        tuple: The prompt text (or list of texts) and the prompt tokens.
+    """
+    if endpoint == "chat":
+        messages = params.get("messages") or []
+        return "\n".join(m["content"] for m in messages), sum(count_message(m) for m in messages)
+    prompt = params.get("prompt", "")
+    prompts = prompt if isinstance(prompt, list) else [prompt]
+    return prompt, sum(count_tokens(p) for p in prompts)
+
+
+def usage_of(prompt_tokens, completion_tokens):
+    """
+    Build a usage block.
+
+    Args:
+        prompt_tokens (int): The prompt tokens.
+        completion_tokens (int): The completion tokens.
+
+    Returns:
+        dict: The usage block.
+    """
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for the mock API.
+    """
+
+    protocol_version = "HTTP/1.1"
+    simulator = None
+    quiet = True
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=None):
+        """
+        Send a JSON response.
+
+        Args:
+            status (int): The HTTP status.
+            body (dict): The response body.
+            headers (dict): Extra headers.
+        """
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_body(self, status, kind, message):
+        """
+        Send an error in the OpenAI format.
+
+        Args:
+            status (int): The HTTP status.
+            kind (str): The error type.
+            message (str): The error message.
+        """
+        headers = {"Retry-After": str(self.simulator.retry_after)} if status == 429 else None
+        self.send_json(status, {"error": {"message": message, "type": kind, "param": None, "code": None}},
+                       headers)
+
+    def send_event(self, body):
+        """
+        Send one server-sent event as an HTTP chunk.
+
+        Args:
+            body (object): The event data; a string is sent as is.
+        """
+        data = ("data: " + (body if isinstance(body, str) else json.dumps(body)) + "\n\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        """
+        Serve a completion or chat completion.
+        """
+        match = ROUTE.match(self.path.split("?")[0])
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            params = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self.send_error_body(400, "invalid_request_error", "Request body is not valid JSON.")
+            return
+        if match is None:
+            self.send_error_body(404, "invalid_request_error", f"Unknown URL {self.path}")
+            return
+        endpoint = "chat" if match.group(2) == "chat/completions" else "completion"
+        model = match.group(1) or params.get("model") or params.get("engine") or "mock"
+
+        failure = self.simulator.failure()
+        if failure is not None:
+            time.sleep(self.simulator.first_token_delay())
+            self.send_error_body(*failure)
+            return
+
+        if params.get("stream"):
+            self.stream(endpoint, model, params)
+        else:
+            self.respond(endpoint, model, params)
+
+    def respond(self, endpoint, model, params):
+        """
+        Send a whole answer once it would have finished generating.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            model (str): The model name.
+            params (dict): The request parameters.
+        """
+        prompt, prompt_tokens = prompt_of(endpoint, params)
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        answers = [self.simulator.generate(p, params.get("max_tokens", 16)) for p in prompts]
+        longest = max(len(tokens) for tokens in answers)
+        time.sleep(self.simulator.first_token_delay() + (longest - 1) * self.simulator.token_delay())
+        choices = []
+        for index, tokens in enumerate(answers):
+            text = "".join(tokens)
+            if endpoint == "chat":
+                choices.append({"index": index, "message": {"role": "assistant", "content": text},
+                                "finish_reason": "length"})
+            else:
+                choices.append({"index": index, "text": text, "logprobs": None, "finish_reason": "length"})
+        completion_tokens = sum(len(tokens) for tokens in answers)
+        self.send_json(200, {"id": f"mock-{zlib.crc32(str(prompt).encode('utf-8'))}",
+                             "object": "chat.completion" if endpoint == "chat" else "text_completion",
+                             "created": int(time.time()), "model": model, "choices": choices,
+                             "usage": usage_of(prompt_tokens, completion_tokens)})
+
+    def stream(self, endpoint, model, params):
+        """
+        Send an answer token by token as server-sent events.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            model (str): The model name.
+            params (dict): The request parameters.
+        """
+        prompt, _ = prompt_of(endpoint, params)
+        tokens = self.simulator.generate(str(prompt), params.get("max_tokens", 16))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(self.simulator.first_token_delay())
+        base = {"id": "mock-stream", "object": "chat.completion.chunk" if endpoint == "chat"
+                else "text_completion", "created": int(time.time()), "model": model}
+        for index, token in enumerate(tokens):
+            if index:
+                time.sleep(self.simulator.token_delay())
+            if endpoint == "chat":
+                choice = {"index": 0, "delta": {"content": token}, "finish_reason": None}
+            else:
+                choice = {"index": 0, "text": token, "logprobs": None, "finish_reason": None}
+            self.send_event(dict(base, choices=[choice]))
+        self.send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_server(simulator=None, host=DEFAULT_HOST, port=DEFAULT_PORT, quiet=True):
+    """
+    Start the mock server on a background thread.
+
+    Args:
+        simulator (Simulator): The simulation settings; defaults are used if None.
+        host (str): The interface to listen on.
+        port (int): The port, or 0 for any free port.
+        quiet (bool): Whether to suppress the request log.
+
+    Returns:
+        tuple: The server and the api_base URL to give the client.
+    """
+    handler = type("Handler", (MockHandler,), {"simulator": simulator or Simulator(), "quiet": quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+class MockBackend:
+    """
+    In-process backend that runs the simulator without HTTP.
+
+    It raises the same openai errors the real API would, so retries, rate
+    limiting and key failover behave as they do against the server.
+    """
+
+    def __init__(self, simulator=None):
+        """
+        Initialize the backend.
+
+        Args:
+            simulator (Simulator): The simulation settings; defaults are used if None.
+        """
+        self.simulator = simulator or Simulator()
+
+    def check_failure(self):
+        """
+        Raise the simulated error for a request, if it fails.
+
+        Raises:
+            openai.error.RateLimitError: For a simulated 429.
+            openai.error.ServiceUnavailableError: For a simulated 503.
+        """
+        failure = self.simulator.failure()
+        if failure is None:
+            return
+        status, _, message = failure
+        if status == 429:
+            raise openai.error.RateLimitError(message, http_status=429,
+                                              headers={"Retry-After": str(self.simulator.retry_after)})
+        raise openai.error.ServiceUnavailableError(message, http_status=503)
+
+    async def send(self, endpoint, params, on_token=None):
+        """
+        Simulate one request.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): The request parameters.
+            on_token (callable): Called with each token when streaming.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        start = time.monotonic()
+        self.check_failure()
+        prompt, prompt_tokens = prompt_of(endpoint, params)
+        tokens = self.simulator.generate(prompt, params.get("max_tokens", 16))
+        await asyncio.sleep(self.simulator.first_token_delay())
+        ttft = time.monotonic() - start
+        if on_token is None:
+            await asyncio.sleep((len(tokens) - 1) * self.simulator.token_delay())
+        else:
+            for index, token in enumerate(tokens):
+                if index:
+                    await asyncio.sleep(self.simulator.token_delay())
+                on_token(token.lstrip() if not index else token)
+        latency = time.monotonic() - start
+        return {"text": "".join(tokens).strip(),
+                "usage": usage_of(prompt_tokens, len(tokens)) if on_token is None else {},
+                "ttft": ttft if on_token is not None else latency, "latency": latency}
+
+    async def send_batch(self, params):
+        """
+        Simulate one completion request with a list of prompts.
+
+        Args:
+            params (dict): The request parameters, with a list prompt.
+
+        Returns:
+            tuple: One result per prompt, in order, and the usage of the whole batch.
+        """
+        start = time.monotonic()
+        self.check_failure()
+        answers = [self.simulator.generate(p, params.get("max_tokens", 16)) for p in params["prompt"]]
+        longest = max(len(tokens) for tokens in answers)
+        await asyncio.sleep(self.simulator.first_token_delay() + (longest - 1) * self.simulator.token_delay())
+        latency = time.monotonic() - start
+        results = [{"text": "".join(tokens).strip(), "usage": {}, "ttft": latency, "latency": latency}
+                   for tokens in answers]
+        return results, usage_of(prompt_of("completion", params)[1], sum(len(t) for t in answers))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenAI API.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.2, help="median seconds to first token")
+    parser.add_argument("--jitter", type=float, default=0.5, help="log-normal sigma of the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests failing with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+    simulator = Simulator(args.latency, args.jitter, args.tokens_per_second, args.error_rate,
+                          args.rate_limit_rate, args.retry_after, args.seed)
+    server, api_base = start_server(simulator, args.host, args.port, quiet=not args.verbose)
+    print(f"Mock OpenAI API listening on {api_base} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,175 @@
+"""
+Request and token rate limiting for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: asyncio, time, context, tokenizer
+Licence: Please cite if used.
+"""
+
+import asyncio
+import time
+
+from context import count_message
+from tokenizer import count_tokens
+
+# Requests per minute and tokens per minute for each engine in MODELS
+RATE_LIMITS = {
+    "text-gpt-1-en-12b": (3000, 250000),
+    "text-gpt-2-en-117b": (3000, 250000),
+    "text-davinci-002": (3000, 250000),
+    "text-davinci-003": (3000, 250000),
+    "text-davinci-004": (500, 40000),
+    "text-jurassic-1-jumbo-en-175b": (200, 40000),
+    "text-megatron-turing-nlg-345m-355b": (200, 40000),
+    "text-wudao-2-0-en-1.76T": (200, 40000)
+}
+DEFAULT_LIMITS = (60, 40000)
+
+
+def estimate_tokens(endpoint, params):
+    """
+    Estimate the tokens a request will use before sending it.
+
+    Args:
+        endpoint (str): "completion" or "chat".
+        params (dict): The request parameters.
+
+    Returns:
+        tuple: The prompt tokens and the most tokens the whole request can use.
+    """
+    if endpoint == "chat":
+        prompt_tokens = sum(count_message(message) for message in params["messages"])
+    else:
+        prompt_tokens = count_tokens(params["prompt"])
+    return prompt_tokens, prompt_tokens + params.get("max_tokens", 16)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously up to its capacity.
+
+    Waiters are served in arrival order. The balance may go negative when a
+    request used more than was charged for it, which delays later callers.
+    """
+
+    def __init__(self, capacity, per_minute):
+        """
+        Initialize a full bucket.
+
+        Args:
+            capacity (float): The most the bucket can hold.
+            per_minute (float): How much is added back each minute.
+        """
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.refunded = asyncio.Event()
+
+    def refill(self):
+        """
+        Add back what has accrued since the last update.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount):
+        """
+        Wait until the bucket holds the amount, then take it.
+
+        Args:
+            amount (float): How much to take; capped at the capacity.
+        """
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                # Wake early if a reconciled request gives tokens back
+                self.refunded.clear()
+                try:
+                    await asyncio.wait_for(self.refunded.wait(), (amount - self.tokens) / self.rate)
+                except asyncio.TimeoutError:
+                    pass
+
+    def adjust(self, amount):
+        """
+        Give back (positive) or charge extra (negative) without waiting.
+
+        Args:
+            amount (float): The correction.
+        """
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+        if amount > 0:
+            self.refunded.set()
+
+
+class RateLimiter:
+    """
+    Per-engine requests-per-minute and tokens-per-minute limiter.
+
+    Each request is pre-charged its prompt tokens plus max_tokens from a local
+    count, and the charge is corrected to the real usage once the response
+    comes back.
+    """
+
+    def __init__(self, limits=None, default=DEFAULT_LIMITS):
+        """
+        Initialize the limiter.
+
+        Args:
+            limits (dict): Engines mapped to (requests per minute, tokens per minute).
+            default (tuple): Limits for engines not in the table.
+        """
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.default = default
+        self.buckets = {}
+        self.waiting = 0
+
+    def get_buckets(self, engine):
+        """
+        Return the request and token buckets for an engine.
+
+        Args:
+            engine (str): The engine name.
+
+        Returns:
+            tuple: The requests bucket and the tokens bucket.
+        """
+        if engine not in self.buckets:
+            rpm, tpm = self.limits.get(engine, self.default)
+            self.buckets[engine] = (TokenBucket(rpm, rpm), TokenBucket(tpm, tpm))
+        return self.buckets[engine]
+
+    async def acquire(self, engine, tokens):
+        """
+        Wait until the engine has capacity for one request of this size.
+
+        Args:
+            engine (str): The engine name.
+            tokens (int): The tokens to pre-charge.
+        """
+        requests, token_bucket = self.get_buckets(engine)
+        self.waiting += 1
+        try:
+            await requests.acquire(1)
+            await token_bucket.acquire(tokens)
+        finally:
+            self.waiting -= 1
+
+    def reconcile(self, engine, charged, used):
+        """
+        Correct a pre-charge once the real usage is known.
+
+        Args:
+            engine (str): The engine name.
+            charged (int): The tokens pre-charged.
+            used (int): The tokens the request really used.
+        """
+        self.get_buckets(engine)[1].adjust(charged - used)
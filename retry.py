@@ -0,0 +1,148 @@
+"""
+Retry policy for browseGPT requests
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, asyncio, random, time, email.utils
+Licence: Please cite if used.
+"""
+
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import openai
+
+RETRYABLE = "retryable"
+RATE_LIMITED = "rate_limited"
+AUTH = "auth"
+FATAL = "fatal"
+
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_MAX_ELAPSED = 120.0
+
+
+def classify(error):
+    """
+    Sort an error into retryable, rate-limited, auth or fatal.
+
+    Args:
+        error (Exception): The error raised by a request.
+
+    Returns:
+        str: One of RETRYABLE, RATE_LIMITED, AUTH or FATAL.
+    """
+    if isinstance(error, (openai.error.AuthenticationError, openai.error.PermissionError)):
+        return AUTH
+    if isinstance(error, openai.error.RateLimitError):
+        return RATE_LIMITED
+    if isinstance(error, (asyncio.TimeoutError, openai.error.Timeout, openai.error.TryAgain,
+                          openai.error.APIConnectionError, openai.error.ServiceUnavailableError)):
+        return RETRYABLE
+    if isinstance(error, openai.error.OpenAIError):
+        status = error.http_status or 0
+        if status in (401, 403):
+            return AUTH
+        if status == 429:
+            return RATE_LIMITED
+        if status >= 500 or isinstance(error, openai.error.APIError):
+            return RETRYABLE
+    return FATAL
+
+
+def retry_after(error):
+    """
+    Read the Retry-After header from an error, if it has one.
+
+    Args:
+        error (Exception): The error raised by a request.
+
+    Returns:
+        float: Seconds to wait, or None if the header is missing.
+    """
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Retry failed requests with exponential backoff and full jitter.
+
+    Rate-limited requests wait at least as long as Retry-After asks. Auth and
+    fatal errors are raised at once, as is anything still failing after
+    max_attempts tries or max_elapsed seconds.
+    """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, max_elapsed=DEFAULT_MAX_ELAPSED):
+        """
+        Initialize the retry policy.
+
+        Args:
+            max_attempts (int): The maximum number of tries per request.
+            base_delay (float): The backoff cap for the first retry, in seconds.
+            max_delay (float): The largest backoff cap, in seconds.
+            max_elapsed (float): The total time budget per request, in seconds.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.counters = {"retries": 0, "rate_limited": 0, "gave_up": 0}
+
+    def backoff(self, attempt):
+        """
+        Pick a full-jitter delay for a retry.
+
+        Args:
+            attempt (int): The number of tries made so far.
+
+        Returns:
+            float: Seconds to wait.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def call(self, send, can_retry=None):
+        """
+        Call send() until it succeeds or the policy gives up.
+
+        Args:
+            send (callable): Returns a new request coroutine on each call.
+            can_retry (callable): Returns False once retrying is no longer safe,
+                for example after a stream has started printing.
+
+        Returns:
+            object: The result of the first successful call.
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await send()
+            except Exception as e:
+                kind = classify(e)
+                if kind in (AUTH, FATAL) or (can_retry is not None and not can_retry()):
+                    raise
+                delay = self.backoff(attempt)
+                if kind == RATE_LIMITED:
+                    self.counters["rate_limited"] += 1
+                    delay = max(delay, retry_after(e) or 0.0)
+                if attempt >= self.max_attempts or time.monotonic() - start + delay > self.max_elapsed:
+                    self.counters["gave_up"] += 1
+                    raise
+                self.counters["retries"] += 1
+                await asyncio.sleep(delay)
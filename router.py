@@ -0,0 +1,290 @@
+"""
+Latency- and cost-aware model routing for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, asyncio, json, time, datetime.datetime, collections.deque, history, ledger, retry, tokenizer
+Licence: Please cite if used.
+"""
+
+import asyncio
+import json
+import time
+from collections import deque
+from datetime import datetime
+
+from history import SYNC_EVERY, SYNC_INTERVAL
+from ledger import PRICES, BudgetExceeded, price
+from retry import AUTH, classify
+from tokenizer import count_tokens
+
+AUTO = "Auto"
+CHEAPEST = "cheapest"
+FASTEST = "fastest"
+QUALITY = "quality"
+POLICIES = (CHEAPEST, FASTEST, QUALITY)
+
+# Rough answer quality of each engine, from 0 to 1
+QUALITY_SCORES = {
+    "text-gpt-1-en-12b": 0.2,
+    "text-gpt-2-en-117b": 0.3,
+    "text-davinci-002": 0.7,
+    "text-davinci-003": 0.8,
+    "text-davinci-004": 0.95,
+    "text-jurassic-1-jumbo-en-175b": 0.6,
+    "text-megatron-turing-nlg-345m-355b": 0.65,
+    "text-wudao-2-0-en-1.76T": 0.7
+}
+
+EWMA_WEIGHT = 0.2
+ERROR_RATE_THRESHOLD = 0.5
+MIN_REQUESTS = 5
+DEGRADED_SECONDS = 60
+MAX_DECISIONS = 200
+
+
+class EngineStats:
+    """
+    Running latency and error rate of one engine.
+    """
+
+    def __init__(self):
+        """
+        Initialize empty stats.
+        """
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.degraded_until = 0.0
+
+    def degraded(self, now):
+        """
+        Check whether the engine is sitting out after too many errors.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            bool: True if the engine should only be used as a fallback.
+        """
+        return now < self.degraded_until
+
+
+class ModelRouter:
+    """
+    Pick an engine for each prompt from observed latency, errors and price.
+
+    Engines below the quality floor are never picked. The rest are ranked by
+    the policy: cheapest estimated cost, fastest average latency, or highest
+    quality. Engines whose error rate climbs too high are degraded for a while
+    and only tried after the healthy ones. Every decision is kept for audit
+    and, if a log path is set, appended to a JSONL file that is kept open and
+    flushed in batches, so logging does not block the event loop on disk.
+    """
+
+    def __init__(self, client, models, policy=CHEAPEST, min_quality=0.0, prices=None, quality=None,
+                 log_path=None):
+        """
+        Initialize the router.
+
+        Args:
+            client (AsyncClient): The client that sends the requests.
+            models (dict): Model names mapped to engines.
+            policy (str): One of "cheapest", "fastest" or "quality".
+            min_quality (float): The lowest quality score an engine may have.
+            prices (dict): Engines mapped to (prompt, completion) dollars per 1,000 tokens.
+            quality (dict): Engines mapped to quality scores.
+            log_path (str): The JSONL file decisions are appended to, if any.
+        """
+        self.client = client
+        self.engines = list(models.values())
+        self.policy = policy
+        self.min_quality = min_quality
+        self.prices = PRICES if prices is None else prices
+        self.quality = QUALITY_SCORES if quality is None else quality
+        self.log_path = log_path
+        self.log_file = open(log_path, 'a') if log_path else None
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.stats = {engine: EngineStats() for engine in self.engines}
+        self.decisions = deque(maxlen=MAX_DECISIONS)
+
+    def cost(self, engine, prompt_tokens, max_tokens):
+        """
+        Estimate the most a request can cost.
+
+        Args:
+            engine (str): The engine name.
+            prompt_tokens (int): The prompt tokens.
+            max_tokens (int): The maximum number of tokens to generate.
+
+        Returns:
+            float: The estimated cost in dollars.
+        """
+        return price(engine, prompt_tokens, max_tokens, self.prices)
+
+    def observe(self, engine, latency=None, error=None):
+        """
+        Record the outcome of a request.
+
+        Args:
+            engine (str): The engine name.
+            latency (float): The response time of a successful request.
+            error (Exception): The error of a failed request.
+        """
+        stats = self.stats.setdefault(engine, EngineStats())
+        stats.requests += 1
+        stats.error_rate += EWMA_WEIGHT * ((error is not None) - stats.error_rate)
+        if error is not None:
+            stats.errors += 1
+            if stats.requests >= MIN_REQUESTS and stats.error_rate > ERROR_RATE_THRESHOLD:
+                stats.degraded_until = time.monotonic() + DEGRADED_SECONDS
+                stats.error_rate = 0.0
+        elif latency is not None:
+            stats.latency = latency if stats.latency is None else \
+                stats.latency + EWMA_WEIGHT * (latency - stats.latency)
+
+    def rank(self, prompt_tokens, max_tokens, policy=None):
+        """
+        Order the engines for a request, healthy engines first.
+
+        Args:
+            prompt_tokens (int): The prompt tokens.
+            max_tokens (int): The maximum number of tokens to generate.
+            policy (str): Overrides the router's policy.
+
+        Returns:
+            list: Engines in the order they should be tried.
+        """
+        policy = policy or self.policy
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown routing policy: {policy}")
+        candidates = [e for e in self.engines if self.quality.get(e, 0.0) >= self.min_quality]
+        if policy == FASTEST:
+            # Engines with no samples yet go first so they get measured
+            order = lambda e: (self.stats[e].latency or 0.0, self.cost(e, prompt_tokens, max_tokens))
+        elif policy == QUALITY:
+            order = lambda e: (-self.quality.get(e, 0.0), self.cost(e, prompt_tokens, max_tokens))
+        else:
+            order = lambda e: (self.cost(e, prompt_tokens, max_tokens), self.stats[e].latency or 0.0)
+        now = time.monotonic()
+        return sorted(candidates, key=lambda e: (self.stats[e].degraded(now), order(e)))
+
+    def route(self, prompt, max_tokens, policy=None):
+        """
+        Pick the engines to try for a prompt and log the decision.
+
+        Args:
+            prompt (str): The prompt text.
+            max_tokens (int): The maximum number of tokens to generate.
+            policy (str): Overrides the router's policy.
+
+        Returns:
+            list: Engines in the order they should be tried.
+        """
+        prompt_tokens = count_tokens(prompt)
+        ranked = self.rank(prompt_tokens, max_tokens, policy)
+        now = time.monotonic()
+        decision = {"timestamp": datetime.now().isoformat(), "policy": policy or self.policy,
+                    "prompt_tokens": prompt_tokens, "max_tokens": max_tokens,
+                    "chosen": ranked[0] if ranked else None,
+                    "candidates": [{"engine": e, "cost": self.cost(e, prompt_tokens, max_tokens),
+                                    "latency": self.stats[e].latency,
+                                    "error_rate": self.stats[e].error_rate,
+                                    "degraded": self.stats[e].degraded(now)} for e in ranked]}
+        self.log(decision)
+        return ranked
+
+    def log(self, decision):
+        """
+        Keep a decision for audit.
+
+        Args:
+            decision (dict): The routing decision or fallback.
+        """
+        self.decisions.append(decision)
+        if self.log_file is None:
+            return
+        self.log_file.write(json.dumps(decision) + "\n")
+        self.pending += 1
+        if self.pending >= SYNC_EVERY or time.monotonic() - self.last_flush >= SYNC_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Write logged decisions out to the log file.
+        """
+        if self.log_file is not None:
+            self.log_file.flush()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Flush and close the log file.
+        """
+        if self.log_file is not None:
+            self.flush()
+            self.log_file.close()
+            self.log_file = None
+
+    async def complete(self, prompt, max_tokens, temperature, on_token=None, timeout=None, policy=None):
+        """
+        Request a completion from the best engine, falling back on failure.
+
+        Args:
+            prompt (str): The prompt text.
+            max_tokens (int): The maximum number of tokens to generate.
+            temperature (float): The sampling temperature.
+            on_token (callable): Called with each token when streaming.
+            timeout (float): Timeout in seconds, defaults to the client timeout.
+            policy (str): Overrides the router's policy.
+
+        Returns:
+            dict: The response, with the engine that served it under "model".
+
+        Raises:
+            ValueError: If no engine meets the quality floor.
+        """
+        engines = self.route(prompt, max_tokens, policy)
+        if not engines:
+            raise ValueError(f"No engine has a quality score of at least {self.min_quality}")
+
+        # A stream that has started printing cannot move to another engine
+        streamed = []
+
+        def forward(token):
+            streamed.append(True)
+            on_token(token)
+
+        for index, engine in enumerate(engines):
+            try:
+                result = await self.client.complete(engine, prompt, max_tokens, temperature,
+                                                    on_token=forward if on_token else None,
+                                                    timeout=timeout)
+            except (asyncio.CancelledError, BudgetExceeded):
+                raise
+            except Exception as e:
+                self.observe(engine, error=e)
+                if classify(e) == AUTH or streamed or index == len(engines) - 1:
+                    raise
+                self.log({"timestamp": datetime.now().isoformat(), "fallback_from": engine,
+                          "fallback_to": engines[index + 1], "error": f"{type(e).__name__}: {e}"})
+                continue
+            if not result.get("cached") and not result.get("coalesced"):
+                self.observe(engine, latency=result["latency"])
+            return dict(result, model=engine)
+
+    def report(self):
+        """
+        Return the running stats of every engine.
+
+        Returns:
+            list: One dict per engine with its price, quality, latency and errors.
+        """
+        now = time.monotonic()
+        return [{"engine": engine, "price": self.prices.get(engine), "quality": self.quality.get(engine),
+                 "latency": stats.latency, "error_rate": stats.error_rate, "requests": stats.requests,
+                 "errors": stats.errors, "degraded": stats.degraded(now)}
+                for engine, stats in self.stats.items()]
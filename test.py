@@ -3,15 +3,32 @@ Public Version browseGPT Prototype
 
 Date: 5/25/2023
 Author: Javed I. Ahmed; chat@aicanalytics.com 
-Dependencies: openai, os, json, datetime.datetime
+Dependencies: openai, os, json, asyncio, datetime.datetime, client, cache, batch, batcher, fanout, history, tokenizer, retry, ratelimit, keypool, hedge, router, vcr, metrics, ledger
 Licence: Please cite if used.
 """
 
 import openai
 import os
 import json
+import asyncio
 from datetime import datetime
 
+from batch import BatchRunner, checkpoint_path
+from batcher import MicroBatcher
+from cache import ResponseCache
+from client import AsyncClient, OpenAIBackend
+from fanout import FanOut
+from hedge import HedgePolicy
+from history import open_history, print_results
+from keypool import KeyPool
+from ledger import BudgetExceeded, Ledger
+from metrics import Metrics
+from ratelimit import RateLimiter
+from retry import AUTH, RetryPolicy, classify
+from router import AUTO, ModelRouter
+from tokenizer import count_tokens
+from vcr import Cassette, CassetteMiss, Player, Recorder
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODELS = {
     "GPT-1": "text-gpt-1-en-12b",
@@ -29,7 +46,8 @@ DEFAULT_SETTINGS = {
     "Query Settings": {
         "Max Tokens": 60,
         "Temperature": 0.5,
-        "Role": "user"
+        "Role": "user",
+        "Stream": True
     },
     "Copilot Settings": {
         "Assistance Level": "Medium",
@@ -37,10 +55,64 @@ DEFAULT_SETTINGS = {
         "Default GUI":"GPT4All",
         "Role": "client-l2"
     },
+    "Client Settings": {
+        "Max Concurrency": 32,
+        "Timeout": 60,
+        "Hedge Requests": False,
+        "Hedge Budget": 0.1,
+        "Hedge Spend Cap": 1.0,
+        "Micro Batching": True,
+        "Batch Window": 0.02,
+        "Max Batch": 20,
+        "API Base": os.getenv("OPENAI_API_BASE")
+    },
+    "Router Settings": {
+        "Policy": "cheapest",
+        "Min Quality": 0.0,
+        "Log Path": "gpt_router_log.jsonl"
+    },
+    "Fan-out Settings": {
+        "Mode": "off",
+        "Models": ("GPT-3", "GPT-3.5", "GPT-4")
+    },
+    "Cassette Settings": {
+        "Mode": "off",
+        "Path": "gpt_cassette.jsonl.gz",
+        "Realtime": False
+    },
+    "Metrics Settings": {
+        "Enabled": True,
+        "Port": None,
+        "Dump Path": "gpt_metrics.prom"
+    },
+    "Ledger Settings": {
+        "Enabled": True,
+        "Path": "gpt_ledger.jsonl",
+        "Session Budget": None,
+        "Daily Budget": None
+    },
+    "Retry Settings": {
+        "Max Attempts": 6,
+        "Max Elapsed": 120
+    },
+    "Cache Settings": {
+        "Enabled": True,
+        "Cache Sampled": False,
+        "TTL": 7 * 24 * 60 * 60,
+        "Path": "gpt_cache.sqlite3"
+    },
+    "History Settings": {
+        "Backend": "journal",
+        "Journal Path": "gpt_chat_history.jsonl",
+        "SQLite Path": "gpt_chat_history.sqlite3"
+    },
     "Menu": {
         "1": "Chat",
         "2": "Copilot",
         "3": "Export data",
+        "4": "Search history",
+        "5": "Metrics",
+        "6": "Usage and cost",
         "s": "Settings",
         "?": "Help",
         "x": "Exit"
@@ -57,8 +129,55 @@ class OpenAI:
         Initialize the ChatGPT instance.
         """
         self.api_key = OPENAI_API_KEY
+        self.keys = KeyPool.from_env()
         self.settings = DEFAULT_SETTINGS.copy()
-        self.history = []
+        history_settings = self.settings["History Settings"]
+        backend = history_settings["Backend"]
+        self.history = open_history(backend, history_settings["SQLite Path"] if backend == "sqlite"
+                                    else history_settings["Journal Path"])
+        client_settings = self.settings["Client Settings"]
+        cache_settings = self.settings["Cache Settings"]
+        self.cache = None
+        if cache_settings["Enabled"]:
+            self.cache = ResponseCache(cache_settings["Path"], ttl=cache_settings["TTL"],
+                                       cache_sampled=cache_settings["Cache Sampled"])
+        self.hedge = None
+        if client_settings["Hedge Requests"]:
+            self.hedge = HedgePolicy(max_hedge_ratio=client_settings["Hedge Budget"],
+                                     max_hedge_cost=client_settings["Hedge Spend Cap"])
+        retry_settings = self.settings["Retry Settings"]
+        retry = RetryPolicy(max_attempts=retry_settings["Max Attempts"],
+                            max_elapsed=retry_settings["Max Elapsed"])
+        self.batcher = None
+        backend = OpenAIBackend(api_base=client_settings["API Base"])
+        cassette_settings = self.settings["Cassette Settings"]
+        if cassette_settings["Mode"] == "record":
+            backend = Recorder(backend, Cassette(cassette_settings["Path"]))
+        elif cassette_settings["Mode"] == "replay":
+            backend = Player(Cassette(cassette_settings["Path"]), realtime=cassette_settings["Realtime"])
+        if client_settings["Micro Batching"]:
+            backend = self.batcher = MicroBatcher(backend, window=client_settings["Batch Window"],
+                                                  max_batch=client_settings["Max Batch"])
+        metrics_settings = self.settings["Metrics Settings"]
+        self.metrics = None
+        if metrics_settings["Enabled"]:
+            self.metrics = Metrics()
+            if metrics_settings["Port"]:
+                self.metrics.serve(metrics_settings["Port"])
+        ledger_settings = self.settings["Ledger Settings"]
+        self.ledger = None
+        if ledger_settings["Enabled"]:
+            self.ledger = Ledger(ledger_settings["Path"], session_budget=ledger_settings["Session Budget"],
+                                 daily_budget=ledger_settings["Daily Budget"])
+        self.client = AsyncClient(backend=backend, max_concurrency=client_settings["Max Concurrency"],
+                                  timeout=client_settings["Timeout"], cache=self.cache, retry=retry,
+                                  limiter=RateLimiter(), keys=self.keys, hedge=self.hedge,
+                                  metrics=self.metrics, ledger=self.ledger)
+        router_settings = self.settings["Router Settings"]
+        self.router = ModelRouter(self.client, MODELS, policy=router_settings["Policy"],
+                                  min_quality=router_settings["Min Quality"],
+                                  log_path=router_settings["Log Path"])
+        self.fanout = FanOut(self.client)
 
     def prompt_user(self, message):
         """
@@ -74,12 +193,14 @@ class OpenAI:
 
     def check_api_key(self):
         """
-        Check the API key and set it for the OpenAI library.
+        Check that the key pool has a usable key, prompting for one if not.
         """
-        while not self.api_key:
+        while not self.keys.available():
             print("API Key not found.")
             self.api_key = self.prompt_user("Please enter your OpenAI API Key: ")
-        openai.api_key = self.api_key
+            if self.api_key:
+                self.keys.add(self.api_key)
+        openai.api_key = self.keys.available()[0].key
 
     def chat(self, copilot=False):
         """
@@ -87,7 +208,9 @@ class OpenAI:
         """
         self.check_api_key()
         model_name = self.settings['Model']
-        model_value = MODELS[model_name]
+        # "Auto" lets the router pick an engine for each query
+        auto = model_name == AUTO
+        model_value = f"{self.router.policy} routing" if auto else MODELS[model_name]
         header = "Copilot" if copilot else "Chatting"
         print(f'\n{header} with {model_name} ({model_value})')
 
@@ -95,6 +218,9 @@ class OpenAI:
             query = self.prompt_user("\nEnter your query ('f' to submit by file or 'x' to exit): ")
             if query.lower() == 'f':
                 json_query = self.prompt_user("Enter the path to JSON file: ")
+                if json_query.endswith(".jsonl"):
+                    self.run_batch(json_query)
+                    continue
                 try:
                     with open(json_query, 'r') as file:
                         data = json.load(file)
@@ -107,21 +233,117 @@ class OpenAI:
             role = self.settings["Query Settings"]["Role"]
             prompt = f"{role}: {query}"
             query_settings = self.settings["Query Settings"]
+            if self.settings["Fan-out Settings"]["Mode"] != "off":
+                self.fan_out(query, prompt, copilot)
+                continue
             try:
-                response = openai.Completion.create(
-                    engine=model_value,
-                    prompt=prompt,
-                    max_tokens=query_settings["Max Tokens"],
-                    temperature=query_settings["Temperature"]
-                )
-                response_text = response.choices[0].text.strip()
-                self.history.append({"query": query, "response": response_text,
-                                     "copilot_response": response_text if copilot else ""})
-                print(f"\n{response_text}")
-            except openai.error.APIError as e:
+                on_token = self.print_token if query_settings["Stream"] else None
+                if auto:
+                    request = self.router.complete(prompt, query_settings["Max Tokens"],
+                                                   query_settings["Temperature"], on_token=on_token)
+                else:
+                    request = self.client.complete(model_value, prompt, query_settings["Max Tokens"],
+                                                   query_settings["Temperature"], on_token=on_token)
+                if query_settings["Stream"]:
+                    print()
+                    result = self.client.run(request)
+                    print()
+                else:
+                    result = self.client.run(request)
+                    print(f"\n{result['text']}")
+                response_text = result["text"]
+                self.history.append({"timestamp": datetime.now().isoformat(),
+                                     "model": result.get("model", model_value),
+                                     "copilot": copilot, "query": query, "response": response_text,
+                                     "prompt_tokens": count_tokens(prompt),
+                                     "completion_tokens": result["usage"].get("completion_tokens")
+                                     or count_tokens(response_text),
+                                     "copilot_response": response_text if copilot else "",
+                                     "ttft": result["ttft"]})
+            except asyncio.TimeoutError:
+                print("\nRequest timed out. Please try again.")
+            except (BudgetExceeded, CassetteMiss) as e:
+                print(f"\n{e}")
+            except openai.error.OpenAIError as e:
                 print(f"\nOpenAI API Error: {e}")
-                self.api_key = ""
-                self.check_api_key()
+                # Transient errors were already retried; only a bad key needs the user
+                if classify(e) == AUTH:
+                    self.api_key = ""
+                    self.check_api_key()
+
+    def fan_out(self, query, prompt, copilot=False):
+        """
+        Send a query to several models at once and print the answers.
+
+        In race mode only the first acceptable answer is printed; in compare
+        mode every answer is. Each answer is saved with its model's latency.
+
+        Args:
+            query (str): The user's query.
+            prompt (str): The prompt sent to the models.
+            copilot (bool): Whether the query came from copilot mode.
+        """
+        fanout_settings = self.settings["Fan-out Settings"]
+        query_settings = self.settings["Query Settings"]
+        engines = [MODELS[name] for name in fanout_settings["Models"]]
+        try:
+            answers = self.client.run(self.fanout.run(fanout_settings["Mode"], engines, prompt,
+                                                      query_settings["Max Tokens"],
+                                                      query_settings["Temperature"]))
+        except ValueError as e:
+            print(f"\n{e}")
+            return
+        latencies = answers[0].get("latencies") or {a["model"]: a["latency"] for a in answers}
+        for answer in answers:
+            print(f"\n[{answer['model']}, {answer['latency']:.2f}s]")
+            print(answer["text"] if answer["error"] is None else f"Error: {answer['error']}")
+            if answer["error"] is not None:
+                continue
+            self.history.append({"timestamp": datetime.now().isoformat(), "model": answer["model"],
+                                 "copilot": copilot, "query": query, "response": answer["text"],
+                                 "prompt_tokens": count_tokens(prompt),
+                                 "completion_tokens": answer["usage"].get("completion_tokens")
+                                 or count_tokens(answer["text"]),
+                                 "copilot_response": answer["text"] if copilot else "",
+                                 "ttft": answer["ttft"], "latency": answer["latency"],
+                                 "fanout": fanout_settings["Mode"], "latencies": latencies})
+
+    def run_batch(self, input_path):
+        """
+        Run a JSONL file of queries and write the results next to it.
+
+        Args:
+            input_path (str): The path to the JSONL file.
+        """
+        output_path = input_path[:-len(".jsonl")] + "_results.jsonl"
+        query_settings = self.settings["Query Settings"]
+        defaults = {"model": self.settings["Model"], "max_tokens": query_settings["Max Tokens"],
+                    "temperature": query_settings["Temperature"], "role": query_settings["Role"]}
+        runner = BatchRunner(self.client, defaults, MODELS,
+                             concurrency=self.settings["Client Settings"]["Max Concurrency"],
+                             router=self.router)
+        resume = True
+        if os.path.exists(checkpoint_path(output_path)):
+            resume = self.prompt_user("Resume the previous run of this batch? (y/n): ").lower() != "n"
+        try:
+            self.client.run(runner.run(input_path, output_path, resume=resume))
+        except (json.JSONDecodeError, FileNotFoundError):
+            print("Invalid JSONL file. Please try again.")
+            return
+        print(f"\nBatch results written to {output_path}")
+        if self.batcher is not None:
+            stats = self.batcher.stats()
+            print(f"Sent {stats['prompts']} prompts in {stats['batches']} requests "
+                  f"({stats['mean_batch']:.1f} per request)")
+
+    def print_token(self, token):
+        """
+        Print a streamed token as it arrives.
+
+        Args:
+            token (str): The token text.
+        """
+        print(token, end="", flush=True)
 
     def update_settings(self):
         """
@@ -129,8 +351,23 @@ class OpenAI:
         """
         print("\nWhich setting would you like to change?")
         self.display_settings(self.settings)
+        self.display_cache_stats()
+        self.display_hedge_stats()
+        self.display_router_stats()
         self.change_settings(self.prompt_user("Select setting to change [FIX NUMBERING]:"))
 
+    def display_cache_stats(self):
+        """
+        Display the response cache hit and miss counters.
+        """
+        if self.cache is None:
+            print("\nCache: disabled")
+            return
+        stats = self.cache.stats()
+        print(f"\nCache: {stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, "
+              f"{stats['misses']} misses, {stats['skipped']} skipped "
+              f"({stats['hit_rate']:.0%} hit rate)")
+
     def display_settings(self, settings, indices=None):
         """
         Display the current chat settings.
@@ -165,16 +402,92 @@ class OpenAI:
         self.display_settings(settings)
         self.change_settings(settings)
 
+    def display_hedge_stats(self):
+        """
+        Display the hedge rate, latency saved and hedge spend per model.
+        """
+        if self.hedge is None:
+            return
+        for model, stats in self.hedge.stats().items():
+            print(f"Hedging {model}: {stats['hedges']}/{stats['requests']} hedged "
+                  f"({stats['hedge_rate']:.1%}), {stats['wins']} won, ~{stats['saved']:.2f}s saved, "
+                  f"{stats['wasted_tokens']} tokens (${stats['wasted_cost']:.4f}) on cancelled copies")
+
+    def display_router_stats(self):
+        """
+        Display the latency, error rate and price the router has seen per engine.
+        """
+        for stats in self.router.report():
+            if not stats["requests"]:
+                continue
+            latency = f"{stats['latency']:.2f}s" if stats["latency"] is not None else "n/a"
+            print(f"Routing {stats['engine']}: {stats['requests']} requests, {latency} avg, "
+                  f"{stats['error_rate']:.0%} errors, ${stats['price'][0]}/${stats['price'][1]} "
+                  f"per 1K prompt/completion tokens"
+                  f"{' (degraded)' if stats['degraded'] else ''}")
+
     def export_data(self):
         """
         Export the chat history to a file.
         """
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"gpt_chat_export_{timestamp}.json"
-        with open(filename, 'w') as f:
-            json.dump(self.history, f)
+        filename = f"gpt_chat_export_{timestamp}{self.history.extension}"
+        self.history.export(filename)
         print(f"\nChat history exported to {filename}")
 
+    def search_history(self):
+        """
+        Search past conversations and print the matches.
+        """
+        text = self.prompt_user("Enter words to search for: ")
+        print_results(self.history.search(text))
+
+    def display_metrics(self):
+        """
+        Display per-model latency and token metrics and write them to the dump file.
+        """
+        if self.metrics is None:
+            print("\nMetrics: disabled")
+            return
+        rows = self.metrics.summary()
+        if not rows:
+            print("\nNo requests yet.")
+        for row in rows:
+            latency = "n/a" if row["p50"] is None else \
+                f"p50 {row['p50']:.2f}s, p95 {row['p95']:.2f}s, p99 {row['p99']:.2f}s"
+            ttft = "n/a" if row["ttft_p50"] is None else f"{row['ttft_p50']:.2f}s"
+            print(f"\n{row['model']}: {row['requests']} requests, {row['errors']} errors")
+            print(f"  Latency: {latency}; first token p50 {ttft}")
+            print(f"  Tokens: {row['prompt_tokens']} in, {row['completion_tokens']} out")
+        self.display_cache_stats()
+        retry = self.client.retry.counters
+        print(f"Retries: {retry['retries']} ({retry['rate_limited']} rate limited, {retry['gave_up']} gave up); "
+              f"queued: {self.client.queued}")
+        path = self.settings["Metrics Settings"]["Dump Path"]
+        self.metrics.dump(path)
+        print(f"Metrics written to {path}")
+
+    def display_usage(self):
+        """
+        Display token use and cost per session, model, API key and day.
+        """
+        if self.ledger is None:
+            print("\nLedger: disabled")
+            return
+        for dimension in ("session", "model", "key", "day"):
+            totals = self.ledger.rollup(dimension)
+            if not totals:
+                continue
+            print(f"\nBy {dimension}:")
+            for name, row in sorted(totals.items()):
+                print(f"  {name}: {row['requests']} calls, {row['prompt_tokens']} prompt + "
+                      f"{row['completion_tokens']} completion tokens, ${row['cost']:.4f}")
+        session_budget = self.ledger.session_budget
+        daily_budget = self.ledger.daily_budget
+        print(f"\nThis session: ${self.ledger.spent('session', self.ledger.session):.4f} of "
+              f"{'no cap' if session_budget is None else f'${session_budget:.2f}'}; "
+              f"daily cap: {'none' if daily_budget is None else f'${daily_budget:.2f}'}")
+
     def display_help(self):
         """
         Display the help text.
@@ -183,6 +496,9 @@ class OpenAI:
         1. Chat: Initiate a chat with the selected GPT model.
         2. Copilot: Get code suggestions from the selected GPT model.
         3. Export data: Save the chat history to a file.
+        4. Search history: Find past queries and responses.
+        5. Metrics: Show latency, token and cache metrics.
+        6. Usage and cost: Show tokens and spending per session, model, key and day.
         s. Settings: Change the chat settings.
         ?. Help: Display this help text.
         x. Exit: Quit the application.
@@ -203,12 +519,28 @@ class OpenAI:
             self.chat(copilot=True)
         elif choice == "3":
             self.export_data()
+        elif choice == "4":
+            self.search_history()
+        elif choice == "5":
+            self.display_metrics()
+        elif choice == "6":
+            self.display_usage()
         elif choice == "s":
             self.update_settings()
         elif choice == "?":
             self.display_help()
         elif choice == "x":
             print("Exiting the program...")
+            self.client.close()
+            self.history.close()
+            self.router.close()
+            if self.cache is not None:
+                self.cache.close()
+            if self.metrics is not None:
+                self.metrics.dump(self.settings["Metrics Settings"]["Dump Path"])
+                self.metrics.close()
+            if self.ledger is not None:
+                self.ledger.close()
             exit()
         else:
             print("Invalid choice. Please try again.")            
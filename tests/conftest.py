@@ -0,0 +1,14 @@
+"""
+Test configuration for browseGPT
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: os, sys
+Licence: Please cite if used.
+"""
+
+import os
+import sys
+
+# The modules live at the repo root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
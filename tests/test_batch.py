@@ -0,0 +1,111 @@
+"""
+Tests for resumable JSONL batch runs
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, pytest, asyncio, json, batch, client
+Licence: Please cite if used.
+"""
+
+import asyncio
+import json
+
+import openai
+
+from batch import BatchRunner, checkpoint_path
+from client import AsyncClient
+
+DEFAULTS = {"model": "e", "max_tokens": 5, "temperature": 0, "role": None}
+
+
+class EchoBackend:
+    """
+    Backend that answers with the prompt, failing the prompts it is told to.
+    """
+
+    def __init__(self, failing=(), stop_after=None):
+        self.failing = set(failing)
+        self.stop_after = stop_after
+        self.calls = 0
+        self.stopped = asyncio.Event()
+
+    async def send(self, endpoint, params, on_token=None):
+        self.calls += 1
+        if self.stop_after is not None and self.calls > self.stop_after:
+            self.stopped.set()
+            await asyncio.Event().wait()
+        if params["prompt"] in self.failing:
+            raise openai.error.ServiceUnavailableError("busy")
+        return {"text": params["prompt"].upper(), "usage": {"prompt_tokens": 1, "completion_tokens": 1},
+                "ttft": 0.0, "latency": 0.0}
+
+
+def write_queries(path, records):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+
+
+def read_results(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def run_batch(backend, input_path, output_path, resume=True):
+    runner = BatchRunner(AsyncClient(backend=backend), DEFAULTS, concurrency=2, progress_interval=60)
+    return asyncio.run(runner.run(str(input_path), str(output_path), resume=resume))
+
+
+def test_killed_run_resumes_without_duplicates(tmp_path):
+    queries = tmp_path / "queries.jsonl"
+    output = tmp_path / "results.jsonl"
+    write_queries(queries, [{"query": f"q{i}"} for i in range(10)])
+
+    async def killed_run():
+        backend = EchoBackend(stop_after=4)
+        runner = BatchRunner(AsyncClient(backend=backend), DEFAULTS, concurrency=2, progress_interval=60)
+        task = asyncio.ensure_future(runner.run(str(queries), str(output)))
+        await backend.stopped.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(killed_run())
+    # A result that reached the file but not the journal before the process died
+    with open(output, 'a') as f:
+        f.write(json.dumps({"id": 10, "query": "q9", "response": "Q9"}) + "\n")
+    assert 0 < len(read_results(output)) < 10
+
+    run_batch(EchoBackend(), queries, output)
+    results = read_results(output)
+    assert sorted(r["id"] for r in results) == list(range(1, 11))
+    assert all(r["response"] == r["query"].upper() for r in results)
+
+
+def test_failed_queries_are_retried_on_resume(tmp_path):
+    queries = tmp_path / "queries.jsonl"
+    output = tmp_path / "results.jsonl"
+    write_queries(queries, [{"query": "a"}, {"query": "b"}, {"query": "c"}])
+
+    summary = run_batch(EchoBackend(failing={"b"}), queries, output)
+    assert summary["failed"] == 1
+    assert [r["id"] for r in read_results(output) if "error" in r] == [2]
+
+    backend = EchoBackend()
+    summary = run_batch(backend, queries, output)
+    assert backend.calls == 1 and summary["skipped"] == 2 and summary["failed"] == 0
+    results = read_results(output)
+    assert sorted(r["id"] for r in results) == [1, 2, 3]
+    assert not any("error" in r for r in results)
+    with open(checkpoint_path(str(output))) as f:
+        assert len(f.readlines()) == 3
+
+
+def test_explicit_ids_do_not_collide_with_line_numbers(tmp_path):
+    queries = tmp_path / "queries.jsonl"
+    output = tmp_path / "results.jsonl"
+    # The first query's explicit ID 2 is also the second query's line number
+    write_queries(queries, [{"id": 2, "query": "x"}, {"query": "y"}])
+
+    run_batch(EchoBackend(failing={"y"}), queries, output)
+    backend = EchoBackend()
+    run_batch(backend, queries, output)
+    assert backend.calls == 1
+    results = read_results(output)
+    assert sorted((r["id"], r["response"]) for r in results) == [(2, "X"), (2, "Y")]
@@ -0,0 +1,139 @@
+"""
+Tests for prompt micro-batching
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, pytest, asyncio, batcher, client
+Licence: Please cite if used.
+"""
+
+import asyncio
+
+import openai
+
+from batcher import MicroBatcher, split_usage
+from client import OpenAIBackend
+
+PARAMS = {"engine": "e", "max_tokens": 5, "temperature": 0}
+
+
+class RecordingBackend:
+    """
+    Backend that answers each prompt with its upper-cased text and records every call.
+    """
+
+    def __init__(self):
+        self.sends = []
+        self.batches = []
+
+    async def send(self, endpoint, params, on_token=None):
+        self.sends.append((endpoint, params))
+        text = params["prompt"].upper() if endpoint == "completion" else "chat"
+        return {"text": text, "usage": {"prompt_tokens": 1, "completion_tokens": 1}, "ttft": 0.0, "latency": 0.0}
+
+    async def send_batch(self, params):
+        self.batches.append(params["prompt"])
+        results = [{"text": prompt.upper(), "usage": {}, "ttft": 0.0, "latency": 0.0} for prompt in params["prompt"]]
+        return results, {"prompt_tokens": 10 * len(results), "completion_tokens": 20 * len(results)}
+
+
+def send_all(batcher, prompts, params=PARAMS):
+    async def scenario():
+        return await asyncio.gather(*[batcher.send("completion", dict(params, prompt=prompt))
+                                      for prompt in prompts])
+    return asyncio.run(scenario())
+
+
+def test_prompts_in_one_window_share_a_request():
+    backend = RecordingBackend()
+    batcher = MicroBatcher(backend, window=0.01)
+    results = send_all(batcher, ["one", "two", "three"])
+    assert backend.batches == [["one", "two", "three"]] and not backend.sends
+    assert [r["text"] for r in results] == ["ONE", "TWO", "THREE"]
+    assert batcher.stats() == {"prompts": 3, "batches": 1, "mean_batch": 3.0}
+
+
+def test_full_batches_are_sent_without_waiting():
+    backend = RecordingBackend()
+    batcher = MicroBatcher(backend, window=10, max_batch=2)
+
+    async def scenario():
+        return await asyncio.wait_for(asyncio.gather(
+            *[batcher.send("completion", dict(PARAMS, prompt=str(i))) for i in range(4)]), 1)
+
+    results = asyncio.run(scenario())
+    assert backend.batches == [["0", "1"], ["2", "3"]]
+    assert [r["text"] for r in results] == ["0", "1", "2", "3"]
+
+
+def test_lone_prompt_uses_a_plain_request():
+    backend = RecordingBackend()
+    batcher = MicroBatcher(backend, window=0.01)
+    results = send_all(batcher, ["solo"])
+    assert not backend.batches and [p["prompt"] for _, p in backend.sends] == ["solo"]
+    assert results[0]["text"] == "SOLO"
+
+
+def test_different_settings_are_not_batched_together():
+    backend = RecordingBackend()
+    batcher = MicroBatcher(backend, window=0.01)
+
+    async def scenario():
+        return await asyncio.gather(*[batcher.send("completion", dict(PARAMS, prompt=prompt, temperature=t))
+                                      for prompt, t in [("a", 0), ("b", 1), ("c", 0), ("d", 1)]])
+
+    results = asyncio.run(scenario())
+    assert sorted(backend.batches) == [["a", "c"], ["b", "d"]]
+    assert [r["text"] for r in results] == ["A", "B", "C", "D"]
+
+
+def test_chat_and_streaming_pass_through():
+    backend = RecordingBackend()
+    batcher = MicroBatcher(backend, window=0.01)
+
+    async def scenario():
+        await batcher.send("chat", {"model": "m", "messages": []})
+        await batcher.send("completion", dict(PARAMS, prompt="p"), on_token=lambda token: None)
+
+    asyncio.run(scenario())
+    assert [endpoint for endpoint, _ in backend.sends] == ["chat", "completion"]
+    assert not backend.batches and batcher.stats()["prompts"] == 0
+
+
+def test_batch_usage_is_split_by_prompt_and_completion_size():
+    results = send_all(MicroBatcher(RecordingBackend(), window=0.01), ["a", "a b c"])
+    usages = [r["usage"] for r in results]
+    assert sum(u["prompt_tokens"] for u in usages) == 20
+    assert sum(u["completion_tokens"] for u in usages) == 40
+    assert usages[0]["prompt_tokens"] < usages[1]["prompt_tokens"]
+    assert all(u["total_tokens"] == u["prompt_tokens"] + u["completion_tokens"] for u in usages)
+
+
+def test_split_usage_counts_locally_without_a_usage_block():
+    split = split_usage({}, ["hello world", "hi"], ["yes", "no thanks"])
+    assert [u["prompt_tokens"] for u in split] == [2, 1]
+    assert [u["completion_tokens"] for u in split] == [1, 2]
+
+
+class Choice:
+    def __init__(self, index, text):
+        self.index = index
+        self.text = text
+
+
+class Response(dict):
+    def __init__(self, choices, usage):
+        super().__init__(usage=usage)
+        self.choices = choices
+
+
+def test_openai_choices_are_mapped_back_by_index(monkeypatch):
+    async def acreate(**params):
+        return Response([Choice(2, " c"), Choice(0, " a"), Choice(1, " b")], {"prompt_tokens": 3})
+
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+    backend = OpenAIBackend()
+    monkeypatch.setattr(backend, "get_session", lambda: None)
+    results, usage = asyncio.run(backend.send_batch(dict(PARAMS, prompt=["x", "y", "z"])))
+    assert [r["text"] for r in results] == ["a", "b", "c"]
+    assert usage == {"prompt_tokens": 3}
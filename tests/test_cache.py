@@ -0,0 +1,116 @@
+"""
+Tests for the response cache
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: pytest, asyncio, cache, client
+Licence: Please cite if used.
+"""
+
+import asyncio
+
+import pytest
+
+import cache
+from cache import ResponseCache
+from client import AsyncClient
+
+PARAMS = {"engine": "e", "prompt": "p", "max_tokens": 5, "temperature": 0}
+
+
+class Clock:
+    """
+    Stand-in for the time module with a clock the test moves by hand.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_entries_expire_after_ttl(tmp_path, clock, on_disk):
+    responses = ResponseCache(str(tmp_path / "cache.sqlite3") if on_disk else None, ttl=60)
+    key = responses.make_key("completion", PARAMS)
+    responses.put(key, {"text": "hi"})
+    clock.now += 59
+    assert responses.get(key) == {"text": "hi"}
+    clock.now += 2
+    assert responses.get(key) is None
+    assert responses.stats()["misses"] == 1
+    responses.close()
+
+
+def test_disk_tier_outlives_the_memory_tier(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    responses = ResponseCache(path)
+    key = responses.make_key("completion", PARAMS)
+    responses.put(key, {"text": "hi"})
+    responses.close()
+    responses = ResponseCache(path)
+    assert responses.get(key) == {"text": "hi"}
+    assert responses.get(key) == {"text": "hi"}
+    assert (responses.counters["disk_hits"], responses.counters["memory_hits"]) == (1, 1)
+    responses.close()
+
+
+def test_memory_tier_drops_least_recently_used(clock):
+    responses = ResponseCache(None, max_memory_items=2)
+    responses.put("a", 1)
+    responses.put("b", 2)
+    responses.get("a")
+    responses.put("c", 3)
+    assert list(responses.memory) == ["a", "c"]
+    assert responses.get("b") is None
+
+
+def test_disk_tier_is_trimmed_to_its_limit(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(cache, "EVICT_EVERY", 5)
+    responses = ResponseCache(str(tmp_path / "cache.sqlite3"), max_memory_items=1, max_disk_items=3)
+    for i in range(5):
+        clock.now += 1
+        responses.put(str(i), i)
+    rows = [row[0] for row in responses.db.execute("SELECT key FROM responses ORDER BY key")]
+    assert rows == ["2", "3", "4"]
+    responses.close()
+
+
+def test_sampled_requests_bypass_the_cache():
+    responses = ResponseCache(None)
+    assert responses.make_key("completion", dict(PARAMS, temperature=0.7)) is None
+    assert responses.stats()["skipped"] == 1
+    assert ResponseCache(None, cache_sampled=True).make_key("completion", dict(PARAMS, temperature=0.7))
+
+
+class CountingBackend:
+    def __init__(self):
+        self.calls = 0
+
+    async def send(self, endpoint, params, on_token=None):
+        self.calls += 1
+        return {"text": f"answer {self.calls}", "usage": {"prompt_tokens": 1, "completion_tokens": 2},
+                "ttft": 0.0, "latency": 0.0}
+
+
+@pytest.mark.parametrize("temperature, calls", [(0, 1), (0.7, 2)])
+def test_client_only_reuses_deterministic_answers(temperature, calls):
+    backend = CountingBackend()
+    client = AsyncClient(backend=backend, cache=ResponseCache(None))
+
+    async def scenario():
+        first = await client.complete("e", "p", 5, temperature)
+        second = await client.complete("e", "p", 5, temperature)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert backend.calls == calls
+    assert second.get("cached", False) == (calls == 1)
@@ -0,0 +1,112 @@
+"""
+Tests for request coalescing in the asyncio client
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, pytest, asyncio, client
+Licence: Please cite if used.
+"""
+
+import asyncio
+
+import openai
+import pytest
+
+from client import AsyncClient
+
+
+class GatedBackend:
+    """
+    Backend whose requests stream one token, then wait to be released.
+    """
+
+    def __init__(self, error=None):
+        self.calls = 0
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        self.error = error
+
+    async def send(self, endpoint, params, on_token=None):
+        self.calls += 1
+        if on_token is not None:
+            on_token("Hello")
+        self.started.set()
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        if on_token is not None:
+            on_token(" world")
+        return {"text": "Hello world", "usage": {"prompt_tokens": 1, "completion_tokens": 2},
+                "ttft": 0.0, "latency": 0.0}
+
+
+def test_cancelled_leader_leaves_followers_running():
+    async def scenario():
+        backend = GatedBackend()
+        client = AsyncClient(backend=backend)
+        leader = asyncio.ensure_future(client.complete("e", "p", 5, 0))
+        await backend.started.wait()
+        follower = asyncio.ensure_future(client.complete("e", "p", 5, 0))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        backend.release.set()
+        result = await follower
+        assert leader.cancelled()
+        assert result["text"] == "Hello world" and result["coalesced"]
+        assert backend.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_request_is_cancelled_when_every_caller_leaves():
+    async def scenario():
+        backend = GatedBackend()
+        client = AsyncClient(backend=backend)
+        callers = [asyncio.ensure_future(client.complete("e", "p", 5, 0)) for _ in range(2)]
+        await backend.started.wait()
+        await asyncio.sleep(0)
+        flight = next(iter(client.inflight.values()))
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        with pytest.raises(asyncio.CancelledError):
+            await flight.task
+        assert not client.inflight
+
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_caller():
+    async def scenario():
+        backend = GatedBackend(error=openai.error.InvalidRequestError("bad", None))
+        client = AsyncClient(backend=backend)
+        callers = [asyncio.ensure_future(client.complete("e", "p", 5, 0)) for _ in range(3)]
+        await backend.started.wait()
+        await asyncio.sleep(0)
+        backend.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert all(isinstance(r, openai.error.InvalidRequestError) for r in results)
+        assert backend.calls == 1 and client.coalesced == 2
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("leader_streams", [True, False])
+def test_streaming_follower_gets_every_token(leader_streams):
+    async def scenario():
+        backend = GatedBackend()
+        client = AsyncClient(backend=backend)
+        leader_tokens, follower_tokens = [], []
+        leader = asyncio.ensure_future(client.complete(
+            "e", "p", 5, 0, on_token=leader_tokens.append if leader_streams else None))
+        await backend.started.wait()
+        follower = asyncio.ensure_future(client.complete("e", "p", 5, 0, on_token=follower_tokens.append))
+        await asyncio.sleep(0)
+        backend.release.set()
+        await asyncio.gather(leader, follower)
+        assert "".join(follower_tokens) == "Hello world"
+        if leader_streams:
+            assert leader_tokens == ["Hello", " world"]
+
+    asyncio.run(scenario())
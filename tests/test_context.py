@@ -0,0 +1,116 @@
+"""
+Tests for the token-budgeted context window
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: pytest, concurrent.futures.Future, context
+Licence: Please cite if used.
+"""
+
+from concurrent.futures import Future
+
+from context import SUMMARY_PROMPT, ContextWindow, SummarizingContext, count_message, summary_messages
+
+
+def make_window(budget, turns=6):
+    window = ContextWindow(budget)
+    window.add("system", "You are a helpful assistant.")
+    for i in range(turns):
+        window.add("user" if i % 2 == 0 else "assistant", f"turn number {i}")
+    return window
+
+
+def test_everything_fits_under_a_large_budget():
+    window = make_window(10000)
+    assert window.window() == window.messages
+    assert window.total_tokens() == sum(count_message(m) for m in window.messages)
+
+
+def test_window_keeps_system_messages_and_newest_turns():
+    window = make_window(1000)
+    per_turn = count_message(window[1])
+    budget = window.system_tokens + 2 * per_turn
+    sent = window.window(budget)
+    assert sent == [window[0], window[-2], window[-1]]
+    assert sum(count_message(m) for m in sent) <= budget
+
+
+def test_latest_turn_is_sent_even_over_budget():
+    window = make_window(1000)
+    window.add("user", "a long question " * 50)
+    sent = window.window(10)
+    assert sent == [window[0], window[-1]]
+
+
+def test_system_messages_later_in_the_chat_are_kept_in_order():
+    window = make_window(1000, turns=4)
+    window.add("system", "Answer in French.")
+    window.add("user", "latest")
+    budget = window.system_tokens + count_message(window[-1])
+    sent = window.window(budget)
+    assert [m["content"] for m in sent] == ["You are a helpful assistant.", "Answer in French.", "latest"]
+
+
+class Summarizer:
+    """
+    Summarize callable whose futures the test resolves by hand.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, summary, turns):
+        future = Future()
+        self.calls.append((summary, [turn["content"] for turn in turns], future))
+        return future
+
+
+def turn(i):
+    return f"turn {i} " + "word " * 10
+
+
+def make_summarizing(turns):
+    summarize = Summarizer()
+    system = {"role": "system", "content": "You are a helpful assistant."}
+    summary = {"role": "system", "content": "Summary of the earlier conversation: They counted."}
+    # Room for the system message, a summary and two turns, but not three turns
+    budget = count_message(system) + count_message(summary) + 2 * count_message({"role": "user", "content": turn(0)})
+    context = SummarizingContext(summarize, budget=budget, compact_every=2, messages=[system])
+    for i in range(turns):
+        context.add("user", turn(i))
+    return summarize, context
+
+
+def test_turns_leaving_the_window_are_summarized_in_the_background():
+    summarize, context = make_summarizing(6)
+    assert [(summary, turns) for summary, turns, _ in summarize.calls] == [(None, [turn(0), turn(1)])]
+    # Not done yet, so the plain window is sent
+    assert [m["content"] for m in context.window()] == ["You are a helpful assistant.", turn(4), turn(5)]
+    summarize.calls[0][2].set_result("They counted.")
+    sent = context.window()
+    assert sent[0] == context[0]
+    assert sent[1] == {"role": "system", "content": "Summary of the earlier conversation: They counted."}
+    assert [m["content"] for m in sent[2:]] == [turn(4), turn(5)]
+
+
+def test_later_folds_build_on_the_summary_so_far():
+    summarize, context = make_summarizing(6)
+    summarize.calls[0][2].set_result("First.")
+    context.add("user", turn(6))
+    assert [(summary, turns) for summary, turns, _ in summarize.calls[1:]] == [("First.", [turn(2), turn(3)])]
+
+
+def test_failed_summary_is_retried_with_the_same_turns():
+    summarize, context = make_summarizing(6)
+    summarize.calls[0][2].set_exception(RuntimeError("down"))
+    context.compact()
+    assert context.summary is None
+    assert [(summary, turns) for summary, turns, _ in summarize.calls] == [
+        (None, [turn(0), turn(1)]), (None, [turn(0), turn(1)])]
+
+
+def test_summary_messages_fold_turns_into_the_summary():
+    messages = summary_messages("Old.", [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "yo"}])
+    assert messages[0] == {"role": "system", "content": SUMMARY_PROMPT}
+    assert messages[1]["content"] == "Summary so far: Old.\n\nuser: hi\nassistant: yo"
+    assert summary_messages(None, [{"role": "user", "content": "hi"}])[1]["content"] == "user: hi"
@@ -0,0 +1,85 @@
+"""
+Tests for hedged requests
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: pytest, asyncio, client, hedge, ledger, tokenizer
+Licence: Please cite if used.
+"""
+
+import asyncio
+
+from client import AsyncClient
+from hedge import MIN_SAMPLES, HedgePolicy
+from ledger import Ledger
+from tokenizer import count_tokens
+
+PRICES = {"m": (1.0, 2.0)}
+
+
+class SlowPrimaryBackend:
+    """
+    Backend whose first call is slow to stream and whose second call is fast.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    async def send(self, endpoint, params, on_token=None):
+        self.calls += 1
+        if self.calls == 1:
+            await asyncio.sleep(0.2)
+            on_token(" late")
+            await asyncio.sleep(5)
+        else:
+            on_token("fast")
+            await asyncio.sleep(0.4)
+        return {"text": "fast", "usage": {}, "ttft": 0.0, "latency": 0.4}
+
+
+def make_hedge(**kwargs):
+    hedge = HedgePolicy(prices=PRICES, **kwargs)
+    for _ in range(MIN_SAMPLES):
+        hedge.tracker.record("m", 0.01)
+    return hedge
+
+
+def test_cancelled_copy_is_billed_and_counted():
+    async def scenario():
+        backend = SlowPrimaryBackend()
+        hedge = make_hedge()
+        ledger = Ledger(None, prices=PRICES)
+        client = AsyncClient(backend=backend, hedge=hedge, ledger=ledger)
+        tokens = []
+        result = await client.complete("m", "Hello there", 5, 0, on_token=tokens.append)
+        return backend, hedge, ledger, result, tokens
+
+    backend, hedge, ledger, result, tokens = asyncio.run(scenario())
+    assert backend.calls == 2 and tokens == ["fast"]
+    prompt_tokens = result["usage"]["prompt_tokens"]
+    wasted = prompt_tokens + count_tokens(" late")
+    stats = hedge.stats()["m"]
+    assert stats["hedges"] == 1 and stats["wins"] == 1 and stats["hedge_rate"] == 1.0
+    assert stats["wasted_tokens"] == wasted
+    assert stats["wasted_cost"] == (prompt_tokens * 1.0 + count_tokens(" late") * 2.0) / 1000
+    totals = ledger.rollup("model")["m"]
+    assert totals["requests"] == 2
+    assert totals["prompt_tokens"] == 2 * prompt_tokens
+    assert totals["completion_tokens"] == result["usage"]["completion_tokens"] + count_tokens(" late")
+    assert ledger.reserved == 0.0
+
+
+def test_spend_cap_stops_hedging():
+    async def scenario():
+        backend = SlowPrimaryBackend()
+        hedge = make_hedge(max_hedge_cost=0.0)
+        client = AsyncClient(backend=backend, hedge=hedge)
+        try:
+            await asyncio.wait_for(client.complete("m", "Hello there", 5, 0, on_token=lambda token: None), 0.3)
+        except asyncio.TimeoutError:
+            pass
+        return backend, hedge
+
+    backend, hedge = asyncio.run(scenario())
+    assert backend.calls == 1
+    assert hedge.stats()["m"]["hedges"] == 0
@@ -0,0 +1,73 @@
+"""
+Tests for the API key pool
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: pytest, keypool, ledger
+Licence: Please cite if used.
+"""
+
+import asyncio
+
+import pytest
+
+from keypool import KeyPool, NoKeyAvailable
+from ledger import Ledger
+
+
+def test_from_env_reads_organization_and_quota(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEYS", "sk-one, sk-two:org-2, sk-three:org-3:50000, sk-four::1000")
+    keys = KeyPool.from_env().keys
+    assert [(k.key, k.organization, k.quota) for k in keys] == [
+        ("sk-one", None, None),
+        ("sk-two", "org-2", None),
+        ("sk-three", "org-3", 50000),
+        ("sk-four", None, 1000),
+    ]
+
+
+def test_from_env_falls_back_to_single_key(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEYS", raising=False)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-only")
+    keys = KeyPool.from_env().keys
+    assert [(k.key, k.organization, k.quota) for k in keys] == [("sk-only", None, None)]
+
+
+def test_quota_from_env_caps_the_key(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEYS", "sk-capped::100")
+    pool = KeyPool.from_env()
+    key = asyncio.run(pool.acquire())
+    pool.release(key, usage={"total_tokens": 100})
+    assert not key.under_quota()
+    with pytest.raises(NoKeyAvailable):
+        asyncio.run(pool.acquire())
+
+
+def test_from_env_rejects_bad_quota(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEYS", "sk-one:org:lots")
+    with pytest.raises(ValueError):
+        KeyPool.from_env()
+
+
+def test_quota_usage_is_loaded_from_the_ledger(monkeypatch, tmp_path):
+    monkeypatch.setenv("OPENAI_API_KEYS", "sk-capped::100,sk-other::100")
+    ledger = Ledger(str(tmp_path / "ledger.jsonl"))
+    ledger.record("text-davinci-003", {"prompt_tokens": 60, "completion_tokens": 40}, key="...pped")
+    ledger.close()
+    ledger = Ledger(str(tmp_path / "ledger.jsonl"))
+    pool = KeyPool.from_env()
+    pool.load_usage(ledger)
+    ledger.close()
+    assert [(k.name, k.tokens) for k in pool.keys] == [("...pped", 100), ("...ther", 0)]
+    assert [k.name for k in pool.available()] == ["...ther"]
+
+
+def test_quota_resets_each_day(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEYS", "sk-capped::100")
+    pool = KeyPool.from_env()
+    key = asyncio.run(pool.acquire())
+    pool.release(key, usage={"total_tokens": 100})
+    assert not key.under_quota()
+    key.day = "2000-01-01"
+    assert key.under_quota()
+    assert key.tokens == 0
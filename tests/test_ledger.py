@@ -0,0 +1,77 @@
+"""
+Tests for the token and cost ledger
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: pytest, json, ledger
+Licence: Please cite if used.
+"""
+
+import json
+
+from ledger import Ledger
+
+PRICES = {"m": (1.0, 1.0)}
+USAGE = {"prompt_tokens": 10, "completion_tokens": 5}
+
+
+def test_two_ledgers_on_one_file_count_every_entry_once(tmp_path):
+    path = str(tmp_path / "ledger.jsonl")
+    first = Ledger(path, prices=PRICES, session="first")
+    second = Ledger(path, prices=PRICES, session="second")
+    for _ in range(3):
+        first.record("m", USAGE)
+        second.record("m", USAGE)
+    second.record("m", USAGE)
+    for ledger in (first, second):
+        assert ledger.rollup("model")["m"]["requests"] == 7
+        assert ledger.rollup("session")["first"]["requests"] == 3
+        assert ledger.rollup("session")["second"]["requests"] == 4
+    first.close()
+    second.close()
+    reopened = Ledger(path, prices=PRICES)
+    assert reopened.rollup("model")["m"] == {"requests": 7, "prompt_tokens": 70, "completion_tokens": 35,
+                                             "cost": 7 * 15 / 1000}
+    reopened.close()
+
+
+def test_stale_ledger_does_not_move_coverage_back(tmp_path):
+    path = str(tmp_path / "ledger.jsonl")
+    first = Ledger(path, prices=PRICES)
+    second = Ledger(path, prices=PRICES)
+    first.record("m", USAGE)
+    first.record("m", USAGE)
+    second.cover(0)
+    second.db.commit()
+    second.catch_up()
+    assert second.rollup("model")["m"]["requests"] == 2
+    first.close()
+    second.close()
+
+
+def test_truncated_ledger_is_replayed_from_the_start(tmp_path):
+    path = str(tmp_path / "ledger.jsonl")
+    ledger = Ledger(path, prices=PRICES)
+    ledger.record("m", USAGE)
+    ledger.record("m", USAGE)
+    ledger.close()
+    with open(path, 'r') as f:
+        first_line = f.readline()
+    with open(path, 'w') as f:
+        f.write(first_line)
+    ledger = Ledger(path, prices=PRICES)
+    assert ledger.rollup("model")["m"]["requests"] == 1
+    ledger.close()
+
+
+def test_record_picks_up_entries_another_process_wrote(tmp_path):
+    path = str(tmp_path / "ledger.jsonl")
+    ledger = Ledger(path, prices=PRICES)
+    entry = dict(ledger.record("m", USAGE), session="other")
+    # Written by another process that has not updated the rollups yet
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + "\n")
+    ledger.record("m", USAGE)
+    assert ledger.rollup("model")["m"]["requests"] == 3
+    assert ledger.rollup("session")["other"]["requests"] == 1
+    ledger.close()
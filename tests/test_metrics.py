@@ -0,0 +1,110 @@
+"""
+Tests for latency histograms and the Prometheus metrics surface
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: pytest, math, random, re, urllib, cache, client, metrics
+Licence: Please cite if used.
+"""
+
+import math
+import random
+import re
+import urllib.error
+import urllib.request
+
+import pytest
+
+from cache import ResponseCache
+from client import AsyncClient
+from metrics import QUANTILES, Histogram, Metrics
+
+# Half the width of a sub-bucket, relative to its low edge
+MAX_RELATIVE_ERROR = 1 / 32
+SAMPLE = re.compile(r'^[a-z_]+(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? -?[0-9.e+-]+$')
+
+
+@pytest.mark.parametrize("low, high", [(1e-3, 100.0), (0.05, 0.5), (1e-5, 1e-4)])
+def test_percentiles_are_within_the_bucket_error(low, high):
+    rng = random.Random(7)
+    values = [math.exp(rng.uniform(math.log(low), math.log(high))) for _ in range(5000)]
+    histogram = Histogram()
+    for value in values:
+        histogram.record(value)
+    ordered = sorted(values)
+    for q in QUANTILES + (0.001, 1.0):
+        exact = ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+        # Sub-microsecond truncation dominates for the smallest values
+        tolerance = exact * MAX_RELATIVE_ERROR + 1e-6
+        assert abs(histogram.percentile(q) - exact) <= tolerance
+    assert histogram.count == 5000 and histogram.max == max(values)
+    assert histogram.sum == pytest.approx(sum(values))
+
+
+def test_empty_histogram_and_missing_values():
+    histogram = Histogram()
+    histogram.record(None)
+    assert histogram.count == 0 and histogram.percentile(0.5) is None
+
+
+def test_percentile_never_exceeds_the_maximum():
+    histogram = Histogram()
+    # The low edge of a bucket, whose middle is above the value
+    histogram.record(2 ** 20 / 1e6)
+    assert histogram.percentile(0.99) == 2 ** 20 / 1e6
+
+
+def make_metrics():
+    metrics = Metrics()
+    client = AsyncClient(backend=object(), cache=ResponseCache(None), metrics=metrics)
+    params = {"engine": "e", "prompt": "p", "max_tokens": 5, "temperature": 0}
+    for seconds in (0.1, 0.2, 0.3):
+        metrics.observe("completion", params, seconds, {"text": "hi", "ttft": seconds / 2,
+                                                        "usage": {"prompt_tokens": 3, "completion_tokens": 2}})
+    metrics.observe("completion", params, 0.01, {"text": "hi", "ttft": 0.0, "cached": True, "usage": {}})
+    metrics.observe("chat", {"model": "c"}, 0.5, {"text": "", "ttft": None, "usage": {}})
+    metrics.observe("chat", {"model": "c"}, 1.0, error=TimeoutError())
+    return metrics, client
+
+
+def test_render_is_valid_prometheus_text():
+    metrics, _ = make_metrics()
+    text = metrics.render()
+    declared = set()
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            declared.add(line.split()[2])
+        elif not line.startswith("# HELP "):
+            assert SAMPLE.match(line), line
+            name = line.split("{")[0].split()[0]
+            assert name in declared or re.sub(r"_(sum|count)$", "", name) in declared
+    assert 'browsegpt_request_latency_seconds_count{model="e"} 4' in text
+    assert 'browsegpt_ttft_seconds_count{model="e"} 3' in text
+    # The empty streamed reply has no first token, so the chat model has no TTFT summary
+    assert 'browsegpt_ttft_seconds_count{model="c"}' not in text
+    assert 'browsegpt_requests_total{model="c",outcome="TimeoutError"} 1' in text
+    assert 'browsegpt_requests_total{model="e",outcome="cached"} 1' in text
+    assert 'browsegpt_prompt_tokens_total{model="e"} 9' in text
+    assert "browsegpt_cache_hit_ratio 0.0" in text
+
+
+def test_summary_counts_requests_errors_and_tokens():
+    metrics, _ = make_metrics()
+    rows = {row["model"]: row for row in metrics.summary()}
+    assert (rows["e"]["requests"], rows["e"]["errors"], rows["e"]["completion_tokens"]) == (4, 0, 6)
+    assert (rows["c"]["requests"], rows["c"]["errors"], rows["c"]["ttft_p50"]) == (2, 1, None)
+
+
+def test_dump_and_serve(tmp_path):
+    metrics, _ = make_metrics()
+    path = tmp_path / "metrics.prom"
+    metrics.dump(str(path))
+    assert path.read_text() == metrics.render()
+    port = metrics.serve(0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.read().decode("utf-8") == metrics.render()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other")
+    finally:
+        metrics.close()
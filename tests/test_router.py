@@ -0,0 +1,44 @@
+"""
+Tests for the model router's decision log
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: pytest, json, history, router
+Licence: Please cite if used.
+"""
+
+import json
+
+from history import SYNC_EVERY
+from router import ModelRouter
+
+MODELS = {"GPT-3": "text-davinci-002", "GPT-3.5": "text-davinci-003"}
+
+
+def read_log(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_log_is_flushed_in_batches_and_on_close(tmp_path):
+    path = tmp_path / "router_log.jsonl"
+    router = ModelRouter(None, MODELS, log_path=str(path))
+    router.last_flush = float("inf")
+    router.route("Hello", 16)
+    assert read_log(path) == []
+    for _ in range(SYNC_EVERY - 1):
+        router.route("Hello", 16)
+    assert len(read_log(path)) == SYNC_EVERY
+    router.route("Hello", 16)
+    router.close()
+    decisions = read_log(path)
+    assert len(decisions) == SYNC_EVERY + 1
+    assert decisions[-1]["chosen"] in MODELS.values()
+    router.close()
+
+
+def test_no_log_file_without_a_path(tmp_path):
+    router = ModelRouter(None, MODELS)
+    router.route("Hello", 16)
+    router.close()
+    assert len(router.decisions) == 1 and router.log_file is None
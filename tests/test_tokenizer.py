@@ -0,0 +1,37 @@
+"""
+Tests for the local BPE tokenizer
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: pytest, tokenizer
+Licence: Please cite if used.
+"""
+
+import pytest
+
+from tokenizer import count_tokens, decode, encode, pre_tokenize
+
+
+@pytest.mark.parametrize("text, pieces", [
+    ("x²", ["x", "²"]),
+    (" x²", [" x", "²"]),
+    ("ab½c", ["ab", "½", "c"]),
+    ("x²3", ["x", "²3"]),
+    ("Ⅻ century", ["Ⅻ", " century"]),
+    ("café 12", ["café", " 12"]),
+    ("it's a_b", ["it", "'s", " a", "_", "b"]),
+    ("hello  world\n", ["hello", " ", " world", "\n"]),
+])
+def test_pre_tokenize_matches_gpt2(text, pieces):
+    assert pre_tokenize(text) == pieces
+
+
+@pytest.mark.parametrize("text", ["Hello world", "x² + ½ = ab½c", "naïve café, 12 ½"])
+def test_encode_round_trips(text):
+    tokens = encode(text)
+    assert decode(tokens) == text
+    assert count_tokens(text) == len(tokens)
+
+
+def test_numerals_are_encoded_apart_from_letters():
+    assert count_tokens("x²") == count_tokens("x") + count_tokens("²")
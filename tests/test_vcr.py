@@ -0,0 +1,147 @@
+"""
+Tests for record and replay of API traffic
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, pytest, asyncio, gzip, json, time, vcr
+Licence: Please cite if used.
+"""
+
+import asyncio
+import gzip
+import json
+import time
+
+import openai
+import pytest
+
+from vcr import Cassette, CassetteMiss, Player, Recorder, from_export
+
+PARAMS = {"engine": "e", "prompt": "user: hi", "max_tokens": 5, "temperature": 0}
+
+
+class LiveBackend:
+    """
+    Backend that streams two tokens, or fails for prompts containing "fail".
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    async def send(self, endpoint, params, on_token=None):
+        self.calls += 1
+        if "fail" in params["prompt"]:
+            raise openai.error.RateLimitError("slow down", http_status=429, headers={"retry-after": "7"})
+        await asyncio.sleep(0.01)
+        if on_token is not None:
+            on_token("Hello")
+            await asyncio.sleep(0.01)
+            on_token(" there")
+        return {"text": f"Hello there {self.calls}", "usage": {"prompt_tokens": 3, "completion_tokens": 2},
+                "ttft": 0.01, "latency": 0.02}
+
+    async def send_batch(self, params):
+        results = [await self.send("completion", dict(params, prompt=prompt)) for prompt in params["prompt"]]
+        return results, {"prompt_tokens": 3 * len(results)}
+
+
+def record(path, requests):
+    async def scenario():
+        recorder = Recorder(LiveBackend(), Cassette(path))
+        outcomes = []
+        for params, on_token in requests:
+            try:
+                outcomes.append(await recorder.send("completion", params, on_token))
+            except openai.error.OpenAIError as e:
+                outcomes.append(e)
+        await recorder.close()
+        return outcomes
+
+    return asyncio.run(scenario())
+
+
+def replay(path, requests, realtime=False):
+    async def scenario():
+        player = Player(Cassette(path), realtime=realtime)
+        outcomes = []
+        for params, on_token in requests:
+            try:
+                outcomes.append(await player.send("completion", params, on_token))
+            except openai.error.OpenAIError as e:
+                outcomes.append(e)
+        await player.close()
+        return outcomes
+
+    return asyncio.run(scenario())
+
+
+def test_round_trip_replays_answers_tokens_and_errors(tmp_path):
+    path = str(tmp_path / "cassette.jsonl.gz")
+    recorded_tokens, replayed_tokens = [], []
+    requests = [(dict(PARAMS, api_key="sk-secret"), recorded_tokens.append),
+                (dict(PARAMS, prompt="user: fail"), None)]
+    recorded = record(path, requests)
+    replayed = replay(path, [(PARAMS, replayed_tokens.append), (dict(PARAMS, prompt="user: fail"), None)])
+    assert replayed[0]["text"] == recorded[0]["text"] and replayed[0]["usage"] == recorded[0]["usage"]
+    assert replayed_tokens == recorded_tokens == ["Hello", " there"]
+    error = replayed[1]
+    assert isinstance(error, openai.error.RateLimitError)
+    assert str(error) == "slow down" and error.http_status == 429 and error.headers["Retry-After"] == "7"
+    with gzip.open(path, 'rt') as f:
+        assert "sk-secret" not in f.read()
+
+
+def test_repeated_requests_replay_in_order_then_repeat(tmp_path):
+    path = str(tmp_path / "cassette.jsonl.gz")
+    record(path, [(PARAMS, None), (PARAMS, None)])
+    texts = [result["text"] for result in replay(path, [(PARAMS, None)] * 3)]
+    assert texts == ["Hello there 1", "Hello there 2", "Hello there 2"]
+
+
+def test_unrecorded_request_is_a_miss(tmp_path):
+    path = str(tmp_path / "cassette.jsonl.gz")
+    record(path, [(PARAMS, None)])
+    with pytest.raises(CassetteMiss):
+        replay(path, [(dict(PARAMS, temperature=1), None)])
+
+
+def test_realtime_replay_keeps_the_recorded_pace(tmp_path):
+    path = str(tmp_path / "cassette.jsonl.gz")
+    record(path, [(PARAMS, lambda token: None)])
+    start = time.monotonic()
+    result = replay(path, [(PARAMS, lambda token: None)], realtime=True)[0]
+    assert time.monotonic() - start >= 0.02 and result["ttft"] >= 0.01
+    fast = replay(path, [(PARAMS, lambda token: None)])[0]
+    assert fast["latency"] < 0.01
+
+
+def test_batches_are_recorded_as_single_completions(tmp_path):
+    path = str(tmp_path / "cassette.jsonl.gz")
+
+    async def scenario():
+        recorder = Recorder(LiveBackend(), Cassette(path))
+        await recorder.send_batch(dict(PARAMS, prompt=["user: a", "user: b"]))
+        await recorder.close()
+        player = Player(Cassette(path))
+        single = await player.send("completion", dict(PARAMS, prompt="user: b"))
+        batch, usage = await player.send_batch(dict(PARAMS, prompt=["user: a", "user: b"]))
+        return single, batch, usage
+
+    single, batch, usage = asyncio.run(scenario())
+    assert single["text"] == "Hello there 2"
+    assert [r["text"] for r in batch] == ["Hello there 1", "Hello there 2"]
+    assert usage == {"prompt_tokens": 6, "completion_tokens": 4}
+
+
+def test_history_export_becomes_a_cassette(tmp_path):
+    export = tmp_path / "export.jsonl"
+    export.write_text("\n".join(json.dumps(record) for record in [
+        {"query": "hi", "response": "Hello", "model": "text-davinci-003", "ttft": 0.5},
+        {"query": "old", "response": "From before models were saved"},
+        {"query": "", "response": "skipped"},
+    ]))
+    path = str(tmp_path / "cassette.jsonl.gz")
+    assert from_export(str(export), path, max_tokens=5, temperature=0, engine="e") == 2
+    replayed = replay(path, [(dict(PARAMS, engine="text-davinci-003"), None),
+                             (dict(PARAMS, prompt="user: old"), None)])
+    assert [r["text"] for r in replayed] == ["Hello", "From before models were saved"]
@@ -0,0 +1,485 @@
+"""
+Local BPE tokenizer for browseGPT
+
+Loads the GPT-2 byte-pair encoding tables shipped in the browseGPT app's
+GPTEncoder bundle, so prompts can be counted without a network round trip.
+
+Parsing encoder.json and vocab.bpe takes a noticeable part of each launch, so
+the tables can be compiled once into a binary file that later runs
+memory-map:
+
+    python tokenizer.py compile
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: array, json, mmap, os, re, struct, sys, zlib
+Licence: Please cite if used.
+"""
+
+import array
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+
+ENCODER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "browseGPT.app",
+                           "Contents", "Resources", "GPTEncoder_GPTEncoder.bundle",
+                           "Contents", "Resources")
+COMPILED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gpt_encoder.bin")
+BPE_CACHE_SIZE = 100000
+
+# Compiled file header: magic, byte-order marker, token and merge counts,
+# hash table sizes and string blob lengths. Arrays are native uint32.
+MAGIC = b"BPE1"
+BYTE_ORDER_MARK = 0x01020304
+HEADER = struct.Struct("=4s7I")
+
+# GPT-2 pre-tokenizer. For ASCII text [^\W\d_] matches \p{L} and \d matches \p{N};
+# other text goes through unicode_pattern(), which moves numerals such as ² and ½
+# (Unicode Nl and No, which re counts as \w but not \d) from letters to numbers
+PATTERN_TEMPLATE = r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_{0}]+| ?[\d{0}]+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+"""
+PATTERN = re.compile(PATTERN_TEMPLATE.format(""))
+
+_encoder = None
+_unicode_pattern = None
+
+
+def bytes_to_unicode():
+    """
+    Map every byte to a printable unicode character, as GPT-2 does.
+
+    Returns:
+        dict: Byte values mapped to single characters.
+    """
+    bs = (list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1))
+          + list(range(ord("®"), ord("ÿ") + 1)))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+class Encoder:
+    """
+    GPT-2 byte-pair encoder.
+    """
+
+    def __init__(self, encoder, merges):
+        """
+        Initialize the encoder from its vocabulary and merge list.
+
+        Args:
+            encoder (dict): Token strings mapped to token IDs.
+            merges (list): Merge pairs, highest priority first.
+        """
+        self.encoder = encoder
+        self.decoder = {v: k for k, v in encoder.items()}
+        self.bpe_ranks = {pair: rank for rank, pair in enumerate(merges)}
+        self.init_bytes()
+
+    def init_bytes(self):
+        """
+        Set up the byte mapping and the merge cache.
+        """
+        self.byte_encoder = bytes_to_unicode()
+        self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+        # Words repeat heavily in chat text, so merge results are memoized
+        self.cache = {}
+
+    def rank(self, pair):
+        """
+        Return the merge priority of a pair.
+
+        Args:
+            pair (tuple): Two adjacent sub-word strings.
+
+        Returns:
+            float: The merge rank, or infinity if the pair never merges.
+        """
+        return self.bpe_ranks.get(pair, float("inf"))
+
+    def token_id(self, part):
+        """
+        Return the ID of a sub-word string.
+
+        Args:
+            part (str): The sub-word string.
+
+        Returns:
+            int: The token ID.
+        """
+        return self.encoder[part]
+
+    def token_string(self, token):
+        """
+        Return the sub-word string of a token ID.
+
+        Args:
+            token (int): The token ID.
+
+        Returns:
+            str: The sub-word string.
+        """
+        return self.decoder[token]
+
+    def bpe(self, token):
+        """
+        Apply byte-pair merges to one pre-tokenized word.
+
+        Args:
+            token (str): The word, already mapped through bytes_to_unicode.
+
+        Returns:
+            tuple: The merged sub-word strings.
+        """
+        cached = self.cache.get(token)
+        if cached is not None:
+            return cached
+
+        word = tuple(token)
+        while len(word) > 1:
+            pairs = {(word[i], word[i + 1]) for i in range(len(word) - 1)}
+            pair = min(pairs, key=self.rank)
+            if self.rank(pair) == float("inf"):
+                break
+            first, second = pair
+            merged = []
+            i = 0
+            while i < len(word):
+                if i < len(word) - 1 and word[i] == first and word[i + 1] == second:
+                    merged.append(first + second)
+                    i += 2
+                else:
+                    merged.append(word[i])
+                    i += 1
+            word = tuple(merged)
+
+        if len(self.cache) >= BPE_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[token] = word
+        return word
+
+    def encode(self, text):
+        """
+        Encode text to token IDs.
+
+        Args:
+            text (str): The text to encode.
+
+        Returns:
+            list: The token IDs.
+        """
+        tokens = []
+        for piece in pre_tokenize(text):
+            piece = "".join(self.byte_encoder[b] for b in piece.encode("utf-8"))
+            tokens.extend(self.token_id(part) for part in self.bpe(piece))
+        return tokens
+
+    def decode(self, tokens):
+        """
+        Decode token IDs back to text.
+
+        Args:
+            tokens (list): The token IDs.
+
+        Returns:
+            str: The decoded text.
+        """
+        text = "".join(self.token_string(token) for token in tokens)
+        return bytearray(self.byte_decoder[c] for c in text).decode("utf-8", errors="replace")
+
+
+class MappedEncoder(Encoder):
+    """
+    GPT-2 byte-pair encoder reading its tables from a memory-mapped file.
+
+    Nothing is parsed at load time; lookups go through open-addressed hash
+    tables in the file, and the pages are shared by every process that maps
+    the same file.
+    """
+
+    def __init__(self, path=COMPILED_PATH):
+        """
+        Map a compiled tables file.
+
+        Args:
+            path (str): The file written by compile_tables().
+
+        Raises:
+            ValueError: If the file is not a compiled tables file for this machine.
+        """
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, mark, n_tokens, n_merges, token_slots, merge_slots, token_blob, merge_blob = \
+            HEADER.unpack_from(self.map)
+        if magic != MAGIC or mark != BYTE_ORDER_MARK:
+            self.map.close()
+            raise ValueError(f"{path} is not a compiled tokenizer for this machine")
+
+        view = memoryview(self.map)
+        offset = HEADER.size
+        sections = []
+        for length in (n_tokens + 1, token_slots, n_merges + 1, merge_slots):
+            sections.append(view[offset:offset + 4 * length].cast("I"))
+            offset += 4 * length
+        self.token_offsets, self.token_table, self.merge_offsets, self.merge_table = sections
+        self.token_blob = offset
+        self.merge_blob = offset + token_blob
+        self.n_tokens = n_tokens
+        self.init_bytes()
+
+    def lookup(self, table, offsets, blob, key):
+        """
+        Find a key in one of the hash tables.
+
+        Args:
+            table (memoryview): The hash table of index + 1, with 0 for empty slots.
+            offsets (memoryview): Offsets of each string in the blob.
+            blob (int): The file offset of the string blob.
+            key (bytes): The UTF-8 key.
+
+        Returns:
+            int: The index of the key, or -1 if it is not present.
+        """
+        mask = len(table) - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            entry = table[slot]
+            if entry == 0:
+                return -1
+            index = entry - 1
+            if self.map[blob + offsets[index]:blob + offsets[index + 1]] == key:
+                return index
+            slot = (slot + 1) & mask
+
+    def rank(self, pair):
+        """
+        Return the merge priority of a pair from the mapped merge table.
+        """
+        key = f"{pair[0]} {pair[1]}".encode("utf-8")
+        rank = self.lookup(self.merge_table, self.merge_offsets, self.merge_blob, key)
+        return float("inf") if rank < 0 else rank
+
+    def token_id(self, part):
+        """
+        Return the ID of a sub-word string from the mapped token table.
+        """
+        token = self.lookup(self.token_table, self.token_offsets, self.token_blob, part.encode("utf-8"))
+        if token < 0:
+            raise KeyError(part)
+        return token
+
+    def token_string(self, token):
+        """
+        Return the sub-word string of a token ID from the mapped blob.
+        """
+        if not 0 <= token < self.n_tokens:
+            raise KeyError(token)
+        start = self.token_blob + self.token_offsets[token]
+        end = self.token_blob + self.token_offsets[token + 1]
+        return self.map[start:end].decode("utf-8")
+
+
+def unicode_pattern():
+    """
+    Return the pre-tokenizer for text beyond ASCII, building it on first use.
+
+    Finding the numerals means checking every code point, which takes about
+    a tenth of a second, so ASCII-only programs never pay for it.
+
+    Returns:
+        re.Pattern: The pattern.
+    """
+    global _unicode_pattern
+    if _unicode_pattern is None:
+        numerals = "".join(c for c in map(chr, range(sys.maxunicode + 1))
+                           if c.isnumeric() and not c.isdecimal() and not c.isalpha())
+        _unicode_pattern = re.compile(PATTERN_TEMPLATE.format(re.escape(numerals)))
+    return _unicode_pattern
+
+
+def pre_tokenize(text):
+    """
+    Split text into the pieces GPT-2 encodes separately.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        list: The pieces, in order.
+    """
+    return (PATTERN if text.isascii() else unicode_pattern()).findall(text)
+
+
+def read_tables(directory=ENCODER_DIR):
+    """
+    Read the vocabulary and merges from encoder.json and vocab.bpe.
+
+    Args:
+        directory (str): The directory holding both files.
+
+    Returns:
+        tuple: The token-to-ID dict and the list of merge pairs.
+    """
+    with open(os.path.join(directory, "encoder.json"), 'r', encoding="utf-8") as f:
+        encoder = json.load(f)
+    with open(os.path.join(directory, "vocab.bpe"), 'r', encoding="utf-8") as f:
+        # The first line is a "#version" header and the file ends with a newline
+        merges = [tuple(line.split()) for line in f.read().split("\n")[1:] if line]
+    return encoder, merges
+
+
+def load_encoder(directory=ENCODER_DIR):
+    """
+    Load an encoder from encoder.json and vocab.bpe.
+
+    Args:
+        directory (str): The directory holding both files.
+
+    Returns:
+        Encoder: The loaded encoder.
+    """
+    return Encoder(*read_tables(directory))
+
+
+def build_table(keys):
+    """
+    Build an open-addressed hash table over a list of keys.
+
+    Args:
+        keys (list): The UTF-8 keys, stored as index + 1.
+
+    Returns:
+        array.array: The table, sized to a power of two at most half full.
+    """
+    size = 1
+    while size < 2 * len(keys):
+        size *= 2
+    table = array.array("I", bytes(4 * size))
+    mask = size - 1
+    for index, key in enumerate(keys):
+        slot = zlib.crc32(key) & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = index + 1
+    return table
+
+
+def pack_strings(keys):
+    """
+    Concatenate strings and record where each one starts.
+
+    Args:
+        keys (list): The UTF-8 strings.
+
+    Returns:
+        tuple: The offsets array (one longer than keys) and the blob.
+    """
+    offsets = array.array("I", [0])
+    for key in keys:
+        offsets.append(offsets[-1] + len(key))
+    return offsets, b"".join(keys)
+
+
+def compile_tables(directory=ENCODER_DIR, output=COMPILED_PATH):
+    """
+    Compile encoder.json and vocab.bpe into a file MappedEncoder can map.
+
+    Args:
+        directory (str): The directory holding both files.
+        output (str): The compiled file to write.
+    """
+    encoder, merges = read_tables(directory)
+    by_id = sorted(encoder.items(), key=lambda item: item[1])
+    if [token for _, token in by_id] != list(range(len(by_id))):
+        raise ValueError("Token IDs in encoder.json are not contiguous")
+
+    tokens = [part.encode("utf-8") for part, _ in by_id]
+    pairs = [f"{first} {second}".encode("utf-8") for first, second in merges]
+    token_offsets, token_blob = pack_strings(tokens)
+    merge_offsets, merge_blob = pack_strings(pairs)
+    token_table = build_table(tokens)
+    merge_table = build_table(pairs)
+
+    temp = output + ".tmp"
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, BYTE_ORDER_MARK, len(tokens), len(pairs), len(token_table),
+                            len(merge_table), len(token_blob), len(merge_blob)))
+        for table in (token_offsets, token_table, merge_offsets, merge_table):
+            table.tofile(f)
+        f.write(token_blob)
+        f.write(merge_blob)
+    os.replace(temp, output)
+
+
+def get_encoder():
+    """
+    Return the shared encoder, loading it on first use.
+
+    The compiled tables are used when they exist, otherwise the JSON files
+    are parsed.
+
+    Returns:
+        Encoder: The bundled GPT-2 encoder.
+    """
+    global _encoder
+    if _encoder is None:
+        try:
+            _encoder = MappedEncoder()
+        except (OSError, ValueError):
+            _encoder = load_encoder()
+    return _encoder
+
+
+def encode(text):
+    """
+    Encode text with the bundled encoder.
+
+    Args:
+        text (str): The text to encode.
+
+    Returns:
+        list: The token IDs.
+    """
+    return get_encoder().encode(text)
+
+
+def decode(tokens):
+    """
+    Decode token IDs with the bundled encoder.
+
+    Args:
+        tokens (list): The token IDs.
+
+    Returns:
+        str: The decoded text.
+    """
+    return get_encoder().decode(tokens)
+
+
+def count_tokens(text):
+    """
+    Count the tokens in a piece of text.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+    return len(get_encoder().encode(text))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "compile":
+        print("Usage: python tokenizer.py compile [output]")
+        sys.exit(1)
+    compile_tables(output=sys.argv[2] if len(sys.argv) > 2 else COMPILED_PATH)
+    print("Compiled tokenizer tables written.")
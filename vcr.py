@@ -0,0 +1,406 @@
+"""
+Record and replay of API traffic for browseGPT
+
+A cassette is a gzipped JSONL file with one recorded request per line: the
+parameters, the answer or error, and the timing of every streamed token.
+Recorder wraps a live backend and writes cassettes; Player serves them back
+without a network, at the recorded pace or as fast as possible.
+
+Usage: python vcr.py convert <history export> <cassette>
+
+Date: 5/25/2023
+Author: Javed I. Ahmed; chat@aicanalytics.com
+Dependencies: openai, argparse, asyncio, gzip, hashlib, json, time
+Licence: Please cite if used.
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import time
+
+import openai
+
+# Parameters that do not change the answer and must not be written to disk
+UNRECORDED = ("api_key", "organization", "api_base")
+# MODELS["GPT-3"], the chat loop's default, for exports whose records have no model
+DEFAULT_ENGINE = "text-davinci-002"
+
+
+def request_key(endpoint, params):
+    """
+    Return the key a request is recorded under.
+
+    Args:
+        endpoint (str): "completion" or "chat".
+        params (dict): The request parameters.
+
+    Returns:
+        str: A hash of the endpoint and parameters, without credentials.
+    """
+    recorded = {k: v for k, v in params.items() if k not in UNRECORDED}
+    return hashlib.sha1(json.dumps([endpoint, recorded], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class CassetteMiss(LookupError):
+    """
+    Raised when a replayed request was never recorded.
+    """
+
+
+class Cassette:
+    """
+    Recorded requests, read from and appended to a gzipped JSONL file.
+
+    Requests recorded more than once are replayed in the order they were
+    recorded, and the last one repeats after that.
+    """
+
+    def __init__(self, path):
+        """
+        Load the cassette, if the file exists.
+
+        Args:
+            path (str): The path to the cassette file.
+        """
+        self.path = path
+        self.entries = {}
+        self.played = {}
+        self.file = None
+        try:
+            with gzip.open(path, 'rt') as f:
+                for line in f:
+                    if line.strip():
+                        self.add(json.loads(line))
+        except FileNotFoundError:
+            pass
+        except EOFError:
+            # A recording cut off mid-write; keep what was read
+            pass
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def add(self, entry):
+        """
+        Index an entry in memory.
+
+        Args:
+            entry (dict): The recorded request.
+        """
+        self.entries.setdefault(entry["key"], []).append(entry)
+
+    def record(self, entry):
+        """
+        Add an entry and append it to the file.
+
+        Args:
+            entry (dict): The recorded request.
+        """
+        self.add(entry)
+        if self.file is None:
+            self.file = gzip.open(self.path, 'at')
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def find(self, key):
+        """
+        Return the next recorded entry for a request.
+
+        Args:
+            key (str): The request key.
+
+        Returns:
+            dict: The entry.
+
+        Raises:
+            CassetteMiss: If the request was never recorded.
+        """
+        entries = self.entries.get(key)
+        if not entries:
+            raise CassetteMiss(f"Request {key[:12]} is not in cassette {self.path}")
+        index = self.played.get(key, 0)
+        self.played[key] = index + 1
+        return entries[min(index, len(entries) - 1)]
+
+    def close(self):
+        """
+        Close the file.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def make_entry(endpoint, params, result=None, error=None, chunks=None):
+    """
+    Build a cassette entry.
+
+    Args:
+        endpoint (str): "completion" or "chat".
+        params (dict): The request parameters.
+        result (dict): The response, on success.
+        error (Exception): The error, on failure.
+        chunks (list): [seconds since start, token] pairs of a stream.
+
+    Returns:
+        dict: The entry.
+    """
+    entry = {"key": request_key(endpoint, params), "endpoint": endpoint,
+             "params": {k: v for k, v in params.items() if k not in UNRECORDED}}
+    if error is not None:
+        headers = getattr(error, "headers", None) or {}
+        entry["error"] = {"type": type(error).__name__, "message": str(error),
+                          "status": getattr(error, "http_status", None),
+                          "retry_after": headers.get("retry-after") or headers.get("Retry-After")}
+    else:
+        entry.update(text=result["text"], usage=result["usage"], ttft=result["ttft"],
+                     latency=result["latency"])
+        if chunks:
+            entry["chunks"] = chunks
+    return entry
+
+
+class Recorder:
+    """
+    Backend wrapper that records every request to a cassette.
+    """
+
+    def __init__(self, backend, cassette):
+        """
+        Initialize the recorder.
+
+        Args:
+            backend (object): The live backend.
+            cassette (Cassette): Where to record.
+        """
+        self.backend = backend
+        self.cassette = cassette
+
+    async def send(self, endpoint, params, on_token=None):
+        """
+        Send a request through the live backend and record it.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): The request parameters.
+            on_token (callable): Called with each token when streaming.
+
+        Returns:
+            dict: The response text, usage, time to first token and latency.
+        """
+        start = time.monotonic()
+        chunks = []
+
+        def forward(token):
+            chunks.append([time.monotonic() - start, token])
+            on_token(token)
+
+        try:
+            result = await self.backend.send(endpoint, params, forward if on_token else None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.cassette.record(make_entry(endpoint, params, error=e))
+            raise
+        self.cassette.record(make_entry(endpoint, params, result, chunks=chunks))
+        return result
+
+    async def send_batch(self, params):
+        """
+        Send a list of prompts and record each as its own completion.
+
+        Args:
+            params (dict): The request parameters, with a list prompt.
+
+        Returns:
+            tuple: One result per prompt, in order, and the usage of the whole batch.
+        """
+        results, usage = await self.backend.send_batch(params)
+        for prompt, result in zip(params["prompt"], results):
+            self.cassette.record(make_entry("completion", dict(params, prompt=prompt), result))
+        return results, usage
+
+    async def close(self):
+        """
+        Close the cassette and the live backend.
+        """
+        self.cassette.close()
+        if hasattr(self.backend, "close"):
+            await self.backend.close()
+
+
+class Player:
+    """
+    Backend that serves recorded requests without a network.
+
+    With realtime set, each answer is held back until its recorded latency
+    and each streamed token until its recorded offset; otherwise everything
+    comes back at once.
+    """
+
+    def __init__(self, cassette, realtime=False):
+        """
+        Initialize the player.
+
+        Args:
+            cassette (Cassette): The recorded requests.
+            realtime (bool): Whether to replay at the recorded pace.
+        """
+        self.cassette = cassette
+        self.realtime = realtime
+
+    async def wait_until(self, start, offset):
+        """
+        Sleep until a recorded offset, when replaying in real time.
+
+        Args:
+            start (float): When the replayed request started.
+            offset (float): The recorded seconds since its start.
+        """
+        if self.realtime and offset:
+            await asyncio.sleep(max(0.0, start + offset - time.monotonic()))
+
+    @staticmethod
+    def raise_error(error):
+        """
+        Raise a recorded error as the openai error it was.
+
+        Args:
+            error (dict): The recorded error.
+        """
+        kind = getattr(openai.error, error["type"], None)
+        if not (isinstance(kind, type) and issubclass(kind, openai.error.OpenAIError)):
+            kind = openai.error.APIError
+        headers = {"Retry-After": error["retry_after"]} if error.get("retry_after") else None
+        if issubclass(kind, openai.error.InvalidRequestError):
+            raise kind(error["message"], None, http_status=error.get("status"), headers=headers)
+        raise kind(error["message"], http_status=error.get("status"), headers=headers)
+
+    async def send(self, endpoint, params, on_token=None):
+        """
+        Replay a recorded request.
+
+        Args:
+            endpoint (str): "completion" or "chat".
+            params (dict): The request parameters.
+            on_token (callable): Called with each token when streaming.
+
+        Returns:
+            dict: The recorded response, with the replayed timing.
+
+        Raises:
+            CassetteMiss: If the request was never recorded.
+        """
+        start = time.monotonic()
+        entry = self.cassette.find(request_key(endpoint, params))
+        if "error" in entry:
+            self.raise_error(entry["error"])
+        ttft = None
+        if on_token is not None:
+            # Recordings made without streaming replay as one chunk
+            for offset, token in entry.get("chunks") or [[entry["ttft"], entry["text"]]]:
+                await self.wait_until(start, offset)
+                if ttft is None:
+                    ttft = time.monotonic() - start
+                on_token(token)
+        await self.wait_until(start, entry["latency"])
+        latency = time.monotonic() - start
+        return {"text": entry["text"], "usage": dict(entry.get("usage") or {}),
+                "ttft": ttft if ttft is not None else latency, "latency": latency}
+
+    async def send_batch(self, params):
+        """
+        Replay a list of prompts from their recorded single completions.
+
+        Args:
+            params (dict): The request parameters, with a list prompt.
+
+        Returns:
+            tuple: One result per prompt, in order, and their summed usage.
+        """
+        results = await asyncio.gather(*[self.send("completion", dict(params, prompt=prompt))
+                                         for prompt in params["prompt"]])
+        usage = {}
+        for result in results:
+            for name, count in result["usage"].items():
+                usage[name] = usage.get(name, 0) + count
+        return list(results), usage
+
+    async def close(self):
+        """
+        Close the cassette.
+        """
+        self.cassette.close()
+
+
+def read_export(path):
+    """
+    Read a history export, in JSON list or JSONL form.
+
+    Args:
+        path (str): The path to the export.
+
+    Returns:
+        list: The history records.
+    """
+    with open(path, 'r') as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def from_export(export_path, cassette_path, role="user", max_tokens=60, temperature=0.5,
+                engine=DEFAULT_ENGINE):
+    """
+    Turn a history export into a cassette of completion requests.
+
+    The requests are rebuilt the way the chat loop builds them, so the
+    role, max tokens and temperature must match the settings of the session
+    being replayed. Records saved before the model was kept in the history
+    are charged to the given engine.
+
+    Args:
+        export_path (str): The history export.
+        cassette_path (str): The cassette to append to.
+        role (str): The role prefixed to each query.
+        max_tokens (int): The max tokens of the recorded session.
+        temperature (float): The temperature of the recorded session.
+        engine (str): The engine for records that do not name one.
+
+    Returns:
+        int: The number of requests written.
+    """
+    cassette = Cassette(cassette_path)
+    count = 0
+    for record in read_export(export_path):
+        if not record.get("query") or record.get("response") is None:
+            continue
+        params = {"engine": record.get("model") or engine, "prompt": f"{role}: {record['query']}",
+                  "max_tokens": max_tokens, "temperature": temperature}
+        ttft = record.get("ttft") or 0.0
+        result = {"text": record["response"], "usage": {}, "ttft": ttft,
+                  "latency": record.get("latency") or ttft}
+        cassette.record(make_entry("completion", params, result))
+        count += 1
+    cassette.close()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage browseGPT request cassettes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="turn a history export into a cassette")
+    convert.add_argument("export")
+    convert.add_argument("cassette")
+    convert.add_argument("--role", default="user")
+    convert.add_argument("--max-tokens", type=int, default=60)
+    convert.add_argument("--temperature", type=float, default=0.5)
+    convert.add_argument("--engine", default=DEFAULT_ENGINE, help="engine for records without a model")
+    args = parser.parse_args()
+    written = from_export(args.export, args.cassette, args.role, args.max_tokens, args.temperature,
+                          args.engine)
+    print(f"Wrote {written} requests to {args.cassette}")